@@ -0,0 +1,214 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from mtf_nps_dqe.lib import utils
+from mtf_nps_dqe.mtf import measureMTF
+from mtf_nps_dqe.nps import measureNPS
+
+# Benchmarks of the numerical kernels on deterministic synthetic input. Every case is run once with tracemalloc
+# enabled to measure the peak memory, and then --repeat times without to measure the (minimum) wall time.
+
+DATA = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'data', 'edge', 'simulated')
+
+PRESETS = {
+    # frame sizes for the single frame kernels, and (frame size, stack length) for the stack kernels
+    'quick': {
+        'sizes': [512, 1024, 2048],
+        'stacks': [(512, 10), (512, 100)],
+    },
+    'full': {
+        'sizes': [512, 1024, 2048, 4096, 8192],
+        'stacks': [(512, 10), (512, 100), (512, 300), (1024, 100), (2048, 20), (4096, 4), (8192, 2)],
+    },
+}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--preset', default='quick', choices=PRESETS.keys(), help='Set of frame sizes and stack lengths')
+    parser.add_argument('--repeat', default=3, type=int, help='Number of timed runs per case (minimum is reported)')
+    parser.add_argument('--filter', type=str, help='Only run cases which name contains this string')
+    parser.add_argument('--output', type=str, help='Store the results as JSON')
+    parser.add_argument('--baseline', type=str, help='Compare against the results in this JSON file')
+    parser.add_argument('--tolerance', default=0.2, type=float,
+                        help='Fraction a case may be slower or use more memory than the baseline before it is flagged')
+
+    return parser.parse_args()
+
+
+def flat_fields(size, n_frames):
+    np.random.seed(0)
+    return measureNPS.simulate_flat_fields(n_frames, org_shape=size).astype(np.float64)
+
+
+def edge(size):
+    np.random.seed(0)
+    return measureMTF.simulate_edge(noise=True, org_shape=size)
+
+
+def case_fourier_crop(size):
+    frame = flat_fields(size, 1)[0]
+    fim = utils.ft(frame)
+    mic_freqs = utils.get_mic_freqs(frame, 1)
+
+    return 1, lambda: utils.fourier_crop(fim, mic_freqs, 1 / 4)
+
+
+def case_radial_profile(size):
+    nps, _ = measureNPS.nps_spectra(measureNPS.accumulate_nps(flat_fields(size, 2)))
+
+    return 1, lambda: measureNPS.radial_profile(nps)
+
+
+def case_esf(size):
+    im = edge(size)
+    roi = size // 4, size // 4, size // 2, size // 2
+    crop = im[roi[1]:roi[1] + roi[3], roi[0]:roi[0] + roi[2]]
+    slope, intercept, _ = measureMTF.find_edge(crop)
+
+    def run():
+        distance = measureMTF.edge_distance(slope, intercept, roi[3], roi[2])
+        distances, values = measureMTF.edge_spread(crop, distance)
+        return measureMTF.fit_esf(distances, values)
+
+    return 1, run
+
+
+def case_esf_tif(filename):
+    im = measureMTF.load_image(os.path.join(DATA, filename))
+
+    return 1, lambda: measureMTF.measure_mtf(im, 50, 50, 150, 150)
+
+
+def case_accumulate_nps(size, n_frames):
+    frames = flat_fields(size, n_frames)
+
+    return n_frames, lambda: measureNPS.nps_spectra(measureNPS.accumulate_nps(frames))
+
+
+def case_accumulate_difference(size, n_frames):
+    frames = flat_fields(size, n_frames)
+
+    return n_frames, lambda: measureNPS.accumulate_nps(frames, method='difference')
+
+
+def case_nps_spectra(size, n_frames):
+    # Only the reduction of the partial sums to the NPS and NPS(0), which is the same for any number of frames
+    acc = measureNPS.accumulate_nps(flat_fields(size, n_frames))
+
+    return 1, lambda: measureNPS.nps_spectra(acc)
+
+
+def cases(preset):
+    for size in preset['sizes']:
+        yield 'fourier_crop[%d]' % size, case_fourier_crop, (size,)
+        yield 'radial_profile[%d]' % size, case_radial_profile, (size,)
+        yield 'esf[%d]' % size, case_esf, (size,)
+
+    for filename in sorted(os.listdir(DATA)):
+        yield 'esf_tif[%s]' % filename, case_esf_tif, (filename,)
+
+    for size, n_frames in preset['stacks']:
+        yield 'accumulate_nps[%dx%d]' % (n_frames, size), case_accumulate_nps, (size, n_frames)
+        yield 'accumulate_difference[%dx%d]' % (n_frames, size), case_accumulate_difference, (size, n_frames)
+        yield 'nps_spectra[%dx%d]' % (n_frames, size), case_nps_spectra, (size, n_frames)
+
+
+def measure(setup, args, repeat):
+    n_frames, run = setup(*args)
+
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    wall = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        wall = min(wall, time.perf_counter() - start)
+
+    return {
+        'wall': wall,
+        'peak_mb': peak / 2**20,
+        'fps': n_frames / wall,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of messages for cases which are slower or use more memory than the baseline"""
+    regressions = []
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        b = baseline[name]
+        if r['wall'] > b['wall'] * (1 + tolerance):
+            regressions.append("%s: wall time %.4f s -> %.4f s" % (name, b['wall'], r['wall']))
+        if r['peak_mb'] > b['peak_mb'] * (1 + tolerance):
+            regressions.append("%s: peak memory %.1f MB -> %.1f MB" % (name, b['peak_mb'], r['peak_mb']))
+
+    return regressions
+
+
+def main():
+    config = parse_arguments()
+
+    # Quiet the prints of the measure functions
+    stdout = sys.stdout
+
+    results = {}
+    for name, setup, args in cases(PRESETS[config.preset]):
+        if config.filter is not None and config.filter not in name:
+            continue
+
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            results[name] = measure(setup, args, config.repeat)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        r = results[name]
+        print("%-36s %10.4f s %10.1f MB %10.1f frames/s" % (name, r['wall'], r['peak_mb'], r['fps']))
+
+    if config.output is not None:
+        with open(config.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'timestamp': time.time(),
+                    'python': platform.python_version(),
+                    'numpy': np.__version__,
+                    'machine': platform.machine(),
+                    'cpus': os.cpu_count(),
+                    'preset': config.preset,
+                    'repeat': config.repeat,
+                },
+                'results': results,
+            }, f, indent=2)
+
+    if config.baseline is not None:
+        with open(config.baseline) as f:
+            baseline = json.load(f)['results']
+
+        regressions = compare(results, baseline, config.tolerance)
+        for msg in regressions:
+            print("REGRESSION: %s" % msg)
+
+        if regressions:
+            return 1
+
+        print("INFO: No regressions compared to %s" % config.baseline)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Entry points from setup.py. The cold start time is measured by running '--help' in a fresh interpreter, which
+# includes all module level imports and work, but not the actual measurement.
+ENTRY_POINTS = {
+    'measureMTF': 'mtf_nps_dqe.mtf.measureMTF',
+    'measureNPS': 'mtf_nps_dqe.nps.measureNPS',
+    'calculateDQE': 'mtf_nps_dqe.dqe.calculateDQE',
+    'starMTF': 'mtf_nps_dqe.mtf.starMTF',
+    'plotMTF': 'mtf_nps_dqe.mtf.plotMTF',
+    'plotNPS': 'mtf_nps_dqe.nps.plotNPS',
+    'plotDQE': 'mtf_nps_dqe.dqe.plotDQE',
+}
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--repeat', default=5, type=int, help='Number of cold starts per entry point (minimum is reported)')
+    parser.add_argument('--output', type=str, required=False, help='Store the results as JSON')
+
+    return parser.parse_args()
+
+
+def cold_start(module, repeat):
+    env = dict(os.environ, MPLBACKEND='Agg')
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', module, '--help'], env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def main():
+    config = parse_arguments()
+
+    results = {}
+    for name, module in ENTRY_POINTS.items():
+        results[name] = cold_start(module, config.repeat)
+        print("%-14s %.3f s" % (name, results[name]))
+
+    if config.output is not None:
+        with open(config.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,10 @@
 import argparse
 import os
+import sys
 
-import matplotlib.pyplot as plt
-import matplotlib
 import numpy as np
-import pandas
 
-plt.rcParams.update({
-    "font.size": 12,
-    "font.family": 'Arial',
-    "svg.fonttype": 'none',
-    "lines.linewidth" : 3
-})
+from mtf_nps_dqe.lib import catalog, utils
 
 
 def parse_arguments():
@@ -19,6 +12,8 @@ def parse_arguments():
 
     parser.add_argument('--input', nargs='+', type=str, required=False, help='Input measured DQE curves (can be multiple)')
     parser.add_argument('--published', default=False, action='store_true', help='Also plot published DQE curves')
+    parser.add_argument('--catalog', type=str, required=False, help='Also plot measured DQE curves from this catalog (.sqlite)')
+    parser.add_argument('--select', type=str, required=False, help='Only plot catalog curves with a matching label (%% is a wildcard)')
     parser.add_argument('--output', type=str, required=False, help='Output image file (SVG) to store to')
 
     return parser.parse_args()
@@ -39,51 +34,63 @@ def load_dqe(f):
 
 
 def load_published_csv(f, column, delimiter=','):
+    import pandas
+
     path = os.path.dirname(os.path.realpath(__file__))
     d = pandas.read_csv(path + "/published/" + f, delimiter=delimiter)
 
     return d['x'], d[column]
 
 
-config = parse_arguments()
-plt.figure(figsize=(7, 7))
+def main():
+    config = parse_arguments()
 
-if config.input is not None:
-    for dqe_input_f in config.input:
-        w, dqe, label = load_dqe(dqe_input_f)
+    plt = utils.pyplot(show=config.output is None)
+    plt.rcParams.update({
+        "font.size": 12,
+        "font.family": 'Arial',
+        "svg.fonttype": 'none',
+        "lines.linewidth" : 3
+    })
 
-        plt.plot(w, dqe, label=label)
+    plt.figure(figsize=(7, 7))
 
-w_calc = np.arange(0, 1.1, 0.01)
-plt.plot(w_calc, theoretical_dqe(w_calc), '--', color='Black', label='Theoretical')
+    if config.input is not None:
+        for dqe_input_f in config.input:
+            w, dqe, label = load_dqe(dqe_input_f)
 
-if config.published:
-    w, dqe = load_published_csv('FEI-fIII.csv', "Falcon III EC", ' ')
-    plt.plot(w, dqe, label='Published Falcon III EC (300 kV)')
+            plt.plot(w, dqe, label=label)
 
-    w, dqe = load_published_csv('FEI-fIII.csv', "Falcon III", ' ')
-    plt.plot(w, dqe, label='Published Falcon III int (300 kV)')
+    if config.catalog is not None:
+        for label, w, dqe, _ in catalog.select(config.catalog, 'dqe', config.select):
+            plt.plot(w, dqe, label=label)
 
-plt.legend(loc='lower left')
-plt.xlim([0, 1.0])
-plt.ylim([0, 1.1])
-plt.xlabel("Spatial frequency (fraction of Nyquist)")
-plt.title("DQE")
-plt.grid()
-plt.gca().set_aspect('equal', adjustable='box')
+    w_calc = np.arange(0, 1.1, 0.01)
+    plt.plot(w_calc, theoretical_dqe(w_calc), '--', color='Black', label='Theoretical')
 
-if config.output is not None:
-    plt.tight_layout()
-    plt.savefig(config.output, dpi=300, bbox_inches='tight', pad_inches=0.1)
-else:
-    plt.show()
+    if config.published:
+        w, dqe = load_published_csv('FEI-fIII.csv', "Falcon III EC", ' ')
+        plt.plot(w, dqe, label='Published Falcon III EC (300 kV)')
 
+        w, dqe = load_published_csv('FEI-fIII.csv', "Falcon III", ' ')
+        plt.plot(w, dqe, label='Published Falcon III int (300 kV)')
 
-# TODO: This is not a very clean way around the fact that this script should be refactored
-def main():
-    pass
+    plt.legend(loc='lower left')
+    plt.xlim([0, 1.0])
+    plt.ylim([0, 1.1])
+    plt.xlabel("Spatial frequency (fraction of Nyquist)")
+    plt.title("DQE")
+    plt.grid()
+    plt.gca().set_aspect('equal', adjustable='box')
 
+    if config.output is not None:
+        plt.tight_layout()
+        plt.savefig(config.output, dpi=300, bbox_inches='tight', pad_inches=0.1)
+    else:
+        plt.show()
+
+    return 0
 
-if __name__ == "__main__":
-    main()
 
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,414 @@
+from collections import deque
+
+import numpy as np
+from numpy.fft import fft2, fftshift
+
+from mtf_nps_dqe.lib import utils
+
+
+def bin_factors(size):
+    # Calculate the bin factors to measure. Do this as power of 2
+    factors = 2**np.arange(1, np.log2(size), dtype=int)
+
+    # Limit the bin factors to measure not too small image sizes
+    return factors[0:-2]
+
+
+def full_spectrum(half, width):
+    """The full (unshifted) power spectrum of a real signal, from the half spectrum of the real FFT, using its symmetry
+    P(-k) = P(k)"""
+    rows = (-np.arange(half.shape[-2])) % half.shape[-2]
+    cols = np.arange(half.shape[-1], width)
+
+    full = np.empty(half.shape[:-1] + (width,), dtype=half.dtype)
+    full[..., :half.shape[-1]] = half
+    full[..., cols] = half[..., rows, :][..., width - cols]
+
+    return full
+
+
+class NPSAccumulator:
+    """Partial sums over a stack of flat fields, from which the mean subtracted NPS and the binned variance NPS(0) can
+    be calculated exactly, without first calculating the mean of the stack.
+
+    As the FFT and the Fourier binning are linear, for frames f_i with mean m (and their transforms F_i and M):
+        sum_i |F_i - M|^2 = sum_i |F_i|^2 - n |M|^2
+    and likewise the variance of the binned mean subtracted frames follows from the sums of squares of the binned
+    frames. Accumulators of disjoint frame ranges can therefore be merged, and saved to disk in between.
+
+    With a grid (rows, columns), the frames are split into tiles of shape, and the sums are kept for every tile
+    separately (along a leading tile axis). All tiles of a frame are transformed in a single FFT.
+    """
+
+    method = 'mean'
+
+    def __init__(self, shape, grid=None):
+        self.shape = tuple(int(s) for s in shape)
+        self.grid = tuple(int(g) for g in grid) if grid is not None else None
+        lead = (self.grid[0] * self.grid[1],) if self.grid is not None else ()
+
+        self.factors = bin_factors(self.shape[0])
+        self.n = 0
+        self.frame_sum = np.zeros(lead + self.shape)
+        # Sum of |F_i|^2 (not shifted)
+        self.ps_sum = np.zeros(lead + self.shape)
+        # Per bin factor: sum of the squared pixels of the binned frames, and sum of the squared mean of binned frames
+        self.binned_sq_sum = np.zeros(lead + (len(self.factors),))
+        self.binned_mean_sq_sum = np.zeros(lead + (len(self.factors),))
+        # Frame ranges (start, stop) that have been added
+        self.ranges = []
+        self.first = None
+        self._mic_freqs = None
+
+    def _bin(self, ft, factor):
+        if self._mic_freqs is None:
+            self._mic_freqs = utils.get_mic_freqs(np.empty(self.shape), 1)
+
+        # Bin the frame (or stack of tiles) using fourier cropping
+        return utils.ift(utils.fourier_crop(ft, self._mic_freqs, 1 / (factor * 2)))
+
+    def split(self, frame):
+        """Split a frame into a stack of tiles (dropping the pixels beyond the grid)"""
+        (rows, cols), (h, w) = self.grid, self.shape
+        if frame.shape[0] < rows * h or frame.shape[1] < cols * w:
+            raise ValueError("Frame shape %s is smaller than the grid of tiles %s" % (frame.shape, (rows * h, cols * w)))
+
+        return frame[:rows * h, :cols * w].reshape(rows, h, cols, w).swapaxes(1, 2).reshape(rows * cols, h, w)
+
+    def prepare(self, frame):
+        """The frame as float, split into tiles when using a grid"""
+        frame = np.asarray(frame, dtype=np.float64)
+        if self.grid is not None:
+            return self.split(frame)
+        if frame.shape != self.shape:
+            raise ValueError("Frame shape %s does not match accumulator shape %s" % (frame.shape, self.shape))
+
+        return frame
+
+    def add(self, frame, index=None):
+        """Add a frame. The index of the frame in the stack is used for bookkeeping of the added frame ranges"""
+        frame = self.prepare(frame)
+
+        if self.first is None:
+            self.first = frame.copy()
+
+        f = fft2(frame)
+        self.ps_sum += f.real ** 2 + f.imag ** 2
+        self.frame_sum += frame
+
+        # The real FFT is the left half of the full FFT
+        ft = f[..., :self.shape[1] // 2 + 1]
+        for idx, factor in enumerate(self.factors):
+            binned = self._bin(ft, factor)
+            self.binned_sq_sum[..., idx] += np.sum(binned ** 2, axis=(-2, -1))
+            self.binned_mean_sq_sum[..., idx] += np.mean(binned, axis=(-2, -1)) ** 2
+
+        self.n += 1
+        if index is not None:
+            self._add_range(index, index + 1)
+
+    def follow(self, frame, index):
+        """Continue after frame (with index), which was added to another accumulator. Only the difference method pairs
+        consecutive frames, so this does nothing here"""
+        pass
+
+    def add_frames(self, frames, start=0):
+        """Add a range of frames. Start is the index of the first frame in the stack"""
+        for idx, frame in enumerate(frames):
+            self.add(frame, start + idx)
+
+    def _add_range(self, start, stop):
+        if stop <= start:
+            return
+
+        for a, b in self.ranges:
+            if start < b and a < stop:
+                raise ValueError("Frame range %d:%d overlaps with already added range %d:%d" % (start, stop, a, b))
+
+        # Keep the ranges sorted, and join contiguous ranges
+        ranges = sorted(self.ranges + [(start, stop)])
+        self.ranges = [ranges[0]]
+        for a, b in ranges[1:]:
+            if a == self.ranges[-1][1]:
+                self.ranges[-1] = (self.ranges[-1][0], b)
+            else:
+                self.ranges.append((a, b))
+
+    def merge(self, other):
+        """Merge the partial sums of another accumulator (of a disjoint frame range) into this one"""
+        if type(other) is not type(self):
+            raise ValueError("Cannot merge accumulators of different methods (%s and %s)" %
+                             (other.method, self.method))
+        if other.shape != self.shape or other.grid != self.grid:
+            raise ValueError("Cannot merge accumulators of shape %s (grid %s) and %s (grid %s)" %
+                             (other.shape, other.grid, self.shape, self.grid))
+
+        for start, stop in other.ranges:
+            self._add_range(start, stop)
+
+        self.n += other.n
+        self.frame_sum += other.frame_sum
+        self.ps_sum += other.ps_sum
+        self.binned_sq_sum += other.binned_sq_sum
+        self.binned_mean_sq_sum += other.binned_mean_sq_sum
+        if self.first is None and other.first is not None:
+            self.first = other.first.copy()
+
+        return self
+
+    def mean(self):
+        return self.frame_sum / self.n
+
+    def mean_ft(self):
+        """Real FFT of the mean frame"""
+        return utils.ft(self.mean())
+
+    def nps(self):
+        """The 2D NPS of the mean subtracted frames (zero frequency in the center). With a grid, a stack of the NPS
+        of every tile"""
+        m = fft2(self.mean())
+        ps = self.ps_sum - self.n * (m.real ** 2 + m.imag ** 2)
+
+        # Calculate the 2D NPS by taking the average of all individual NPS, and dividing by the number of pixels
+        # Paton 2021 et al. (eq 2)
+        return fftshift(ps, axes=(-2, -1)) / self.n / (self.shape[0] * self.shape[1])
+
+    def nps0(self):
+        """NPS(0) as function of the binning factor, as rows of [factor, NPS(0)] averaged over all frames. With a grid,
+        a stack of these for every tile"""
+        ft_mean = self.mean_ft()
+
+        r = np.zeros(self.binned_sq_sum.shape + (2,))
+        for idx, factor in enumerate(self.factors):
+            binned_mean = self._bin(ft_mean, factor)
+            size = binned_mean.shape[-2] * binned_mean.shape[-1]
+
+            # Sum over frames of the variance of the binned mean subtracted frame
+            var_sum = (self.binned_sq_sum[..., idx] - self.n * np.sum(binned_mean ** 2, axis=(-2, -1))) / size \
+                - (self.binned_mean_sq_sum[..., idx] - self.n * np.mean(binned_mean, axis=(-2, -1)) ** 2)
+
+            # McMullan et al. 2009 and Paton et al. 2021
+            r[..., idx, 0] = factor
+            r[..., idx, 1] = var_sum / self.n / factor ** 2
+
+        return r
+
+    def arrays(self):
+        """The state as a dict of arrays, for saving"""
+        return {
+            'method': self.method,
+            'shape': self.shape,
+            'grid': self.grid if self.grid is not None else (),
+            'n': self.n,
+            'frame_sum': self.frame_sum,
+            'ps_sum': self.ps_sum,
+            'binned_sq_sum': self.binned_sq_sum,
+            'binned_mean_sq_sum': self.binned_mean_sq_sum,
+            'ranges': np.array(self.ranges, dtype=np.int64).reshape(-1, 2),
+            'first': self.first if self.first is not None else np.empty((0, 0)),
+        }
+
+    def restore(self, d):
+        self.n = int(d['n'])
+        self.frame_sum = d['frame_sum']
+        self.ps_sum = d['ps_sum']
+        self.binned_sq_sum = d['binned_sq_sum']
+        self.binned_mean_sq_sum = d['binned_mean_sq_sum']
+        self.ranges = [tuple(int(v) for v in r) for r in d['ranges']]
+        self.first = d['first'] if d['first'].size > 0 else None
+
+    def save(self, filename):
+        np.savez(filename, **self.arrays())
+
+    @staticmethod
+    def from_arrays(d):
+        """An accumulator (of either method) from its state, as returned by arrays()"""
+        method = str(d['method']) if 'method' in d else 'mean'
+        if method not in METHODS:
+            raise ValueError("Unknown NPS method '%s'" % method)
+
+        grid = d['grid'] if 'grid' in d and np.size(d['grid']) > 0 else None
+        acc = METHODS[method](d['shape'], grid)
+        acc.restore(d)
+
+        return acc
+
+    @staticmethod
+    def load(filename):
+        """Load a saved accumulator (of either method)"""
+        with np.load(filename) as d:
+            try:
+                return NPSAccumulator.from_arrays({k: d[k] for k in d.files})
+            except ValueError as e:
+                raise ValueError("%s in %s" % (e, filename))
+
+
+class DifferenceNPSAccumulator(NPSAccumulator):
+    """Partial sums for the NPS and binned variance NPS(0) from the differences of consecutive frames.
+
+    For frames f_i = s + n_i, with a fixed pattern s and independent noise n_i, the difference d_i = f_(i+1) - f_i
+    contains no fixed pattern and twice the noise power. The NPS is therefore the average of |D_i|^2 / 2, and NPS(0)
+    half the binned variance of d_i (Dobbins et al. 2006). No mean frame is needed, and slow drift of the signal
+    is removed as well.
+
+    Only differences of frames with consecutive indices are used. Pairs across the boundaries of merged partial
+    measurements are lost, but the last frame is saved, so resuming from a checkpoint continues the pairs.
+    """
+
+    method = 'difference'
+
+    def __init__(self, shape, grid=None):
+        super().__init__(shape, grid)
+        self.pairs = 0
+        self.previous = None
+        self.previous_index = None
+
+    def add(self, frame, index=None):
+        data = frame
+        frame = self.prepare(data)
+
+        if self.first is None:
+            self.first = frame.copy()
+        self.frame_sum += frame
+
+        # Frames added without index are taken to be consecutive
+        if self.previous is not None and (index is None or self.previous_index is None or
+                                          index == self.previous_index + 1):
+            self.add_difference(frame - self.previous)
+        # prepare() does not copy float64 frames, which can be in a buffer that is reused for the next frames
+        self.previous = frame.copy() if np.may_share_memory(frame, data) else frame
+        self.previous_index = index
+
+        self.n += 1
+        if index is not None:
+            self._add_range(index, index + 1)
+
+    def follow(self, frame, index):
+        """Pair the next added frame (if it has index + 1) with frame"""
+        self.previous = self.prepare(frame).copy()
+        self.previous_index = index
+
+    def add_difference(self, d):
+        f = fft2(d)
+        self.ps_sum += f.real ** 2 + f.imag ** 2
+
+        ft = f[..., :self.shape[1] // 2 + 1]
+        for idx, factor in enumerate(self.factors):
+            self.binned_sq_sum[..., idx] += np.var(self._bin(ft, factor), axis=(-2, -1))
+
+        self.pairs += 1
+
+    def merge(self, other):
+        super().merge(other)
+        self.pairs += other.pairs
+
+        return self
+
+    def nps(self):
+        return fftshift(self.ps_sum, axes=(-2, -1)) / (2 * self.pairs) / (self.shape[0] * self.shape[1])
+
+    def nps0(self):
+        r = np.zeros(self.binned_sq_sum.shape + (2,))
+        for idx, factor in enumerate(self.factors):
+            r[..., idx, 0] = factor
+            r[..., idx, 1] = self.binned_sq_sum[..., idx] / (2 * self.pairs) / factor ** 2
+
+        return r
+
+    def arrays(self):
+        d = super().arrays()
+        d['pairs'] = self.pairs
+        d['previous'] = self.previous if self.previous is not None else np.empty((0, 0))
+        d['previous_index'] = self.previous_index if self.previous_index is not None else -1
+
+        return d
+
+    def restore(self, d):
+        super().restore(d)
+        self.pairs = int(d['pairs'])
+        self.previous = d['previous'] if d['previous'].size > 0 else None
+        self.previous_index = int(d['previous_index']) if int(d['previous_index']) >= 0 else None
+
+
+class SlidingNPSAccumulator(NPSAccumulator):
+    """Partial sums over a window of the last window frames, for following the NPS and NPS(0) over a stack. Frames
+    entering the window are added, and the frames leaving it are subtracted again.
+
+    The real FFT and binned sums of every frame in the window are kept, so every frame is transformed only once. The
+    mean frame follows from the sum of the transforms, and the power spectrum is summed over the half spectrum only.
+    Every window frames, the sums are recalculated from the kept transforms, so rounding errors do not build up.
+    """
+
+    def __init__(self, shape, window):
+        super().__init__(shape)
+        self.window = int(window)
+        self.frame_sum = None
+        self.ft_sum = np.zeros((self.shape[0], self.shape[1] // 2 + 1), dtype=np.complex128)
+        self.ps_sum = np.zeros(self.ft_sum.shape)
+        self.frames = deque()
+        self.added = 0
+
+    def add(self, frame, index=None):
+        frame = self.prepare(frame)
+
+        if self.first is None:
+            self.first = frame.copy()
+
+        ft = utils.ft(frame)
+        binned = np.zeros((len(self.factors), 2))
+        for idx, factor in enumerate(self.factors):
+            b = self._bin(ft, factor)
+            binned[idx] = np.sum(b ** 2), np.mean(b) ** 2
+
+        self.frames.append((ft, binned))
+        self._apply(ft, binned, 1)
+        if len(self.frames) > self.window:
+            self._apply(*self.frames.popleft(), -1)
+
+        self.added += 1
+        if self.added % self.window == 0:
+            self._resum()
+
+    def _apply(self, ft, binned, sign):
+        self.ft_sum += sign * ft
+        self.ps_sum += sign * (ft.real ** 2 + ft.imag ** 2)
+        self.binned_sq_sum += sign * binned[:, 0]
+        self.binned_mean_sq_sum += sign * binned[:, 1]
+        self.n += sign
+
+    def _resum(self):
+        self.ft_sum = sum(ft for ft, _ in self.frames)
+        self.ps_sum = sum(ft.real ** 2 + ft.imag ** 2 for ft, _ in self.frames)
+        self.binned_sq_sum = sum(binned[:, 0] for _, binned in self.frames)
+        self.binned_mean_sq_sum = sum(binned[:, 1] for _, binned in self.frames)
+        self.n = len(self.frames)
+
+    def full(self):
+        return self.n == self.window
+
+    def mean_ft(self):
+        return self.ft_sum / self.n
+
+    def mean(self):
+        from scipy.fft import irfft2
+
+        return irfft2(self.mean_ft(), s=self.shape)
+
+    def signal(self):
+        """Mean signal (per pixel) of the window, from the zero frequency of the mean transform"""
+        return self.ft_sum[0, 0].real / self.n / (self.shape[0] * self.shape[1])
+
+    def nps(self):
+        m = self.mean_ft()
+        ps = self.ps_sum - self.n * (m.real ** 2 + m.imag ** 2)
+
+        return fftshift(full_spectrum(ps, self.shape[1])) / self.n / (self.shape[0] * self.shape[1])
+
+    def merge(self, other):
+        raise ValueError("Sliding window accumulators cannot be merged")
+
+
+METHODS = {
+    'mean': NPSAccumulator,
+    'difference': DifferenceNPSAccumulator,
+}
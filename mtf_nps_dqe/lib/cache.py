@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+# Content-addressed on-disk cache for measurement intermediates (such as the 2D NPS and the binned ESF).
+# Entries are keyed on the identity of the input file (path, size and modification time), the stage and the
+# parameters that change the intermediate. Every entry is a single .npz file. The cache is bounded in size, and the
+# least recently used entries are evicted first.
+
+ENV = 'MTF_NPS_DQE_CACHE'
+DEFAULT_DIR = os.environ.get(ENV, os.path.join(os.path.expanduser('~'), '.cache', 'mtf-nps-dqe'))
+DEFAULT_SIZE = 2048
+
+
+def file_identity(filename):
+    st = os.stat(filename)
+    return [os.path.realpath(filename), st.st_size, st.st_mtime_ns]
+
+
+def key(stage, filename, **params):
+    """Cache key for the intermediate of a stage, computed from the input file and parameters"""
+    d = {'stage': stage, 'file': file_identity(filename), 'params': params}
+
+    return hashlib.sha256(json.dumps(d, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load(cache_dir, k):
+    """Returns a dict of arrays, or None when not in the cache"""
+    path = os.path.join(cache_dir, k + '.npz')
+    try:
+        with np.load(path) as d:
+            data = {name: d[name] for name in d.files}
+    except (OSError, ValueError):
+        return None
+
+    # Mark as recently used
+    os.utime(path)
+
+    return data
+
+
+def store(cache_dir, k, max_mb=DEFAULT_SIZE, **arrays):
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Write to a temporary file first, so concurrent readers never see a partial entry
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, os.path.join(cache_dir, k + '.npz'))
+
+    evict(cache_dir, max_mb)
+
+
+def evict(cache_dir, max_mb):
+    """Remove the least recently used entries until the cache is smaller than max_mb"""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.npz'):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+
+    total = sum(e[1] for e in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_mb * 2**20:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
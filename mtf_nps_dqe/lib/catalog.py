@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from mtf_nps_dqe.lib import cache
+
+# A single SQLite file that stores all measured curves (MTF, NPS and DQE), together with the metadata that
+# was previously only stored in the filename. Arrays are stored as raw float64 blobs, so loading them is a
+# zero-copy np.frombuffer. The metadata (JSON) only holds scalars and short lists; further arrays of a curve (such
+# as directional NPS curves or maps) are stored as blobs in a separate table, and only loaded on request.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS curves (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    label TEXT NOT NULL,
+    source TEXT,
+    source_hash TEXT,
+    created REAL NOT NULL,
+    metadata TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    w BLOB NOT NULL,
+    value BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS curves_kind_label ON curves (kind, label);
+CREATE INDEX IF NOT EXISTS curves_source_hash ON curves (source_hash);
+CREATE INDEX IF NOT EXISTS curves_created ON curves (created);
+CREATE TABLE IF NOT EXISTS arrays (
+    curve_id INTEGER NOT NULL REFERENCES curves (id),
+    name TEXT NOT NULL,
+    shape TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (curve_id, name)
+);
+"""
+
+KINDS = ('mtf', 'nps', 'dqe')
+
+# Hashes of the files hashed in this run, by their identity (see cache.file_identity)
+_hashes = {}
+
+
+def connect(path):
+    con = sqlite3.connect(path)
+    con.executescript(SCHEMA)
+    return con
+
+
+def file_hash(filename, block_size=1 << 20):
+    """SHA-256 of a file, read in blocks. A file is only hashed once per run (for its path, size and modification
+    time), so storing many curves of the same (large) input does not read it again for every curve"""
+    identity = tuple(cache.file_identity(filename))
+    if identity not in _hashes:
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                h.update(block)
+        _hashes[identity] = h.hexdigest()
+
+    return _hashes[identity]
+
+
+def _to_builtin(v):
+    if isinstance(v, np.generic):
+        return v.item()
+    if isinstance(v, np.ndarray):
+        return v.tolist()
+    return v
+
+
+def store_curve(path, kind, w, value, label, source=None, arrays=None, **metadata):
+    """Store a curve in the catalog. Extra keyword arguments are stored as JSON metadata, arrays (a dict of name ->
+    array) as blobs with the curve. Returns the id."""
+    if kind not in KINDS:
+        raise ValueError("Unknown curve kind '%s'" % kind)
+
+    w = np.ascontiguousarray(w, dtype=np.float64)
+    value = np.ascontiguousarray(value, dtype=np.float64)
+    if w.shape != value.shape:
+        raise ValueError("Frequency and value arrays differ in shape")
+
+    source_hash = None
+    if source is not None and os.path.isfile(source):
+        source_hash = file_hash(source)
+
+    meta = json.dumps({k: _to_builtin(v) for k, v in metadata.items()})
+
+    with connect(path) as con:
+        cur = con.execute(
+            "INSERT INTO curves (kind, label, source, source_hash, created, metadata, n, w, value) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (kind, label, source, source_hash, time.time(), meta, len(w), w.tobytes(), value.tobytes())
+        )
+        curve_id = cur.lastrowid
+
+        for name, data in (arrays or {}).items():
+            data = np.ascontiguousarray(data, dtype=np.float64)
+            con.execute("INSERT INTO arrays (curve_id, name, shape, data) VALUES (?, ?, ?, ?)",
+                        (curve_id, name, json.dumps(list(data.shape)), data.tobytes()))
+    con.close()
+
+    return curve_id
+
+
+def query(path, kind=None, label=None, source_hash=None, since=None):
+    """Find curves in the catalog, without loading the arrays. The label may contain SQL LIKE wildcards (%).
+
+    Returns a list of dicts with the id, kind, label, source, source_hash, created and metadata"""
+    where = []
+    args = []
+    if kind is not None:
+        where.append("kind = ?")
+        args.append(kind)
+    if label is not None:
+        where.append("label LIKE ?")
+        args.append(label)
+    if source_hash is not None:
+        where.append("source_hash = ?")
+        args.append(source_hash)
+    if since is not None:
+        where.append("created >= ?")
+        args.append(since)
+
+    sql = "SELECT id, kind, label, source, source_hash, created, metadata FROM curves"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id"
+
+    con = connect(path)
+    rows = con.execute(sql, args).fetchall()
+    con.close()
+
+    return [{
+        'id': r[0],
+        'kind': r[1],
+        'label': r[2],
+        'source': r[3],
+        'source_hash': r[4],
+        'created': r[5],
+        'metadata': json.loads(r[6]),
+    } for r in rows]
+
+
+def load_curves(path, ids):
+    """Bulk load the arrays of many curves in one query. Returns a dict of id -> (w, value).
+
+    The arrays are read-only views on the blobs returned by SQLite"""
+    ids = [int(i) for i in ids]
+    if not ids:
+        return {}
+
+    con = connect(path)
+    curves = {}
+    # SQLite limits the number of host parameters, so query in batches
+    for start in range(0, len(ids), 500):
+        batch = ids[start:start + 500]
+        rows = con.execute(
+            "SELECT id, w, value FROM curves WHERE id IN (%s)" % ",".join("?" * len(batch)), batch
+        ).fetchall()
+        for curve_id, w, value in rows:
+            curves[curve_id] = (np.frombuffer(w, dtype=np.float64), np.frombuffer(value, dtype=np.float64))
+    con.close()
+
+    missing = set(ids) - set(curves)
+    if missing:
+        raise KeyError("Curves not in catalog: %s" % sorted(missing))
+
+    return curves
+
+
+def load_arrays(path, curve_id, names=None):
+    """Load the arrays stored with a curve (optionally only those in names). Returns a dict of name -> array"""
+    con = connect(path)
+    rows = con.execute("SELECT name, shape, data FROM arrays WHERE curve_id = ? ORDER BY name", (int(curve_id),)).fetchall()
+    con.close()
+
+    return {name: np.frombuffer(data, dtype=np.float64).reshape(json.loads(shape))
+            for name, shape, data in rows if names is None or name in names}
+
+
+def select(path, kind, label=None):
+    """Query and load the curves of one kind, matching an optional label pattern.
+    Returns a list of (label, w, value, metadata)"""
+    rows = query(path, kind=kind, label=label)
+    curves = load_curves(path, [r['id'] for r in rows])
+
+    return [(r['label'],) + curves[r['id']] + (r['metadata'],) for r in rows]
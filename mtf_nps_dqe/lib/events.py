@@ -0,0 +1,160 @@
+import contextlib
+import os
+
+import numpy as np
+
+from mtf_nps_dqe.lib import profiling
+
+# Reading event lists of counting detectors (such as Timepix), with for every event a pixel position (x, y), a time
+# (t) and optionally a time over threshold (tot). Dense frames and summed images are built from the events with a
+# single bincount, so the data never needs to be stored as a dense stack.
+#
+# Supported layouts:
+#   .npy            structured array with fields x, y, t (and tot)
+#   .npz            structured array 'events', or arrays x, y, t (and tot). Optional 'shape' (rows, columns)
+#   .h5 / .hdf5     compound dataset 'events', or a group 'events' with datasets x, y, t (and tot). Optional
+#                   attribute 'shape' on the dataset or group. Requires h5py.
+#
+# Positions may be floats (sub-pixel centroids of clusters), which allows rendering at super resolution. The events
+# should be sorted on time.
+
+EXTENSIONS = ('.npy', '.npz', '.h5', '.hdf5')
+
+
+def is_event_file(filename):
+    return os.path.splitext(filename)[1].lower() in EXTENSIONS
+
+
+@contextlib.contextmanager
+def open_events(filename):
+    """Open an event file. Yields a dict of column name -> (lazily read) array, and the shape of the detector, which
+    is None when not stored in the file"""
+    ext = os.path.splitext(filename)[1].lower()
+
+    if ext == '.npy':
+        events = np.load(filename, mmap_mode='r')
+        yield {name: events[name] for name in events.dtype.names}, None
+    elif ext == '.npz':
+        with np.load(filename) as f:
+            shape = tuple(f['shape']) if 'shape' in f.files else None
+            if 'events' in f.files:
+                events = f['events']
+                yield {name: events[name] for name in events.dtype.names}, shape
+            else:
+                yield {name: f[name] for name in ('x', 'y', 't', 'tot') if name in f.files}, shape
+    elif ext in ('.h5', '.hdf5'):
+        try:
+            import h5py
+        except ImportError:
+            raise ValueError('Reading HDF5 event files requires h5py')
+
+        with h5py.File(filename, 'r') as f:
+            events = f['events']
+            shape = tuple(events.attrs['shape']) if 'shape' in events.attrs else None
+            if isinstance(events, h5py.Group):
+                yield {name: events[name] for name in ('x', 'y', 't', 'tot') if name in events}, shape
+            else:
+                yield {name: events.fields(name) for name in events.dtype.names}, shape
+    else:
+        raise ValueError('Unsupported event file extension (only %s)' % ", ".join(EXTENSIONS))
+
+
+def detector_shape(columns, shape=None, super_res=1):
+    if shape is None:
+        shape = (int(np.max(columns['y'][:])) + 1, int(np.max(columns['x'][:])) + 1)
+
+    return shape[0] * super_res, shape[1] * super_res
+
+
+def pixel_index(x, y, shape, super_res=1):
+    """Flat pixel index of events (x is the column, y the row) on the (super resolution) grid"""
+    if super_res > 1:
+        col = np.floor(np.asarray(x, dtype=np.float64) * super_res).astype(np.int64)
+        row = np.floor(np.asarray(y, dtype=np.float64) * super_res).astype(np.int64)
+    else:
+        col = np.asarray(x).astype(np.int64)
+        row = np.asarray(y).astype(np.int64)
+
+    inside = (row >= 0) & (row < shape[0]) & (col >= 0) & (col < shape[1])
+
+    return row * shape[1] + col, inside
+
+
+def read_columns(columns, weight, lo=None, hi=None):
+    """Read the x, y and (depending on the weight) tot columns of the events lo:hi"""
+    if weight not in ('counts', 'tot'):
+        raise ValueError("Unknown event weight '%s'" % weight)
+    if weight == 'tot' and 'tot' not in columns:
+        raise ValueError('Event file has no tot column')
+
+    x = np.asarray(columns['x'][lo:hi])
+    y = np.asarray(columns['y'][lo:hi])
+    weights = np.asarray(columns['tot'][lo:hi], dtype=np.float64) if weight == 'tot' else None
+    profiling.add_bytes_read(x.nbytes + y.nbytes + (0 if weights is None else weights.nbytes))
+
+    return x, y, weights
+
+
+def frame_count(t, frame_time):
+    """Number of complete frames of frame_time, counting from the first event"""
+    if len(t) == 0:
+        return 0
+
+    return int((t[-1] - t[0]) // frame_time)
+
+
+@contextlib.contextmanager
+def open_frames(filename, frame_time, super_res=1, weight='counts', shape=None):
+    """Open an event file for building dense frames of frame_time each (in units of t). The file is opened, the times
+    read and the frame boundaries found only once. Yields a function read(start, stop), that builds the frames
+    start:stop, and the number of frames"""
+    with open_events(filename) as (columns, stored_shape):
+        shape = detector_shape(columns, shape or stored_shape, super_res)
+
+        t = np.asarray(columns['t'][:])
+        profiling.add_bytes_read(t.nbytes)
+        n_frames = frame_count(t, frame_time)
+        t0 = t[0] if len(t) > 0 else 0
+
+        # Index of the first event of every frame (and the end of the last frame), with one binary search on the frame
+        # of every event. The frames are found by floor division (as in frame_count and read), as multiples of a
+        # frame_time that is not exactly representable can put an event on a boundary in a different frame
+        bounds = np.searchsorted((t - t0) // frame_time, np.arange(n_frames + 1))
+
+        def read(start, stop):
+            stop = n_frames if stop is None else min(stop, n_frames)
+            if stop <= start:
+                return np.zeros((0,) + shape, dtype=np.float32)
+
+            lo, hi = bounds[start], bounds[stop]
+            x, y, weights = read_columns(columns, weight, lo, hi)
+            pix, inside = pixel_index(x, y, shape, super_res)
+            frame = ((t[lo:hi] - t0) // frame_time).astype(np.int64) - start
+
+            n_pix = shape[0] * shape[1]
+            index = frame[inside] * n_pix + pix[inside]
+            frames = np.bincount(index, weights=None if weights is None else weights[inside],
+                                 minlength=(stop - start) * n_pix)
+
+            return frames.reshape((stop - start,) + shape).astype(np.float32)
+
+        yield read, n_frames
+
+
+def load_frames(filename, frame_time, start=0, stop=None, super_res=1, weight='counts', shape=None):
+    """Build the dense frames start:stop, of frame_time each (in units of t), from an event file"""
+    with open_frames(filename, frame_time, super_res, weight, shape) as (read, n_frames):
+        return read(start, stop)
+
+
+def load_image(filename, super_res=1, weight='counts', shape=None):
+    """Sum all events of an event file into a single image"""
+    with open_events(filename) as (columns, stored_shape):
+        shape = detector_shape(columns, shape or stored_shape, super_res)
+
+        x, y, weights = read_columns(columns, weight)
+        pix, inside = pixel_index(x, y, shape, super_res)
+        im = np.bincount(pix[inside], weights=None if weights is None else weights[inside],
+                         minlength=shape[0] * shape[1])
+
+    return im.reshape(shape).astype(np.float64)
@@ -0,0 +1,170 @@
+import multiprocessing
+import queue
+import time
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from mtf_nps_dqe.lib import profiling
+from mtf_nps_dqe.lib.accumulator import NPSAccumulator
+
+# Accumulation of the NPS partial sums over a single stack on multiple processes. The main process reads the chunks
+# of frames into a ring of shared memory buffers, and sends only the index of the buffer and the frame range to the
+# workers. Every worker keeps its own accumulator(s), adding the chunks it gets, and sends the partial sums back once,
+# at the end. These are merged in the main process (see NPSAccumulator.merge).
+#
+# Every buffer starts with the last frame of the previous chunk, so the difference method also pairs the frames
+# across the boundaries of the chunks.
+
+
+def _worker(names, shape, dtype, factories, tasks, done):
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    buffers = [np.ndarray(shape, dtype=dtype, buffer=block.buf) for block in blocks]
+    accs = None
+
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+
+            slot, start, n, overlap = task
+            if accs is None:
+                accs = [factory(shape[1:]) for factory in factories]
+
+            for acc in accs:
+                if overlap:
+                    acc.follow(buffers[slot][0], start - 1)
+                acc.add_frames(buffers[slot][overlap:overlap + n], start)
+            done.put(('free', slot))
+
+        done.put(('result', [acc.arrays() for acc in accs] if accs is not None else None))
+    except Exception:
+        done.put(('error', traceback.format_exc()))
+    finally:
+        del buffers
+        for block in blocks:
+            block.close()
+
+
+def _receive(done, processes):
+    """Next message of the workers. Raises when a worker failed or died"""
+    while True:
+        try:
+            kind, value = done.get(timeout=1)
+        except queue.Empty:
+            if any(p.exitcode not in (None, 0) for p in processes):
+                raise RuntimeError("A worker process died")
+            continue
+
+        if kind == 'error':
+            raise RuntimeError("Error in worker process:\n%s" % value)
+
+        return kind, value
+
+
+def accumulate(read, factories, start=0, stop=None, workers=2, chunk=16, depth=2):
+    """Add the frames start:stop, read with read(start, stop), to new accumulators made by factory(frame_shape) for
+    every factory, on workers processes. Up to depth chunks of chunk frames are read ahead. Returns the merged
+    accumulators (in the order of the factories), or None when there are no frames"""
+    chunk = max(chunk, 1)
+    t = time.perf_counter()
+
+    def next_range(index):
+        return index, index + chunk if stop is None else min(index + chunk, stop)
+
+    index, end = next_range(start)
+    if stop is not None and end <= index:
+        return None
+    with profiling.stage('read'):
+        data = read(index, end)
+    if len(data) == 0:
+        return None
+
+    # One buffer per worker, and depth buffers to read ahead into
+    shape = (chunk + 1,) + tuple(data.shape[1:])
+    dtype = np.dtype(data.dtype)
+    size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    blocks = [shared_memory.SharedMemory(create=True, size=size) for _ in range(workers + depth)]
+    buffers = [np.ndarray(shape, dtype=dtype, buffer=block.buf) for block in blocks]
+
+    ctx = multiprocessing.get_context()
+    tasks = ctx.Queue()
+    done = ctx.Queue()
+    processes = [ctx.Process(target=_worker, name='NPSWorker-%d' % i, daemon=True,
+                             args=([b.name for b in blocks], shape, dtype.str, factories, tasks, done))
+                 for i in range(workers)]
+
+    n_frames = 0
+    results = []
+    try:
+        for p in processes:
+            p.start()
+
+        free = list(range(len(buffers)))
+        last = None
+        while True:
+            if not free:
+                kind, slot = _receive(done, processes)
+                free.append(slot)
+            slot = free.pop()
+
+            # The frames are only really read here, when a (memory mapped) stack is copied into the buffer
+            with profiling.stage('read'):
+                n = len(data)
+                overlap = 0 if last is None else 1
+                if overlap:
+                    buffers[slot][0] = last
+                np.copyto(buffers[slot][overlap:overlap + n], data)
+                profiling.add_bytes_read(buffers[slot][overlap:overlap + n].nbytes)
+                last = buffers[slot][overlap + n - 1].copy()
+
+            tasks.put((slot, index, n, overlap))
+            n_frames += n
+
+            # A short chunk is the end of the stack
+            if n < end - index:
+                break
+            index, end = next_range(index + n)
+            if stop is not None and end <= index:
+                break
+            with profiling.stage('read'):
+                data = read(index, end)
+            if len(data) == 0:
+                break
+
+        for _ in processes:
+            tasks.put(None)
+
+        with profiling.stage('wait'):
+            while len(results) < len(processes):
+                kind, value = _receive(done, processes)
+                if kind == 'result':
+                    results.append(value)
+
+        for p in processes:
+            p.join()
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+        del buffers, data
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    # Merge in the order of the frames, so the first frame of the merged accumulator is the first frame of the range
+    accs = []
+    for idx in range(len(factories)):
+        partials = [NPSAccumulator.from_arrays(r[idx]) for r in results if r is not None]
+        partials = sorted((acc for acc in partials if acc.n > 0), key=lambda acc: acc.ranges[0] if acc.ranges else ())
+        for acc in partials[1:]:
+            partials[0].merge(acc)
+        accs.append(partials[0])
+
+    elapsed = time.perf_counter() - t
+    print("INFO: Accumulated %d frames on %d processes in %.2f s (%.1f frames/s)" % (
+        n_frames, workers, elapsed, n_frames / elapsed))
+
+    return accs
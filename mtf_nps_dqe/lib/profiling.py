@@ -0,0 +1,138 @@
+import contextlib
+import csv
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Per stage timing and memory instrumentation. Disabled by default, in which case stage() returns a shared no-op
+# context manager. Enable with the MTF_NPS_DQE_PROFILE environment variable (or the --profile option of the tools)
+# set to the report file. The report is JSON, or CSV when the file name ends with .csv
+
+ENV = 'MTF_NPS_DQE_PROFILE'
+
+_NULL = contextlib.nullcontext()
+
+_report = None
+_stack = []
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+        self.bytes_read = 0
+        self.peak = 0
+
+    def __enter__(self):
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        _stack.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        _stack.pop()
+
+        peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+        # Nested stages: the parent includes the peak and bytes read of the child
+        if _stack:
+            _stack[-1].peak = max(_stack[-1].peak, peak)
+            _stack[-1].bytes_read += self.bytes_read
+
+        _report['stages'].append({
+            'stage': self.name,
+            'depth': len(_stack),
+            'wall': wall,
+            'cpu': cpu,
+            'peak_traced_mb': peak / 2**20,
+            'max_rss_mb': max_rss_mb(),
+            'bytes_read': self.bytes_read,
+        })
+
+        return False
+
+
+def max_rss_mb():
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == 'darwin':
+        return rss / 2**20
+    return rss / 2**10
+
+
+def enable(path=None):
+    """Enable the instrumentation. Without path, the MTF_NPS_DQE_PROFILE environment variable is used.
+    Returns whether the instrumentation is enabled"""
+    global _report
+
+    path = path or os.environ.get(ENV)
+    if not path:
+        return False
+
+    _report = {
+        'path': path,
+        'tool': os.path.basename(sys.argv[0]),
+        'argv': sys.argv[1:],
+        'started': time.time(),
+        'stages': [],
+    }
+    tracemalloc.start()
+
+    return True
+
+
+def enabled():
+    return _report is not None
+
+
+def stage(name):
+    """Context manager that records the wall time, CPU time and memory of a named stage, when enabled"""
+    if _report is None:
+        return _NULL
+
+    return _Stage(name)
+
+
+def add_bytes_read(n):
+    """Count bytes read towards the current stage. Only counted on the main thread, which runs the stages"""
+    if _stack and threading.current_thread() is threading.main_thread():
+        _stack[-1].bytes_read += int(n)
+
+
+def write():
+    """Write the report, when enabled"""
+    if _report is None:
+        return
+
+    tracemalloc.stop()
+    path = _report['path']
+
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['stage', 'depth', 'wall', 'cpu', 'peak_traced_mb', 'max_rss_mb',
+                                                   'bytes_read'])
+            writer.writeheader()
+            writer.writerows(_report['stages'])
+    else:
+        report = dict(_report, total=time.time() - _report['started'])
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    print("INFO: Written profile to %s" % path)
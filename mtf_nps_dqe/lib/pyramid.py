@@ -0,0 +1,154 @@
+import math
+import threading
+
+import numpy as np
+
+# Image pyramid for drawing (very) large images. Level k is the block mean of the image over 2^k x 2^k pixels, so
+# pixel (i, j) of level k covers the pixels [i 2^k, (i+1) 2^k) x [j 2^k, (j+1) 2^k) of the full image (pixels beyond the
+# last whole block are dropped). The levels are made when first needed, from the level below, and kept.
+#
+# A PyramidView draws the coarsest level that still shows all detail the axes can display. When zoomed in, only the
+# tiles of the finer level within the view are drawn. The images are drawn in the pixel coordinates of the full
+# image, so positions on the axes (such as a selected rectangle) are full resolution pixel coordinates.
+
+# Size (in pixels of a level) of the tiles in which the finer levels are drawn
+TILE = 256
+
+
+class Pyramid:
+    """Downsampled levels of an image, made on demand"""
+
+    def __init__(self, im):
+        self.levels = [np.asarray(im)]
+        self._lock = threading.Lock()
+
+    @property
+    def shape(self):
+        return self.levels[0].shape
+
+    def level(self, k):
+        """Level k, the block mean over 2^k x 2^k pixels"""
+        with self._lock:
+            while len(self.levels) <= k:
+                prev = self.levels[-1]
+                h, w = prev.shape[0] // 2, prev.shape[1] // 2
+                if h == 0 or w == 0:
+                    raise ValueError("Image of shape %s has no level %d" % (self.shape, k))
+                self.levels.append(prev[:2 * h, :2 * w].reshape(h, 2, w, 2).mean(axis=(1, 3), dtype=np.float32))
+
+        return self.levels[k]
+
+    def n_levels(self):
+        return int(math.floor(math.log2(max(min(self.shape[:2]), 1)))) + 1
+
+    def fit(self, max_size):
+        """The finest level with no side longer than max_size. Returns the level and its block size"""
+        k = 0
+        while k + 1 < self.n_levels() and max(self.shape[:2]) / 2**k > max_size:
+            k += 1
+
+        return self.level(k), 2**k
+
+    def extent(self, k, rows, cols, origin='upper'):
+        """Extent (for imshow) of the rows and columns (start, stop) of level k, in full image pixel coordinates"""
+        f = 2**k
+        left, right = cols[0] * f - 0.5, cols[1] * f - 0.5
+        bottom, top = rows[1] * f - 0.5, rows[0] * f - 0.5
+        if origin == 'lower':
+            bottom, top = top, bottom
+
+        return left, right, bottom, top
+
+
+def roi_from_corners(x0, y0, x1, y1, shape):
+    """The ROI (x, y, width, height) of a rectangle between the corners (x0, y0) and (x1, y1), in full image pixel
+    coordinates, clipped to an image of shape"""
+    xs = np.clip(np.floor(np.sort([x0, x1]) + 0.5).astype(int), 0, shape[1])
+    ys = np.clip(np.floor(np.sort([y0, y1]) + 0.5).astype(int), 0, shape[0])
+
+    return int(xs[0]), int(ys[0]), int(xs[1] - xs[0]), int(ys[1] - ys[0])
+
+
+class PyramidView:
+    """Draw a pyramid on axes. The overview is the level that fits max_size (default the size of the axes on screen).
+    When zooming in, the finer levels are drawn for the visible tiles only. The colour scale is that of the overview"""
+
+    def __init__(self, ax, pyramid, origin='upper', max_size=None, tile=TILE, **kwargs):
+        self.ax = ax
+        self.pyramid = pyramid
+        self.origin = origin
+        self.tile = tile
+
+        overview, factor = pyramid.fit(max_size or self._axes_size())
+        self.overview = int(math.log2(factor))
+        self.shown = (self.overview, (0, overview.shape[0]), (0, overview.shape[1]))
+        self._updating = False
+
+        kwargs.setdefault('vmin', np.min(overview))
+        kwargs.setdefault('vmax', np.max(overview))
+        self.image = ax.imshow(overview, origin=origin, extent=pyramid.extent(self.overview, *self.shown[1:], origin),
+                               **kwargs)
+
+        # Matplotlib only keeps weak references to bound methods, the lambdas keep the view alive with the axes
+        ax.callbacks.connect('xlim_changed', lambda a: self._update(a))
+        ax.callbacks.connect('ylim_changed', lambda a: self._update(a))
+        ax.figure.canvas.mpl_connect('resize_event', lambda event: self._update(ax))
+
+    def _box(self):
+        """Width and height (screen pixels) of the space of the axes. With an equal aspect, matplotlib shrinks the axes
+        within this space to the aspect of the view"""
+        box = self.ax.get_position(original=True)
+        fig = self.ax.figure.bbox
+
+        return max(box.width * fig.width, 1), max(box.height * fig.height, 1)
+
+    def _axes_size(self):
+        return max(self._box())
+
+    def _visible(self, k):
+        """Rows and columns of level k within the view, extended to whole tiles"""
+        level = self.pyramid.level(k)
+        f = 2**k
+        (x0, x1), (y0, y1) = sorted(self.ax.get_xlim()), sorted(self.ax.get_ylim())
+
+        def span(lo, hi, size):
+            start = max(int(math.floor((lo + 0.5) / f / self.tile)) * self.tile, 0)
+            stop = min(int(math.ceil((hi + 0.5) / f / self.tile)) * self.tile, size)
+            return start, max(stop, start)
+
+        return span(y0, y1, level.shape[0]), span(x0, x1, level.shape[1])
+
+    def _update(self, ax):
+        if self._updating:
+            return
+
+        (x0, x1), (y0, y1) = sorted(ax.get_xlim()), sorted(ax.get_ylim())
+
+        # Full image pixels per screen pixel: the level with blocks of (at most) that size shows all detail
+        width, height = self._box()
+        scale = max((x1 - x0) / width, (y1 - y0) / height)
+        k = min(self.overview, max(int(math.floor(math.log2(max(scale, 1)))), 0))
+
+        if k == self.overview:
+            level = self.pyramid.level(k)
+            shown = (k, (0, level.shape[0]), (0, level.shape[1]))
+        else:
+            shown = (k,) + self._visible(k)
+        if shown == self.shown or shown[1][0] == shown[1][1] or shown[2][0] == shown[2][1]:
+            return
+
+        (r0, r1), (c0, c1) = shown[1:]
+        self.image.set_data(self.pyramid.level(k)[r0:r1, c0:c1])
+
+        # Setting the extent can rescale the axes, keep the view
+        self._updating = True
+        try:
+            xlim, ylim = ax.get_xlim(), ax.get_ylim()
+            self.image.set_extent(self.pyramid.extent(k, shown[1], shown[2], self.origin))
+            ax.set_xlim(xlim, emit=False)
+            ax.set_ylim(ylim, emit=False)
+        finally:
+            self._updating = False
+
+        self.shown = shown
+        ax.figure.canvas.draw_idle()
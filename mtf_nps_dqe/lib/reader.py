@@ -0,0 +1,154 @@
+import queue
+import threading
+import time
+
+import numpy as np
+
+from mtf_nps_dqe.lib import profiling
+
+# Pipelined reading of frame stacks. A background thread reads the next chunks of frames, while the current chunk is
+# processed, so the disk (or network) and the CPU are busy at the same time. The chunks are read into a small ring
+# of buffers, which are allocated once (on the first chunk) and then reused.
+#
+# The frames are read with a function read(start, stop), which returns the frames start:stop (or fewer at the end of
+# the stack). This can be a (lazy) memory mapped slice, the frames are only really read when copied into a buffer.
+
+
+class FrameReader:
+    """Iterate over the chunks (start, frames) of a stack. With depth > 0, up to depth chunks are read ahead on a
+    background thread. With depth 0, the chunks are read when requested.
+
+    The frames of a chunk are only valid until the next chunk is requested, after which their buffer is reused."""
+
+    def __init__(self, read, start=0, stop=None, chunk=16, depth=2):
+        self.read = read
+        self.start = start
+        self.stop = stop
+        self.chunk = max(chunk, 1)
+        self.depth = max(depth, 0)
+
+        # Statistics: frames and bytes read, time spent reading (on any thread) and waiting for the reader
+        self.frames = 0
+        self.bytes = 0
+        self.read_time = 0.0
+        self.wait_time = 0.0
+        self.elapsed = 0.0
+
+        self._buffers = None
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _ranges(self):
+        start = self.start
+        while self.stop is None or start < self.stop:
+            stop = start + self.chunk if self.stop is None else min(start + self.chunk, self.stop)
+            yield start, stop
+            start = stop
+
+    def _read_into(self, start, stop, buffer=None):
+        t = time.perf_counter()
+        data = self.read(start, stop)
+        n = len(data)
+
+        if n > 0:
+            if buffer is None:
+                # First chunk: the frame shape and type are known now
+                shape = (self.chunk,) + tuple(data.shape[1:])
+                self._buffers = [np.empty(shape, dtype=data.dtype) for _ in range(self.depth + 1)]
+                for idx in range(1, len(self._buffers)):
+                    self._free.put(idx)
+                buffer = 0
+            np.copyto(self._buffers[buffer][:n], data)
+        self.read_time += time.perf_counter() - t
+
+        return buffer, n
+
+    def _run(self):
+        try:
+            buffer = None
+            for start, stop in self._ranges():
+                if self._buffers is not None:
+                    buffer = self._free.get()
+                if self._stopping.is_set():
+                    break
+
+                buffer, n = self._read_into(start, stop, buffer)
+                if n == 0:
+                    break
+
+                self._filled.put((start, buffer, n))
+                if n < stop - start:
+                    break
+        except Exception as e:
+            self._filled.put(e)
+            return
+
+        self._filled.put(None)
+
+    def _next_sync(self, ranges):
+        for start, stop in ranges:
+            buffer, n = self._read_into(start, stop, 0 if self._buffers is not None else None)
+            if n == 0:
+                return None
+            return start, buffer, n
+
+        return None
+
+    def __iter__(self):
+        t = time.perf_counter()
+        ranges = self._ranges()
+
+        if self.depth > 0:
+            self._thread = threading.Thread(target=self._run, name='FrameReader', daemon=True)
+            self._thread.start()
+
+        try:
+            while True:
+                wait = time.perf_counter()
+                with profiling.stage('read'):
+                    item = self._filled.get() if self.depth > 0 else self._next_sync(ranges)
+                    if isinstance(item, Exception):
+                        raise item
+                    if item is not None:
+                        profiling.add_bytes_read(self._buffers[item[1]][:item[2]].nbytes)
+                self.wait_time += time.perf_counter() - wait
+
+                if item is None:
+                    break
+
+                start, buffer, n = item
+                frames = self._buffers[buffer][:n]
+                self.frames += n
+                self.bytes += frames.nbytes
+
+                yield start, frames
+
+                if self.depth > 0:
+                    self._free.put(buffer)
+                # A short chunk is the end of the stack
+                if self.depth == 0 and n < self.chunk and (self.stop is None or start + n < self.stop):
+                    break
+        finally:
+            self.close()
+            self.elapsed += time.perf_counter() - t
+
+    def close(self):
+        """Stop the reader thread (when stopping early)"""
+        if self._thread is None:
+            return
+
+        self._stopping.set()
+        # Wake up the reader when it waits for a free buffer
+        self._free.put(0)
+        self._thread.join()
+        self._thread = None
+
+    def io_wait(self):
+        """Fraction of the time the consumer waited for frames to be read"""
+        return self.wait_time / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self):
+        return "Read %d frames (%.1f MB) in %.2f s, waited for I/O %.0f%% of %.2f s" % (
+            self.frames, self.bytes / 2**20, self.read_time, 100 * self.io_wait(), self.elapsed)
@@ -0,0 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from mtf_nps_dqe.lib import pyramid
+
+# Drawing of the diagnostic figures. Before drawing, images are downsampled to display resolution (block mean) and
+# scatter plots with many points are turned into a density plot (2D histogram). The time to draw a figure is then
+# independent of the size of the frames and ROIs.
+#
+# Figures saved to a file are drawn on a background thread, using a plain Figure with the Agg canvas (not pyplot,
+# which is not thread safe), so the measurement continues while the figure is drawn. Call wait() before exiting.
+
+# Maximum number of pixels along a side of a drawn image
+DISPLAY_SIZE = 512
+# Maximum number of points in a scatter plot, above which a density plot is drawn
+MAX_POINTS = 20000
+# Number of bins (x, y) of the density plots
+DENSITY_BINS = (256, 128)
+
+_executor = None
+_pending = []
+
+
+def downsample(im, max_size=None):
+    """Block mean of im, so no side is longer than max_size (default DISPLAY_SIZE). Returns the image and the block
+    size"""
+    im = np.asarray(im)
+    max_size = max_size or DISPLAY_SIZE
+    factor = int(np.ceil(max(im.shape[:2]) / max_size))
+    if factor <= 1:
+        return im, 1
+
+    h, w = im.shape[0] // factor, im.shape[1] // factor
+    small = im[:h * factor, :w * factor].reshape(h, factor, w, factor).mean(axis=(1, 3))
+
+    return small, factor
+
+
+def image(ax, im, origin='upper', max_size=None, **kwargs):
+    """imshow of im, downsampled to display resolution, in the pixel coordinates of the full image. An image Pyramid
+    is drawn from its levels, and drawn in more detail when zooming in (in a shown figure)"""
+    if isinstance(im, pyramid.Pyramid):
+        return pyramid.PyramidView(ax, im, origin, max_size or DISPLAY_SIZE, **kwargs).image
+
+    small, factor = downsample(im, max_size)
+    if factor == 1:
+        return ax.imshow(im, origin=origin, **kwargs)
+
+    h, w = small.shape[0] * factor, small.shape[1] * factor
+    bottom, top = (-0.5, h - 0.5) if origin == 'lower' else (h - 0.5, -0.5)
+
+    return ax.imshow(small, origin=origin, extent=(-0.5, w - 0.5, bottom, top), **kwargs)
+
+
+def scatter(ax, x, y, xlim=None, max_points=None, s=1, color=None, label=None):
+    """Scatter plot of x and y. With more than max_points (default MAX_POINTS) points, a density plot of the points
+    within xlim is drawn instead"""
+    x = np.ravel(x)
+    y = np.ravel(y)
+    if len(x) <= (max_points or MAX_POINTS):
+        return ax.scatter(x, y, s=s, color=color, label=label)
+
+    keep = np.isfinite(x) & np.isfinite(y)
+    if xlim is not None:
+        keep &= (x >= xlim[0]) & (x <= xlim[1])
+    x, y = x[keep], y[keep]
+    if len(x) == 0:
+        return ax.scatter([], [], s=s, color=color, label=label)
+
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=DENSITY_BINS)
+    ax.imshow(np.log1p(counts.T), origin='lower', aspect='auto', interpolation='nearest', cmap='Blues',
+              extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]))
+
+    # Only for the legend
+    return ax.scatter([], [], s=s, color=color, label=label)
+
+
+def figure(show, **kwargs):
+    """A new figure. Figures to show are made with pyplot, others with the Agg canvas (and can be drawn on any thread)"""
+    if show:
+        import matplotlib.pyplot as plt
+
+        return plt.figure(**kwargs)
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+
+    return fig
+
+
+def _save(plot, args, kwargs, output, figsize):
+    fig = figure(False, figsize=figsize)
+    plot(fig, *args, **kwargs)
+    fig.savefig(output)
+    print("INFO: Written figure to %s" % output)
+
+
+def render(plot, *args, output=None, figsize=None, background=True, **kwargs):
+    """Draw a figure with plot(fig, *args, **kwargs). Without output the figure is shown, otherwise it is saved to
+    output, by default on a background thread"""
+    global _executor
+
+    if output is None:
+        import matplotlib.pyplot as plt
+
+        plot(figure(True, figsize=figsize), *args, **kwargs)
+        plt.show()
+        return
+
+    if not background:
+        _save(plot, args, kwargs, output, figsize)
+        return
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='report')
+    _pending.append(_executor.submit(_save, plot, args, kwargs, output, figsize))
+
+
+def wait():
+    """Wait for the figures being drawn in the background. Errors are printed, not raised"""
+    while _pending:
+        future = _pending.pop(0)
+        try:
+            future.result()
+        except Exception as e:
+            print("ERROR: Could not draw figure. Message: '%s'" % e)
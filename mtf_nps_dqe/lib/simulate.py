@@ -0,0 +1,197 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Event level detector simulation. Electrons arrive at random (Poisson) positions at a given dose, either uniform
+# (flat field) or on one side of a slanted edge. Every electron is spread by a point spread function (PSF), by default a
+# Gaussian, or a given kernel:
+#   integrating: the charge is integrated over the pixels, using the integral of the PSF over every pixel (for the
+#                electron position rounded to 1/OVERSAMPLE pixel)
+#   counting:    the electron is counted once, in the pixel of its (PSF blurred) centroid
+# Frames are simulated in chunks on a process pool, with independent random streams per chunk, so the result only
+# depends on the seed and the chunk size.
+
+# Sub-pixel positions per pixel (in x and y) at which the PSF is integrated over the pixels
+OVERSAMPLE = 16
+
+# Number of (electron, pixel of the PSF) pairs deposited at once, which bounds the memory use to about 16 bytes per
+# pair, besides the frame
+BLOCK = 1 << 22
+
+
+def arrivals(rng, n_pix, dose, edge=None, margin=0):
+    """Random arrival positions (x, y) of the electrons of a frame. With an edge angle (degrees), only the right side
+    of an edge through the center (rotated by angle) is illuminated. A margin around the frame is also illuminated,
+    so electrons from outside can spread into the frame"""
+    size = n_pix + 2 * margin
+    n = rng.poisson(dose * size ** 2)
+    x = rng.uniform(-margin, n_pix + margin, n)
+    y = rng.uniform(-margin, n_pix + margin, n)
+
+    if edge is not None:
+        c = n_pix / 2
+        a = math.radians(edge)
+        keep = (x - c) * math.cos(a) + (y - c) * math.sin(a) > 0
+        x, y = x[keep], y[keep]
+
+    return x, y
+
+
+def pixel_integrals(sigma, k, oversample=OVERSAMPLE):
+    """Fraction of a Gaussian integrated over the pixels -k..k, for every sub-pixel position of its center.
+    Returns an array of (oversample, 2k+1)"""
+    from scipy.special import erf
+
+    center = (np.arange(oversample) + 0.5) / oversample
+    edges = np.arange(-k, k + 2)[None, :] - center[:, None]
+
+    return np.diff(0.5 * erf(edges / (math.sqrt(2) * sigma)), axis=1)
+
+
+def sample_kernel(kernel, radius=4, oversample=OVERSAMPLE):
+    """A PSF kernel sampled at oversample points per pixel (in x and y), normalised to a total charge of 1. The kernel
+    is either such an array (of odd size, centered on the middle sample), or a callable kernel(dx, dy) of the offsets
+    (in pixels) from the electron, which is sampled up to radius pixels"""
+    if callable(kernel):
+        d = np.arange(-radius * oversample, radius * oversample + 1) / oversample
+        kernel = kernel(*np.meshgrid(d, d))
+
+    kernel = np.asarray(kernel, dtype=np.float64)
+    if kernel.ndim != 2 or kernel.shape[0] % 2 == 0 or kernel.shape[1] % 2 == 0:
+        raise ValueError("The PSF kernel should be a 2D array of odd size, not of shape %s" % (kernel.shape,))
+    if np.any(kernel < 0) or not np.sum(kernel) > 0:
+        raise ValueError("The PSF kernel should be positive")
+
+    return kernel / np.sum(kernel)
+
+
+def make_psf(sigma=0.0, kernel=None, radius=4, oversample=OVERSAMPLE):
+    """The PSF of a Gaussian of sigma (pixels), or of a kernel (see sample_kernel). Returns None for no spread, or a
+    dict with the PSF integrated over the pixels -k..k around the electron, for every sub-pixel position of the
+    electron, as an array of (oversample, oversample, 2k+1, 2k+1) (sub-pixel y and x, pixel y and x)"""
+    if kernel is None:
+        if sigma == 0:
+            return None
+
+        k = int(math.ceil(4 * sigma))
+        g = pixel_integrals(sigma, k, oversample)
+
+        return {'sigma': sigma, 'samples': None, 'k': k, 'pixels': g[:, None, :, None] * g[None, :, None, :]}
+
+    samples = sample_kernel(kernel, radius, oversample)
+
+    # The pixel (relative to that of the electron) of every sample, for every sub-pixel position of the electron
+    q = np.arange(oversample)[:, None]
+    dy = (q + np.arange(samples.shape[0]) - samples.shape[0] // 2) // oversample
+    dx = (q + np.arange(samples.shape[1]) - samples.shape[1] // 2) // oversample
+    k = int(max(np.max(np.abs(dy)), np.max(np.abs(dx))))
+
+    # Sum the samples per pixel, with a (sub-pixel position, pixel, sample) one hot matrix along both axes
+    pixel = np.arange(-k, k + 1)[None, :, None]
+    ay = (dy[:, None, :] == pixel).astype(np.float64)
+    ax = (dx[:, None, :] == pixel).astype(np.float64)
+    pixels = np.einsum('ayi,ij,bxj->abyx', ay, samples, ax, optimize=True)
+
+    return {'sigma': None, 'samples': samples, 'k': k, 'pixels': pixels}
+
+
+def blur(rng, x, y, psf, oversample=OVERSAMPLE):
+    """Positions (x, y) displaced by random offsets drawn from the PSF"""
+    if psf['samples'] is None:
+        return x + rng.normal(0, psf['sigma'], len(x)), y + rng.normal(0, psf['sigma'], len(y))
+
+    # A random sample of the kernel, and a random position within it
+    samples = psf['samples']
+    idx = rng.choice(samples.size, len(x), p=samples.ravel())
+    dy, dx = np.divmod(idx, samples.shape[1])
+    dx = (dx - samples.shape[1] // 2 + rng.uniform(-0.5, 0.5, len(x))) / oversample
+    dy = (dy - samples.shape[0] // 2 + rng.uniform(-0.5, 0.5, len(y))) / oversample
+
+    return x + dx, y + dy
+
+
+def deposit(x, y, n_pix, psf=None, counting=False, rng=None, block=BLOCK):
+    """Integrate electrons at positions (x, y) onto the pixels of a frame, spread by a PSF made by make_psf"""
+    if counting or psf is None:
+        if counting and psf is not None:
+            x, y = blur(rng, x, y, psf)
+
+        col = np.floor(x).astype(np.int64)
+        row = np.floor(y).astype(np.int64)
+        inside = (col >= 0) & (col < n_pix) & (row >= 0) & (row < n_pix)
+
+        return np.bincount(row[inside] * n_pix + col[inside], minlength=n_pix ** 2).reshape(n_pix, n_pix)
+
+    # Every electron adds the PSF integrated over the pixels, for its sub-pixel position, around its pixel. This is a
+    # single weighted histogram, made in blocks of electrons. Only electrons within k pixels of the frame spread into
+    # it, the frame is padded by 2k pixels so their PSF never wraps around a row
+    k = psf['k']
+    n = 2 * k + 1
+    size = n_pix + 4 * k
+    oversample = psf['pixels'].shape[0]
+    weights = psf['pixels'].reshape(oversample ** 2, n * n)
+    offsets = (np.arange(n * n) // n - k) * size + np.arange(n * n) % n - k
+
+    col = np.floor(x).astype(np.int64)
+    row = np.floor(y).astype(np.int64)
+    sub = ((y - row) * oversample).astype(np.int64) * oversample + ((x - col) * oversample).astype(np.int64)
+    col += 2 * k
+    row += 2 * k
+    inside = (col >= k) & (col < size - k) & (row >= k) & (row < size - k)
+    index, sub = row[inside] * size + col[inside], sub[inside]
+
+    frame = np.zeros(size * size)
+    step = max(block // (n * n), 1)
+    for start in range(0, len(index), step):
+        pixels = (index[start:start + step, None] + offsets).ravel()
+        frame += np.bincount(pixels, weights[sub[start:start + step]].ravel(), minlength=size * size)
+
+    return frame.reshape(size, size)[2 * k:2 * k + n_pix, 2 * k:2 * k + n_pix]
+
+
+def simulate_chunk(seed, n_frames, n_pix, dose, sigma, counting, edge, kernel=None, radius=4):
+    rng = np.random.default_rng(seed)
+    psf = make_psf(sigma, kernel, radius)
+    margin = (psf['k'] if psf is not None else 0) + 1
+
+    frames = np.empty((n_frames, n_pix, n_pix), dtype=np.float32)
+    for idx in range(n_frames):
+        x, y = arrivals(rng, n_pix, dose, edge, margin)
+        frames[idx] = deposit(x, y, n_pix, psf, counting, rng)
+
+    return frames
+
+
+def simulate_frames(n_frames, n_pix=512, dose=1.0, sigma=0.0, counting=False, edge=None, seed=None, chunk=4,
+                    workers=None, kernel=None, radius=4):
+    """Simulate n_frames frames of n_pix x n_pix pixels, with dose electrons per pixel per frame. The PSF is a Gaussian
+    of sigma, or the kernel (see sample_kernel)"""
+    chunks = [min(chunk, n_frames - start) for start in range(0, n_frames, chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    args = [(s, n, n_pix, dose, sigma, counting, edge, kernel, radius) for s, n in zip(seeds, chunks)]
+
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(chunks) == 1:
+        return np.concatenate([simulate_chunk(*a) for a in args])
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+        return np.concatenate(list(executor.map(simulate_chunk, *zip(*args))))
+
+
+def simulate_edge(n_pix=512, dose=100.0, sigma=0.0, counting=False, angle=7, seed=None, workers=None, kernel=None,
+                  radius=4):
+    """Simulate a slanted edge image, with dose electrons per illuminated pixel"""
+    # Split the dose over frames, so the chunks can be simulated in parallel
+    n_frames = max(1, min(workers or os.cpu_count(), int(dose)))
+    frames = simulate_frames(n_frames, n_pix, dose / n_frames, sigma, counting, angle, seed, 1, workers, kernel, radius)
+
+    return np.sum(frames, axis=0, dtype=np.float64)
+
+
+def theoretical_mtf(w, sigma):
+    """MTF of a Gaussian PSF integrated over square pixels, at w (fraction of Nyquist)"""
+    f = np.asarray(w) / 2
+
+    return np.abs(np.sinc(f)) * np.exp(-2 * (math.pi * sigma * f) ** 2)
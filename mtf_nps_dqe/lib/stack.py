@@ -0,0 +1,129 @@
+import bz2
+import contextlib
+import gzip
+import os
+
+import numpy as np
+
+# Reading frames of image stacks, without decompressing or copying the whole stack first:
+#   .mrc / .mrcs            memory mapped
+#   .mrc.gz / .mrc.bz2      decompressed while streaming through the file. Reading is forward only, reading an earlier
+#                           frame restarts from the beginning of the file.
+#   .tif / .tiff            the pages (frames) are read and decompressed on a thread pool. LZW and zstd compression
+#                           require the imagecodecs package.
+#
+# open_stack() yields a function read(start, stop), returning the frames start:stop (or fewer at the end of the
+# stack), and the number of frames. The frames are only counted as read (for profiling) by the caller, which may
+# read them on another thread.
+
+MRC_EXTENSIONS = ('.mrc', '.mrcs')
+TIF_EXTENSIONS = ('.tif', '.tiff')
+COMPRESSION = {'.gz': gzip.open, '.bz2': bz2.open}
+
+# Bytes to skip per read when streaming to a later frame
+SKIP_BLOCK = 2**24
+
+
+def split_extension(filename):
+    """The extension of the file and its compression (or None), for example ('.mrc', '.gz')"""
+    root, ext = os.path.splitext(filename.lower())
+    if ext in COMPRESSION:
+        return os.path.splitext(root)[1], ext
+
+    return ext, None
+
+
+def is_stack_file(filename):
+    ext, compression = split_extension(filename)
+
+    return ext in MRC_EXTENSIONS or (ext in TIF_EXTENSIONS and compression is None)
+
+
+class CompressedMrc:
+    """Stream the frames of a gzip or bzip2 compressed MRC file"""
+
+    def __init__(self, filename, compression):
+        import mrcfile
+        from mrcfile.utils import data_dtype_from_header
+
+        # mrcfile only decompresses the header (and extended header) here
+        with mrcfile.open(filename, mode='r', header_only=True, permissive=True) as f:
+            header = f.header
+            self.offset = header.nbytes + int(header.nsymbt)
+            self.dtype = data_dtype_from_header(header)
+
+        self.shape = (int(header.ny), int(header.nx))
+        self.n_frames = int(header.nz)
+        self.frame_bytes = self.shape[0] * self.shape[1] * self.dtype.itemsize
+
+        self.filename = filename
+        self.opener = COMPRESSION[compression]
+        self.stream = None
+        self.position = 0
+
+    def _seek(self, frame):
+        if self.stream is None or frame < self.position:
+            self.close()
+            self.stream = self.opener(self.filename, 'rb')
+            self.stream.read(self.offset)
+            self.position = 0
+
+        skip = (frame - self.position) * self.frame_bytes
+        while skip > 0:
+            skip -= len(self.stream.read(min(skip, SKIP_BLOCK)))
+        self.position = frame
+
+    def read(self, start, stop):
+        start = min(start, self.n_frames)
+        stop = self.n_frames if stop is None else min(stop, self.n_frames)
+        self._seek(start)
+
+        data = self.stream.read(max(stop - start, 0) * self.frame_bytes)
+        n = len(data) // self.frame_bytes
+        self.position += n
+
+        return np.frombuffer(data, dtype=self.dtype, count=n * self.shape[0] * self.shape[1]).reshape((n,) + self.shape)
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+
+@contextlib.contextmanager
+def open_stack(filename, workers=None):
+    """Open an image stack. Yields a function read(start, stop) and the number of frames"""
+    ext, compression = split_extension(filename)
+
+    if ext in MRC_EXTENSIONS and compression is None:
+        import mrcfile
+
+        with mrcfile.mmap(filename, mode='r') as f:
+            data = f.data if f.data.ndim == 3 else f.data[np.newaxis]
+            yield (lambda start, stop: data[start:stop]), len(data)
+    elif ext in MRC_EXTENSIONS:
+        stack = CompressedMrc(filename, compression)
+        try:
+            yield stack.read, stack.n_frames
+        finally:
+            stack.close()
+    elif ext in TIF_EXTENSIONS and compression is None:
+        import tifffile
+
+        with tifffile.TiffFile(filename) as tif:
+            n_frames = len(tif.pages)
+
+            def read(start, stop):
+                keys = range(start, min(n_frames if stop is None else stop, n_frames))
+                if len(keys) == 0:
+                    return np.empty((0,) + tif.pages[0].shape, dtype=tif.pages[0].dtype)
+
+                # Pages are independently compressed, and decompressed in parallel by tifffile
+                frames = tif.asarray(key=keys, maxworkers=workers)
+                frames = frames.reshape((len(keys),) + frames.shape[-2:])
+
+                return frames
+
+            yield read, n_frames
+    else:
+        raise ValueError('Unsupported stack (only MRC, gzip or bzip2 compressed MRC, or TIF)')
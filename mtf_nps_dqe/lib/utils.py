@@ -1,12 +1,17 @@
 import numpy as np
-from scipy.fft import rfft2, irfft2, rfftfreq, fftfreq, fft2, fftshift
+
+# scipy.fft is imported in the functions that use it, as importing it takes a considerable part of the startup time
 
 
 def ft(mic):
+    from scipy.fft import rfft2
+
     return rfft2(mic, workers=1)
 
 
 def ift(mic):
+    from scipy.fft import irfft2
+
     return irfft2(mic, workers=1)
 
 
@@ -56,6 +61,8 @@ def get_mic_freqs(mic, apix, angles=False):
     """Returns array of effective spatial frequencies for a real 2D FFT.
     If angles is True, returns the array of the angles w.r.t. the X-axis
     """
+    from scipy.fft import rfftfreq, fftfreq
+
     n_x, n_y = mic.shape
     x, y = np.meshgrid(rfftfreq(n_y, d=apix), fftfreq(n_x, d=apix))
     s = np.sqrt(x ** 2 + y ** 2)
@@ -76,6 +83,8 @@ def psfg_2d(lam, x0, y0, X, Y):
 
 
 def get_gaussian_filter(sigma, grid_len):
+    from scipy.fft import rfft2
+
     # Calculate the 2D gaussian
     grid = np.arange(0, grid_len, 1)
     grid_x, grid_y = np.meshgrid(grid, grid)
@@ -87,8 +96,22 @@ def get_gaussian_filter(sigma, grid_len):
 
 
 def get_hann_filter(grid_len):
+    from scipy.fft import fftshift
+
     window1d = np.abs(np.hanning(grid_len))
     window2d = fftshift(np.sqrt(np.outer(window1d, window1d)))
     window2d_half = window2d[0:grid_len, 0:(grid_len // 2) + 1]
 
     return window2d_half
+
+
+def pyplot(show=True):
+    """Import pyplot on first use. Selects the non-interactive Agg backend when no figure will be shown"""
+    import matplotlib
+
+    if not show:
+        matplotlib.use('Agg')
+
+    import matplotlib.pyplot as plt
+
+    return plt
@@ -0,0 +1,212 @@
+import argparse
+import contextlib
+import csv
+import os
+import sys
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from mtf_nps_dqe.lib import catalog, profiling, report
+from mtf_nps_dqe.mtf import measureMTF
+
+# Measures the MTF in many ROIs of an edge image, to map the MTF over the sensor (for example per chip of a tiled
+# sensor). The ROIs are either tiles of the image, or read from a CSV file. The ROIs are measured in parallel on a
+# process pool. ROIs without a clear edge are rejected. The accepted ROIs are combined into a single MTF, using the
+# inverse variance weighted mean of lambda.
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('FILE', help="Input edge image (tif, mrc, compressed .mrc.gz/.mrc.bz2 or event list)")
+    parser.add_argument('--tile', type=int, help='Tile the image into ROIs of this size')
+    parser.add_argument('--step', type=int, help='Step between tiles (default the tile size)')
+    parser.add_argument('--rois', type=str, help='CSV file with the columns x, y, width, height of the ROIs')
+    parser.add_argument('--rotate', default=0, type=int, help='Number of times to rotate the image clockwise')
+    parser.add_argument('--sum_frames', default=False, action='store_true',
+                        help='Sum all frames of an MRC or TIF stack (default only the first frame is used)')
+    parser.add_argument('--super_res', default=1, type=int, help='Rescale the frequency of the measured MTF curves by this factor')
+    parser.add_argument('--min_r2', default=0.9, type=float, help='Reject ROIs with a worse R-squared of the edge fit')
+    parser.add_argument('--min_contrast', default=0.5, type=float,
+                        help='Reject ROIs with a smaller contrast (flat-dark)/flat across the edge')
+    parser.add_argument('--workers', default=os.cpu_count(), type=int, help='Number of worker processes')
+    parser.add_argument('--store', type=str, help='Store the lambda map and aggregated MTF curve (.npz)')
+    parser.add_argument('--catalog', type=str, help='Store the aggregated MTF curve in this catalog (.sqlite)')
+    parser.add_argument('--name', type=str, help='Label to store with the aggregated MTF curve (default basename of file)')
+    parser.add_argument('--output', type=str, help='Save the figure to this file, instead of showing it')
+    parser.add_argument('--no_plot', default=False, action='store_true', help='Do not show the figure')
+    parser.add_argument('--profile', type=str, help='Write a report with the time and memory use of each stage (.json or .csv)')
+
+    settings = parser.parse_args()
+
+    if (settings.tile is None) == (settings.rois is None):
+        parser.error('Supply either --tile or --rois')
+
+    return settings
+
+
+def tile_rois(shape, size, step=None):
+    """ROIs (x, y, width, height) tiling an image of shape"""
+    step = step or size
+    ys = range(0, shape[0] - size + 1, step)
+    xs = range(0, shape[1] - size + 1, step)
+
+    return [(x, y, size, size) for y in ys for x in xs], (len(ys), len(xs))
+
+
+def read_rois(filename):
+    with open(filename, newline='') as f:
+        return [tuple(int(row[k]) for k in ('x', 'y', 'width', 'height')) for row in csv.DictReader(f)]
+
+
+def measure_roi(crop, super_res=1):
+    """Measure the MTF of a single ROI. Returns a dict with the fit and quality measures, or None when the fit fails"""
+    # ROIs without an edge give empty slices and NaN fits, these are rejected by accept(), so their warnings are
+    # silenced
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), warnings.catch_warnings(), \
+            np.errstate(all='ignore'):
+        warnings.simplefilter('ignore')
+        try:
+            r = measureMTF.measure_mtf(crop, 0, 0, crop.shape[1], crop.shape[0], super_res)
+        except (RuntimeError, ValueError):
+            return None
+
+    return {
+        'lam': r['fit'][0],
+        'lam_err': r['perr'][0],
+        'x0': r['fit'][1],
+        'r2': r['r_value'] ** 2,
+        'contrast': (r['flat_mean'] - r['dark_mean']) / r['flat_mean'],
+        'w': r['w'],
+        'mtf': r['mtf'],
+    }
+
+
+def measure_rois(crops, super_res=1):
+    return [measure_roi(crop, super_res) for crop in crops]
+
+
+def measure_map(im, rois, super_res=1, workers=None, batch=16):
+    """Measure all ROIs, in batches on a process pool. Returns a list with a result (or None) per ROI"""
+    crops = [np.ascontiguousarray(im[y:y + h, x:x + w]) for x, y, w, h in rois]
+    batches = [crops[i:i + batch] for i in range(0, len(crops), batch)]
+
+    if workers == 1 or len(batches) == 1:
+        return [r for b in batches for r in measure_rois(b, super_res)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return [r for rs in executor.map(measure_rois, batches, [super_res] * len(batches)) for r in rs]
+
+
+def accept(result, min_r2, min_contrast):
+    return result is not None and np.isfinite(result['lam_err']) and result['lam'] > 0 \
+        and result['r2'] >= min_r2 and result['contrast'] >= min_contrast
+
+
+def aggregate(results):
+    """Inverse variance weighted mean lambda of the accepted ROIs. Returns lambda, its error and the spread between
+    the ROIs"""
+    lam = np.array([r['lam'] for r in results])
+    weights = 1 / np.array([r['lam_err'] for r in results]) ** 2
+
+    mean = np.sum(weights * lam) / np.sum(weights)
+    err = 1 / np.sqrt(np.sum(weights))
+
+    return mean, err, np.std(lam)
+
+
+def plot_map(fig, lam_map, mtf_half_map, w, mtf, lam, lam_err, title):
+    (ax0, ax1, ax2) = fig.subplots(1, 3)
+    fig.suptitle(title)
+
+    im = ax0.imshow(lam_map)
+    fig.colorbar(im, ax=ax0, orientation='vertical')
+    ax0.set_title("Lambda")
+
+    im = ax1.imshow(mtf_half_map, vmin=0, vmax=1)
+    fig.colorbar(im, ax=ax1, orientation='vertical')
+    ax1.set_title("MTF(0.5 Nyquist)")
+
+    ax2.plot(w, mtf, label='MTFg(λ=%.02f±%.02f)' % (lam, lam_err))
+    ax2.set_xlim([0, 1])
+    ax2.set_ylim([0, 1.1])
+    ax2.set_xlabel("Spatial frequency (fraction of Nyquist)")
+    ax2.set_ylabel("MTF")
+    ax2.set_title("Aggregated MTF")
+    ax2.legend()
+    ax2.grid()
+
+
+def main():
+    config = parse_arguments()
+    profiling.enable(config.profile)
+
+    try:
+        with profiling.stage('read'):
+            im = measureMTF.load_image(config.FILE, config.rotate, config.super_res, sum_stack=config.sum_frames)
+    except (OSError, ValueError) as e:
+        print("ERROR: %s" % e)
+        return 1
+
+    if config.tile is not None:
+        rois, grid = tile_rois(im.shape, config.tile, config.step)
+    else:
+        rois = read_rois(config.rois)
+        grid = (1, len(rois))
+    print("INFO: Measuring %d ROIs" % len(rois))
+
+    with profiling.stage('measure'):
+        results = measure_map(im, rois, config.super_res, config.workers)
+
+    valid = np.array([accept(r, config.min_r2, config.min_contrast) for r in results], dtype=bool)
+    print("INFO: %d of %d ROIs have a clear edge" % (np.sum(valid), len(rois)))
+    if not np.any(valid):
+        print("ERROR: No ROI with a clear edge")
+        return 1
+
+    def values(key):
+        return np.array([r[key] if ok else np.nan for r, ok in zip(results, valid)])
+
+    lam_map = values('lam').reshape(grid)
+    lam_err_map = values('lam_err').reshape(grid)
+    mtf_half_map = measureMTF.mtf_g(0.5, lam_map)
+
+    lam, lam_err, lam_std = aggregate([r for r, ok in zip(results, valid) if ok])
+    w = results[int(np.flatnonzero(valid)[0])]['w']
+    mtf = measureMTF.mtf_g(w / config.super_res, lam)
+    print("Lambda (weighted mean): %.05f±%.05f (spread between ROIs: %.05f)" % (lam, lam_err, lam_std))
+    print("MTF(0.5 Nyquist): %0.3f (ROIs: %0.3f - %0.3f)" % (measureMTF.mtf_g(0.5, lam), np.nanmin(mtf_half_map),
+                                                             np.nanmax(mtf_half_map)))
+
+    if config.store is not None:
+        np.savez(config.store, w=w, mtf=mtf, lam=lam, lam_err=lam_err, lam_std=lam_std, rois=np.array(rois),
+                 valid=valid, lam_map=lam_map, lam_err_map=lam_err_map, mtf_half_map=mtf_half_map,
+                 r2=np.array([r['r2'] if r is not None else np.nan for r in results]).reshape(grid),
+                 x0=values('x0').reshape(grid))
+
+    if config.catalog is not None:
+        catalog.store_curve(config.catalog, 'mtf', w, mtf,
+                            label=config.name or os.path.basename(config.store or config.FILE),
+                            source=config.FILE,
+                            rotate=config.rotate,
+                            lam=lam, lam_err=lam_err, lam_std=lam_std,
+                            rois=int(np.sum(valid)),
+                            super_res=config.super_res)
+
+    if not config.no_plot:
+        with profiling.stage('plot'):
+            report.render(plot_map, lam_map, mtf_half_map, w, mtf, lam, lam_err, config.FILE, output=config.output,
+                          figsize=(15, 5))
+
+    with profiling.stage('figure'):
+        report.wait()
+
+    profiling.write()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
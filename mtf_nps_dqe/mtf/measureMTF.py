@@ -3,33 +3,40 @@ import math
 import os
 import sys
 
-import matplotlib.pyplot as plt
 import numpy as np
-import scipy.optimize
-from matplotlib import patches
-from matplotlib.widgets import RectangleSelector
-import mrcfile
-from scipy.ndimage import binary_dilation, sobel, gaussian_filter
-from scipy.special import erfc
-from scipy.stats import linregress
-from skimage import io
-from skimage.filters.thresholding import threshold_mean
-from skimage.transform import rotate, downscale_local_mean
 
-from mtf_nps_dqe.lib import utils
+from mtf_nps_dqe.lib import utils, cache, catalog, events, profiling, pyramid, report, stack
+from mtf_nps_dqe.lib.reader import FrameReader
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('FILE', default=None, nargs='?', help="Input image (tif or mrc). If none supplied, an edge will be simulated")
+    parser.add_argument('FILE', default=None, nargs='?', help="Input image (tif, mrc or compressed .mrc.gz/.mrc.bz2) or event list (.npy, .npz or .h5). If none supplied, an edge will be simulated")
     parser.add_argument('-x', default=None, type=int, help="Starting x coordinate of crop")
     parser.add_argument('-y', default=None, type=int, help="Starting y coordinate of crop")
     parser.add_argument('--width', default=None, type=int, help="Width of crop")
     parser.add_argument('--height', default=None, type=int, help="Height of crop")
     parser.add_argument('--store', type=str, help='Store output measured MTF curve')
-    parser.add_argument('--super_res', default=1, type=int, help='Rescale the frequency of the measured MTF curve by this factor')
+    parser.add_argument('--catalog', type=str, help='Store output measured MTF curve in this catalog (.sqlite)')
+    parser.add_argument('--name', type=str, help='Label to store with measured MTF curve in the catalog (default basename of file)')
+    parser.add_argument('--super_res', default=1, type=int,
+                        help='Rescale the frequency of the measured MTF curve by this factor. Event lists are binned at this super resolution')
+    parser.add_argument('--weight', default='counts', choices=['counts', 'tot'],
+                        help='For event lists: count every event once, or weigh events by their time over threshold')
     parser.add_argument('--rotate', default=0, type=int, help='Number of times to rotate the image clockwise')
+    parser.add_argument('--sum_frames', default=False, action='store_true',
+                        help='Sum all frames of an MRC or TIF stack (default only the first frame is used)')
+    parser.add_argument('--chunk', default=16, type=int, help='Number of frames to read at once when summing frames')
+    parser.add_argument('--prefetch', default=2, type=int,
+                        help='Number of chunks to read ahead on a background thread when summing frames (0 to disable)')
+    parser.add_argument('--no_plot', default=False, action='store_true', help='Do not show the diagnostic figure')
+    parser.add_argument('--figure', type=str,
+                        help='Save the diagnostic figure to this file (drawn in the background), instead of showing it')
+    parser.add_argument('--profile', type=str, help='Write a report with the time and memory use of each stage (.json or .csv)')
+    parser.add_argument('--cache', nargs='?', const=cache.DEFAULT_DIR, type=str,
+                        help='Cache the ESF of the input in this directory (default %s)' % cache.DEFAULT_DIR)
+    parser.add_argument('--cache_size', default=cache.DEFAULT_SIZE, type=int, help='Maximum size of the cache (MB)')
 
     sim_group = parser.add_argument_group('simulate edge parameters')
     sim_group.add_argument('--gauss', type=float, default=0, help="Gaussian sigma used for blurring of image")
@@ -39,24 +46,27 @@ def parse_arguments():
     sim_group.add_argument('--factor', type=int, default=1, help="Initial upscale factor")
     sim_group.add_argument('--real', default=False, action='store_true', help="Perform operations in real space")
     sim_group.add_argument('--noise', default=False, action='store_true', help="Add Poission noise to illuminated area")
+    sim_group.add_argument('--poisson', default=False, action='store_true',
+                           help="Simulate individual electrons (Poisson arrivals, spread by a Gaussian or given PSF)")
+    sim_group.add_argument('--dose', type=float, default=100.0, help="Electrons per illuminated pixel (with --poisson)")
+    sim_group.add_argument('--psf_sigma', type=float, default=0.0, help="Sigma of the Gaussian PSF in pixels (with --poisson)")
+    sim_group.add_argument('--psf_kernel', type=str,
+                           help="PSF kernel (.npy) sampled at 16 points per pixel, instead of a Gaussian (with --poisson)")
+    sim_group.add_argument('--counting', default=False, action='store_true',
+                           help="Count every electron once, instead of integrating its charge (with --poisson)")
+    sim_group.add_argument('--seed', type=int, default=None, help="Seed of the random number generator (with --poisson)")
+    sim_group.add_argument('--workers', type=int, default=None, help="Number of processes to simulate with (with --poisson)")
 
     settings = parser.parse_args()
 
     return settings
 
 
-def rectangle_select_callback(eclick, erelease):
-    global config
-    # Not entirely pretty
-    config.x = int(eclick.xdata)
-    config.y = int(eclick.ydata)
-    config.width = int(erelease.xdata - eclick.xdata)
-    config.height = int(erelease.ydata - eclick.ydata)
-
-
 # Edge spread function (ESF)
 # McMullan et al. 2009 Eq 12
 def esf(x, lam, x0):
+    from scipy.special import erfc
+
     with np.errstate(divide='ignore', invalid='ignore'):
         return erfc(-(x - x0) / lam) / 2
 
@@ -84,16 +94,11 @@ def mtf(w, lam):
     return theoretical_mtf(w) * mtf_g(w, lam)
 
 
-# Read config
-config = parse_arguments()
+def simulate_edge(factor=1, super_res=1, gauss=0, hann=False, bw=False, real=False, noise=False, org_shape=512):
+    """Simulate a (slanted) knife edge image"""
+    from skimage.transform import rotate
 
-if config.FILE is None:
-    print("INFO: No image supplied, simulating ideal edge")
-    factor = config.factor
-    super_res = config.sim_super_res
-    org_shape = 512
-    shape = 512 * factor
-    gauss = config.gauss
+    shape = org_shape * factor
 
     im = np.zeros((shape, shape))
 
@@ -102,7 +107,7 @@ if config.FILE is None:
     ill_noise = 10/factor**2
 
     # Add illuminated area
-    if config.noise:
+    if noise:
         im[0:shape, shape // 2:shape] = np.random.normal(ill, ill_noise, (shape, shape//2))
     else:
         im[0:shape, shape//2:shape] = ill
@@ -111,12 +116,15 @@ if config.FILE is None:
     im = rotate(im, 7, mode='constant', cval=0)
 
     # Do operations in real space or fourier space
-    if config.real:
-        if config.gauss > 0:
+    if real:
+        from scipy.ndimage import gaussian_filter
+        from skimage.transform import downscale_local_mean
+
+        if gauss > 0:
             im = gaussian_filter(im, gauss * factor)
 
         # Bin
-        if config.factor > 1:
+        if factor > 1:
             im = downscale_local_mean(im, factor // super_res)
     else:
         # FFT
@@ -128,242 +136,445 @@ if config.FILE is None:
             fim = fim*fg
 
         # Fourier crop (bin)
-        if config.factor > 1:
-            fim = utils.bin_mic_ft(fim, 1 / factor, super_res / 2, mic_freqs=utils.get_mic_freqs(im, 1 / factor), lp=config.bw)
+        if factor > 1:
+            fim = utils.bin_mic_ft(fim, 1 / factor, super_res / 2, mic_freqs=utils.get_mic_freqs(im, 1 / factor), lp=bw)
 
-        if config.hann:
+        if hann:
             fh = utils.get_hann_filter(org_shape*super_res)
             fim = fim*fh
 
         # Inverse FFT
         im = utils.ift(fim)
 
-    # Supply defaults
-    config.FILE = "Simulated (real:{}, gauss:{}, hann:{}, bw:{}, sim_super_res:{}, factor:{}, noise:{})".format(
-        config.real,
-        config.gauss,
-        config.hann,
-        config.bw,
-        config.sim_super_res,
-        config.factor,
-        config.noise
-    )
-    config.x = 128 * super_res
-    config.y = 128 * super_res
-    config.width = 256 * super_res
-    config.height = 256 * super_res
-else:
-    ext = os.path.splitext(config.FILE)[1]
-
-    if ext == '.tif' or ext == '.tiff':
-        # Read image
-        im = np.array(io.imread(config.FILE))
-    elif ext == '.mrc' or ext == '.mrcs':
-        with mrcfile.open(config.FILE, mode='r') as f:
-            if f.is_image_stack():
-                print("WARNING: Image stack, only reading first frame.")
-                im = f.data[0]
+    return im
+
+
+def sum_frames(read, n_frames, chunk=16, prefetch=2):
+    """Sum the frames of a stack, reading the next chunks while the current chunk is summed"""
+    frames = FrameReader(read, 0, n_frames, chunk, prefetch)
+    im = 0
+    for _, chunk_frames in frames:
+        im = im + np.sum(chunk_frames, axis=0, dtype=np.float64)
+    print("INFO: Summed frames. %s" % frames.summary())
+
+    return im
+
+
+def load_image(filename, rotate=0, super_res=1, weight='counts', sum_stack=False, chunk=16, prefetch=2):
+    if events.is_event_file(filename):
+        # Sum all events into a single image
+        im = events.load_image(filename, super_res, weight)
+    elif stack.is_stack_file(filename):
+        with stack.open_stack(filename) as (read, n_frames):
+            if sum_stack and n_frames > 1:
+                im = sum_frames(read, n_frames, chunk, prefetch)
             else:
-                im = f.data
+                if n_frames > 1:
+                    print("WARNING: Image stack, only reading first frame. Use --sum_frames to sum all frames.")
+                im = np.array(read(0, 1)[0])
+                profiling.add_bytes_read(im.nbytes)
     else:
-        print('ERROR: Unsupported file extension (only TIF or MRC)')
-        sys.exit(1)
+        raise ValueError('Unsupported file extension (only TIF, MRC, compressed MRC or event list)')
+
+    if rotate > 0:
+        im = np.rot90(im, rotate)
+
+    return im
 
-    if config.rotate > 0:
-        im = np.rot90(im, config.rotate)
 
-if config.x is None or config.y is None or config.width is None or config.height is None:
-    plt.imshow(im, origin='lower')
-    r = RectangleSelector(plt.gca(), rectangle_select_callback, interactive=True)
-    plt.title("Select the area with edge to crop. Then close this window.")
+def select_roi(preview):
+    """Show the image (a Pyramid) and let the user select the area with the edge. Returns x, y, width, height in full
+    resolution pixels"""
+    import matplotlib.pyplot as plt
+    from matplotlib.widgets import RectangleSelector
+
+    selected = []
+
+    def rectangle_select_callback(eclick, erelease):
+        selected.append(True)
+
+    # Only the level of the pyramid that fits the screen is drawn, and the finer levels of the visible tiles when
+    # zooming in. The axes are in full resolution pixels
+    fig, ax = plt.subplots()
+    pyramid.PyramidView(ax, preview, origin='lower')
+    r = RectangleSelector(ax, rectangle_select_callback, interactive=True)
+    ax.set_title("Select the area with edge to crop. Then close this window.")
     plt.show()
-    print(config)
-
-# Calculate the crop shape
-crop_x = config.x
-crop_y = config.y
-crop_h = config.height
-crop_w = config.width
-
-# Take the crop of the image
-area = np.s_[crop_y:crop_y + crop_h, crop_x:crop_x + crop_w]
-crop = im[area]
-
-# Threshold the image to a binary
-try:
-    thresh = threshold_mean(crop)
-    binary = crop > thresh
-except RuntimeError:
-    # This can happen if the image is already binary
-    print("WARNING: Could not threshold the original image. Image already binary? Trying with original image.")
-    binary = crop
-
-# Binary dilate to fill holes (should only be dead pixels).
-# Doing two iteration to also account for the bigger dead pixels of super res
-rec = binary_dilation(binary, iterations=2)
-
-# Calculate sobel filter
-# http://scikit-image.org/docs/dev/auto_examples/edges/plot_edge_filter.html#sphx-glr-auto-examples-edges-plot-edge-filter-py
-sob = sobel(rec)
-
-# Store final image to take crop of and perform linear regression
-final_crop = sob
-
-# Extract line fragment as x and y coordinates
-line_idx = np.flatnonzero(final_crop)
-line_y, line_x = np.unravel_index(line_idx, final_crop.shape)
-
-# Linear regression
-slope, intercept, r_value, p_value, std_err = linregress(line_x, line_y)
-print("R-squared-value: %f" % r_value ** 2)
-print("Slope: %f (%0.10f degrees)" % (slope, math.degrees(math.atan(slope))))
-print("Intercept: %f" % intercept)
-
-# Show total edge fit
-edge_x_vals = np.arange(0, crop_w)
-edge_y_vals = intercept + slope * edge_x_vals
-
-# Linearize crop
-values = np.reshape(crop, crop_h * crop_w)
-
-# Calculate distance matrix towards the slope
-# https://en.wikipedia.org/wiki/Distance_from_a_point_to_a_line
-distance = np.zeros((crop_h, crop_w))
-column = np.arange(0, crop_w) + 0.5
-for y in range(crop_h):
-    distance[y, :] = (slope * column - (y + 0.5) + intercept) / np.sqrt(slope ** 2 + 1)
-
-# Sort values according to distance to slope
-distances = np.reshape(distance, crop_h * crop_w)
-indexes = np.argsort(distances)
-
-# Invert the slope if black and white are reversed
-sign = 1
-if np.average(values[indexes[:10]]) > np.average(values[indexes[-10:]]):
-    sign = -1
-
-# Take the values according to the distance sorted indexes. This gives the ESF
-values = values[indexes]
-distances = sign * distances[indexes]
-
-# Flip if black and white are reversed
-if distances[0] > distances[-1]:
-    distances = np.flip(distances)
-    values = np.flip(values)
-
-# Normalize the ESF by taking values far away from the edge. Also correct for dark noise
-flat_mean = np.mean(values[distances > 10])
-print("Mean count: %.2f" % flat_mean)
-dark_mean = np.mean(values[distances < -10])
-print("Mean dark count: %.2f" % dark_mean)
-
-# Normalize
-esf_meas = (values - dark_mean) / (flat_mean - dark_mean)
-
-# Fit the measured ESF to the theoretical ESF
-try:
-    fit, pcov = scipy.optimize.curve_fit(esf, distances, esf_meas, maxfev=10000)
+
+    if not selected:
+        return [None, None, None, None]
+
+    # The final rectangle, including adjustments after the first selection
+    x0, x1, y0, y1 = r.extents
+
+    return list(pyramid.roi_from_corners(x0, y0, x1, y1, preview.shape))
+
+
+def find_edge(crop):
+    """Find the edge in the crop. Returns the slope, intercept and r-value of the linear fit to the edge"""
+    from scipy.ndimage import binary_dilation, sobel
+    from scipy.stats import linregress
+    from skimage.filters.thresholding import threshold_mean
+
+    # Threshold the image to a binary
+    try:
+        thresh = threshold_mean(crop)
+        binary = crop > thresh
+    except RuntimeError:
+        # This can happen if the image is already binary
+        print("WARNING: Could not threshold the original image. Image already binary? Trying with original image.")
+        binary = crop
+
+    # Binary dilate to fill holes (should only be dead pixels).
+    # Doing two iteration to also account for the bigger dead pixels of super res
+    rec = binary_dilation(binary, iterations=2)
+
+    # Calculate sobel filter
+    # http://scikit-image.org/docs/dev/auto_examples/edges/plot_edge_filter.html#sphx-glr-auto-examples-edges-plot-edge-filter-py
+    sob = sobel(rec)
+
+    # Store final image to take crop of and perform linear regression
+    final_crop = sob
+
+    # Extract line fragment as x and y coordinates
+    line_idx = np.flatnonzero(final_crop)
+    line_y, line_x = np.unravel_index(line_idx, final_crop.shape)
+
+    # Linear regression
+    slope, intercept, r_value, p_value, std_err = linregress(line_x, line_y)
+
+    return slope, intercept, r_value
+
+
+def edge_distance(slope, intercept, crop_h, crop_w):
+    """Calculate distance matrix towards the slope"""
+    # https://en.wikipedia.org/wiki/Distance_from_a_point_to_a_line
+    column = np.arange(0, crop_w) + 0.5
+    row = np.arange(0, crop_h)[:, None] + 0.5
+
+    return (slope * column - row + intercept) / np.sqrt(slope ** 2 + 1)
+
+
+def edge_spread(crop, distance):
+    """Sort the pixel values of the crop according to their distance to the edge. Returns distances and values"""
+    # Linearize crop
+    values = np.reshape(crop, crop.size)
+
+    # Sort values according to distance to slope
+    distances = np.reshape(distance, distance.size)
+    indexes = np.argsort(distances)
+
+    # Invert the slope if black and white are reversed
+    sign = 1
+    if np.average(values[indexes[:10]]) > np.average(values[indexes[-10:]]):
+        sign = -1
+
+    # Take the values according to the distance sorted indexes. This gives the ESF
+    values = values[indexes]
+    distances = sign * distances[indexes]
+
+    # Flip if black and white are reversed
+    if distances[0] > distances[-1]:
+        distances = np.flip(distances)
+        values = np.flip(values)
+
+    return distances, values
+
+
+def fit_esf(distances, values):
+    """Normalise the ESF and fit it to the theoretical ESF. Returns the normalised ESF, fit, error on fit,
+    flat mean and dark mean. Raises RuntimeError when the fit fails"""
+    from scipy.optimize import curve_fit
+
+    # Normalize the ESF by taking values far away from the edge. Also correct for dark noise
+    flat_mean = np.mean(values[distances > 10])
+    print("Mean count: %.2f" % flat_mean)
+    dark_mean = np.mean(values[distances < -10])
+    print("Mean dark count: %.2f" % dark_mean)
+
+    # Normalize
+    esf_meas = (values - dark_mean) / (flat_mean - dark_mean)
+
+    # Fit the measured ESF to the theoretical ESF
+    fit, pcov = curve_fit(esf, distances, esf_meas, maxfev=10000)
     # Calculate one standard deviation error on the parameters
     perr = np.sqrt(np.diag(pcov))
-except RuntimeError as e:
-    print("ERROR: Could not fit ESF. Message: '%s'" % e.__str__())
-    sys.exit(1)
-
-# Print fits
-print("Lambda (fit): %.05f±%.02f" % (fit[0], perr[0]))
-print("x0 (fit): %.02f±%.02f" % (fit[1], perr[1]))
-
-# Calculate fitted ESF
-x_fit = np.linspace(-10, 10, 1000)
-esf_fit = esf(x_fit, *fit)
-
-# Line spread function (LSF)
-lsf_fit_meas = np.diff(esf_fit, prepend=0)
-lsf_meas_meas = np.diff(esf_meas, prepend=0)
-
-# Fitted LSF
-lsf_fit = lsf(x_fit, *fit)
-
-# Modulation transfer function (Normalised with the sum of the LSF)
-# mtf_meas = 1/np.sum(lsf_fit_meas) * np.abs(np.fft.fft(lsf_fit_meas))
-# mtf_meas_w = np.linspace(0, 100, len(mtf_meas))
-
-# Fitted MTF
-# Overshooting 1, to make sure the value 1 is also included
-mtf_calc_w = np.arange(0, 1.1, 0.01)
-mtf_calc = mtf_g(mtf_calc_w, fit[0])
-
-# Print half and nyquist values
-print("MTF(0.25 Nyquist): %0.3f" % mtf_g(0.25, fit[0]))
-print("MTF(0.5 Nyquist): %0.3f" % mtf_g(0.5, fit[0]))
-print("MTF(1 Nyquist):   %0.3f" % mtf_g(1.0, fit[0]))
-
-if config.super_res > 1:
-    print("Applying super res scaling to final curve")
-    mtf_calc_w = mtf_calc_w * config.super_res
-
-# Figure
-fig, ((ax0, ax1, ax2), (ax3, ax4, ax5), (ax6, ax7, ax8)) = plt.subplots(3, 3)
-fig.suptitle(config.FILE)
-
-# Show image
-ax0.set_title("Full image")
-ax0.imshow(im, origin='lower')
-c = patches.Rectangle((config.x, config.y), config.width, config.height, linewidth=1, edgecolor='r', facecolor='none')
-ax0.add_patch(c)
-
-# Crop
-ax1.set_title("Crop")
-ax1.imshow(crop, origin='lower')
-ax1.plot(edge_x_vals, edge_y_vals, '--', color='orange')
-ax1.set_xlim(0, crop_w)
-ax1.set_ylim(0, crop_h)
-
-# Distance
-ax2.set_title("Distance")
-ax2.imshow(distance, origin='lower')
-ax2.plot(edge_x_vals, edge_y_vals, '--', color='orange')
-ax2.set_xlim(0, crop_w)
-ax2.set_ylim(0, crop_h)
-
-ax3.set_title("Edge spread function (normalised)")
-# ax3.plot(distances, esf_meas, color='blue', label='Measured')
-ax3.scatter(distances, esf_meas, color='blue', label='Measured', s=1)
-ax3.plot(x_fit, esf_fit, color='orange', label='erfc(-x/(%.02f±%.02f))/2' % (fit[0], perr[0]))
-ax3.plot(x_fit, esf(x_fit, 0.00001, fit[1]), '--', color='black', label='erfc(-x/(0.0))/2')
-ax3.set_xlim(fit[1] - 4, fit[1] + 4)
-ax3.legend(loc='lower right')
-
-ax4.set_title("Line spread function (normalised)")
-# ax4.scatter(x_fit, lsf_meas_meas/np.max(lsf_meas_meas), label='Numeric diff ESF')
-# ax4.scatter(x_fit, lsf_fit_meas / np.max(lsf_fit_meas), label='Numeric diff ESFfit')
-ax4.set_xlim(fit[1] - 4, fit[1] + 4)
-ax4.plot(x_fit, lsf_fit / np.max(lsf_fit), color='orange', label='exp(-x^2/(%.02f±%.02f)^2)' % (fit[0], perr[0]))
-ax4.legend(loc='lower left')
-
-ax5.set_title("Modulation transfer function")
-ax5.set_xlim(0, 1.0)
-ax5.set_ylim(0, 1.0)
-ax5.plot(mtf_calc_w, mtf(mtf_calc_w, 0), '--', label='MTF(λ=0)', color='black')
-ax5.plot(mtf_calc_w, mtf_calc, color='orange', label='MTFg(λ=%.02f±%.02f)' % (fit[0], perr[0]))
-ax5.fill_between(mtf_calc_w, mtf_g(mtf_calc_w,  fit[0] - perr[0]), mtf_g(mtf_calc_w, fit[0] + perr[0]),
-                 facecolor='orange', alpha=0.5)
-ax5.legend(loc='lower left')
-ax5.grid()
-
-ax6.set_title("Raw edge spread function")
-ax6.scatter(distances, values, s=1)
-
-plt.show()
-
-if config.store is not None:
-    np.savez(config.store, w=mtf_calc_w, mtf=mtf_calc)
-
-
-# TODO: This is not a very clean way around the fact that this script should be refactored
+
+    return esf_meas, fit, perr, flat_mean, dark_mean
+
+
+def measure_esf(crop):
+    """Find the edge in the crop and construct the ESF. Returns a dict with the slope, intercept, distances and values"""
+    with profiling.stage('find_edge'):
+        slope, intercept, r_value = find_edge(crop)
+    print("R-squared-value: %f" % r_value ** 2)
+    print("Slope: %f (%0.10f degrees)" % (slope, math.degrees(math.atan(slope))))
+    print("Intercept: %f" % intercept)
+
+    with profiling.stage('esf'):
+        distance = edge_distance(slope, intercept, crop.shape[0], crop.shape[1])
+        distances, values = edge_spread(crop, distance)
+
+    return {
+        'slope': slope,
+        'intercept': intercept,
+        'r_value': r_value,
+        'distances': distances,
+        'values': values,
+    }
+
+
+def measure_mtf(im, x, y, width, height, super_res=1, esf_data=None):
+    """Measure the MTF from the edge in the crop of the image. Returns a dict with the results and intermediates.
+    Pass esf_data (from measure_esf) to skip the construction of the ESF, the image may then be None.
+    Raises RuntimeError when the ESF could not be fitted"""
+    # Take the crop of the image
+    area = np.s_[y:y + height, x:x + width]
+    crop = im[area] if im is not None else None
+
+    if esf_data is None:
+        esf_data = measure_esf(crop)
+    distances = esf_data['distances']
+    values = esf_data['values']
+
+    with profiling.stage('fit'):
+        esf_meas, fit, perr, flat_mean, dark_mean = fit_esf(distances, values)
+
+    # Print fits
+    print("Lambda (fit): %.05f±%.02f" % (fit[0], perr[0]))
+    print("x0 (fit): %.02f±%.02f" % (fit[1], perr[1]))
+
+    # Fitted MTF
+    # Overshooting 1, to make sure the value 1 is also included
+    mtf_calc_w = np.arange(0, 1.1, 0.01)
+    mtf_calc = mtf_g(mtf_calc_w, fit[0])
+
+    # Print half and nyquist values
+    print("MTF(0.25 Nyquist): %0.3f" % mtf_g(0.25, fit[0]))
+    print("MTF(0.5 Nyquist): %0.3f" % mtf_g(0.5, fit[0]))
+    print("MTF(1 Nyquist):   %0.3f" % mtf_g(1.0, fit[0]))
+
+    if super_res > 1:
+        print("Applying super res scaling to final curve")
+        mtf_calc_w = mtf_calc_w * super_res
+
+    return {
+        'roi': (x, y, width, height),
+        'crop': crop,
+        'slope': esf_data['slope'],
+        'intercept': esf_data['intercept'],
+        'r_value': esf_data.get('r_value'),
+        'distances': distances,
+        'values': values,
+        'flat_mean': flat_mean,
+        'dark_mean': dark_mean,
+        'esf': esf_meas,
+        'fit': fit,
+        'perr': perr,
+        'w': mtf_calc_w,
+        'mtf': mtf_calc,
+    }
+
+
+def plot_mtf(fig, im, result, title):
+    from matplotlib import patches
+
+    x, y, width, height = result['roi']
+    fit = result['fit']
+    perr = result['perr']
+    mtf_calc_w = result['w']
+    mtf_calc = result['mtf']
+
+    # Show total edge fit
+    edge_x_vals = np.arange(0, width)
+    edge_y_vals = result['intercept'] + result['slope'] * edge_x_vals
+    distance = edge_distance(result['slope'], result['intercept'], height, width)
+
+    # Calculate fitted ESF
+    x_fit = np.linspace(-10, 10, 1000)
+    esf_fit = esf(x_fit, *fit)
+
+    # Fitted LSF
+    lsf_fit = lsf(x_fit, *fit)
+
+    # Figure. Images and scatter plots are reduced to display resolution
+    ((ax0, ax1, ax2), (ax3, ax4, ax5), (ax6, ax7, ax8)) = fig.subplots(3, 3)
+    fig.suptitle(title)
+
+    # Show image
+    ax0.set_title("Full image")
+    report.image(ax0, im, origin='lower')
+    c = patches.Rectangle((x, y), width, height, linewidth=1, edgecolor='r', facecolor='none')
+    ax0.add_patch(c)
+
+    # Crop
+    ax1.set_title("Crop")
+    report.image(ax1, result['crop'], origin='lower')
+    ax1.plot(edge_x_vals, edge_y_vals, '--', color='orange')
+    ax1.set_xlim(0, width)
+    ax1.set_ylim(0, height)
+
+    # Distance
+    ax2.set_title("Distance")
+    report.image(ax2, distance, origin='lower')
+    ax2.plot(edge_x_vals, edge_y_vals, '--', color='orange')
+    ax2.set_xlim(0, width)
+    ax2.set_ylim(0, height)
+
+    ax3.set_title("Edge spread function (normalised)")
+    report.scatter(ax3, result['distances'], result['esf'], xlim=(fit[1] - 4, fit[1] + 4), color='blue',
+                   label='Measured')
+    ax3.plot(x_fit, esf_fit, color='orange', label='erfc(-x/(%.02f±%.02f))/2' % (fit[0], perr[0]))
+    ax3.plot(x_fit, esf(x_fit, 0.00001, fit[1]), '--', color='black', label='erfc(-x/(0.0))/2')
+    ax3.set_xlim(fit[1] - 4, fit[1] + 4)
+    ax3.legend(loc='lower right')
+
+    ax4.set_title("Line spread function (normalised)")
+    ax4.set_xlim(fit[1] - 4, fit[1] + 4)
+    ax4.plot(x_fit, lsf_fit / np.max(lsf_fit), color='orange', label='exp(-x^2/(%.02f±%.02f)^2)' % (fit[0], perr[0]))
+    ax4.legend(loc='lower left')
+
+    ax5.set_title("Modulation transfer function")
+    ax5.set_xlim(0, 1.0)
+    ax5.set_ylim(0, 1.0)
+    ax5.plot(mtf_calc_w, mtf(mtf_calc_w, 0), '--', label='MTF(λ=0)', color='black')
+    ax5.plot(mtf_calc_w, mtf_calc, color='orange', label='MTFg(λ=%.02f±%.02f)' % (fit[0], perr[0]))
+    ax5.fill_between(mtf_calc_w, mtf_g(mtf_calc_w,  fit[0] - perr[0]), mtf_g(mtf_calc_w, fit[0] + perr[0]),
+                     facecolor='orange', alpha=0.5)
+    ax5.legend(loc='lower left')
+    ax5.grid()
+
+    ax6.set_title("Raw edge spread function")
+    report.scatter(ax6, result['distances'], result['values'])
+
+
 def main():
-    pass
+    config = parse_arguments()
+    profiling.enable(config.profile)
+
+    im = None
+    cache_key = None
+    cached = None
+
+    simulated = config.FILE is None
+
+    if simulated and config.poisson:
+        from mtf_nps_dqe.lib import simulate
+
+        print("INFO: No image supplied, simulating edge with individual electrons")
+        super_res = 1
+
+        with profiling.stage('simulate'):
+            try:
+                kernel = np.load(config.psf_kernel) if config.psf_kernel is not None else None
+                im = simulate.simulate_edge(512, config.dose, config.psf_sigma, config.counting, seed=config.seed,
+                                            workers=config.workers, kernel=kernel)
+            except (OSError, ValueError) as e:
+                print("ERROR: %s" % e)
+                return 1
+
+        config.FILE = "Simulated (poisson, dose:{}, psf:{}, counting:{})".format(
+            config.dose,
+            config.psf_kernel or config.psf_sigma,
+            config.counting,
+        )
+    elif simulated:
+        print("INFO: No image supplied, simulating ideal edge")
+        super_res = config.sim_super_res
+
+        with profiling.stage('simulate'):
+            im = simulate_edge(config.factor, super_res, config.gauss, config.hann, config.bw, config.real, config.noise)
+
+        # Supply defaults
+        config.FILE = "Simulated (real:{}, gauss:{}, hann:{}, bw:{}, sim_super_res:{}, factor:{}, noise:{})".format(
+            config.real,
+            config.gauss,
+            config.hann,
+            config.bw,
+            config.sim_super_res,
+            config.factor,
+            config.noise
+        )
+
+    if simulated:
+        config.x = 128 * super_res
+        config.y = 128 * super_res
+        config.width = 256 * super_res
+        config.height = 256 * super_res
+    else:
+        roi = [config.x, config.y, config.width, config.height]
+        if config.cache is not None and None not in roi:
+            cache_key = cache.key('esf', config.FILE, rotate=config.rotate, roi=roi, super_res=config.super_res,
+                                  weight=config.weight, sum_frames=config.sum_frames)
+            cached = cache.load(config.cache, cache_key)
+
+        # The image is only needed for the ESF and the figure
+        if cached is None or not config.no_plot:
+            try:
+                with profiling.stage('read'):
+                    im = load_image(config.FILE, config.rotate, config.super_res, config.weight, config.sum_frames,
+                                    config.chunk, config.prefetch)
+            except ValueError as e:
+                print("ERROR: %s" % e)
+                return 1
+
+    # Downsampled levels of the image, shared by the ROI selector and the figure
+    preview = pyramid.Pyramid(im) if im is not None else None
+
+    if config.x is None or config.y is None or config.width is None or config.height is None:
+        config.x, config.y, config.width, config.height = select_roi(preview)
+        print(config)
+
+        if config.cache is not None:
+            cache_key = cache.key('esf', config.FILE, rotate=config.rotate,
+                                  roi=[config.x, config.y, config.width, config.height], super_res=config.super_res,
+                                  weight=config.weight, sum_frames=config.sum_frames)
+            cached = cache.load(config.cache, cache_key)
+
+    if cached is not None:
+        print("INFO: Using cached ESF")
+
+    try:
+        result = measure_mtf(im, config.x, config.y, config.width, config.height, config.super_res, cached)
+    except RuntimeError as e:
+        print("ERROR: Could not fit ESF. Message: '%s'" % e.__str__())
+        return 1
+
+    if cache_key is not None and cached is None:
+        cache.store(config.cache, cache_key, config.cache_size,
+                    **{k: result[k] for k in ('slope', 'intercept', 'r_value', 'distances', 'values')})
+
+    if simulated and config.poisson and config.psf_kernel is None:
+        # Validate against the MTF of the simulated PSF, integrated over the pixels
+        for f in (0.25, 0.5, 0.75, 1.0):
+            print("INFO: MTF at %.2f Nyquist: %.4f (theoretical %.4f)" % (
+                f, np.interp(f, result['w'], result['mtf']), simulate.theoretical_mtf(f, config.psf_sigma)))
+
+    if not config.no_plot:
+        with profiling.stage('plot'):
+            report.render(plot_mtf, preview, result, config.FILE, output=config.figure, figsize=(12, 10))
+
+    if config.store is not None:
+        np.savez(config.store, w=result['w'], mtf=result['mtf'])
+
+    if config.catalog is not None:
+        fit = result['fit']
+        perr = result['perr']
+        catalog.store_curve(config.catalog, 'mtf', result['w'], result['mtf'],
+                            label=config.name or os.path.basename(config.store or config.FILE),
+                            source=config.FILE,
+                            roi=[config.x, config.y, config.width, config.height],
+                            rotate=config.rotate,
+                            lam=fit[0], lam_err=perr[0], x0=fit[1], x0_err=perr[1],
+                            super_res=config.super_res)
+
+    with profiling.stage('figure'):
+        report.wait()
+
+    profiling.write()
+
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
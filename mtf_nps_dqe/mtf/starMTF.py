@@ -1,51 +1,186 @@
 import argparse
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
+from mtf_nps_dqe.lib import catalog
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('FILE', default=None, help="Input MTF .npz file")
-    parser.add_argument('--output', type=str, required=False, help='Output file (.star)')
+    parser.add_argument('FILE', nargs='+', help="Input MTF .npz file(s) (or label of the MTF curve when using --catalog, "
+                                                "or STAR files when using --reverse)")
+    parser.add_argument('--output', type=str, required=False, help='Output file (.star). Only for a single input')
+    parser.add_argument('--output_dir', type=str, required=False,
+                        help='Output directory for converting multiple inputs (default next to the input file)')
+    parser.add_argument('--catalog', type=str, required=False, help='Read the MTF curve from this catalog (.sqlite)')
+    parser.add_argument('--reverse', default=False, action='store_true',
+                        help='Convert STAR MTF files back into MTF curves (.npz files)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Number of files to convert in parallel')
 
     settings = parser.parse_args()
 
     return settings
 
 
-def star_mtf(filename):
-    r = "data_mtf\n"
-    r += "loop_\n"
-    r += "_rlnResolutionInversePixel\n"
-    r += "_rlnMtfValue\n"
-    r += "0 1\n"
+def read_star(filename):
+    """Lightweight parser for a STAR file with a single loop. Returns a dict of label -> column.
+
+    Also supports the files with all labels on the first line (as the published MTF files)"""
+    labels = []
+    rows = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or line.startswith('data_') or line == 'loop_':
+                continue
+
+            if line.startswith('_'):
+                # Label lines can have a column number after the label (_rlnMtfValue #2)
+                labels.extend(t for t in line.split() if t.startswith('_'))
+            else:
+                rows.append(line)
+
+    if len(labels) == 0:
+        raise ValueError("No labels in STAR file %s" % filename)
+
+    data = np.loadtxt(rows, ndmin=2)
+    if data.shape[1] != len(labels):
+        raise ValueError("Number of columns does not match the number of labels in STAR file %s" % filename)
+
+    return {label: data[:, idx] for idx, label in enumerate(labels)}
+
+
+def load_star_mtf(filename):
+    d = read_star(filename)
+
+    # Relion stores MTF as 1/pixel, and not as fraction of Nyquist
+    w = d['_rlnResolutionInversePixel'] * 2
+    mtf = d['_rlnMtfValue']
+
+    # The files of format_star start with a '0 1' row, followed by the w=0 point of the curve itself. Of repeated
+    # frequencies, keep the last row (of the curve)
+    _, idx = np.unique(w[::-1], return_index=True)
+    idx = len(w) - 1 - idx
+
+    return w[idx], mtf[idx]
+
+
+def load_mtf(filename, catalog_path=None):
+    if catalog_path is not None:
+        curves = catalog.select(catalog_path, 'mtf', filename)
+        if len(curves) == 0:
+            raise KeyError("No MTF curve with label '%s' in catalog" % filename)
+        # Take the most recently stored curve with this label
+        _, w, mtf, _ = curves[-1]
+        return w, mtf
 
     with np.load(filename) as data:
-        mtf = data['mtf']
-        # measureMTF stores the frequency as fraction of Nyquist. Relion wants 1/pixel, so divide frequency by 2.
-        w = data['w'] / 2
+        return data['w'], data['mtf']
+
+
+def format_star(w, mtf):
+    # measureMTF stores the frequency as fraction of Nyquist. Relion wants 1/pixel, so divide frequency by 2.
+    w = w / 2
+    sel = w <= 0.5
+    data = np.column_stack((w[sel], mtf[:np.count_nonzero(sel)]))
+
+    r = "data_mtf\n" \
+        "loop_\n" \
+        "_rlnResolutionInversePixel\n" \
+        "_rlnMtfValue\n" \
+        "0 1\n"
+
+    # Format all rows in one go, instead of row by row
+    return r + ("%.6f %.6f\n" * len(data)) % tuple(data.ravel())
+
+
+def star_mtf(filename, catalog_path=None):
+    w, mtf = load_mtf(filename, catalog_path)
 
-        for idx, fr in enumerate(w[w <= 0.5]):
-            r += "%.6f %.6f\n" % (fr, mtf[idx])
+    return format_star(w, mtf)
 
-    return r
+
+def output_name(filename, output_dir, ext):
+    base = os.path.splitext(os.path.basename(filename))[0] + ext
+    if output_dir is not None:
+        return os.path.join(output_dir, base)
+
+    return os.path.join(os.path.dirname(filename), base)
+
+
+def convert(filename, output, catalog_path=None, reverse=False):
+    if reverse:
+        w, mtf = load_star_mtf(filename)
+        np.savez(output, w=w, mtf=mtf)
+    else:
+        star = star_mtf(filename, catalog_path)
+        with open(output, "w") as f:
+            f.write(star)
+
+    return output
 
 
 def main():
     config = parse_arguments()
 
-    star = star_mtf(config.FILE)
+    ext = '.npz' if config.reverse else '.star'
+    inputs = config.FILE
+
+    # Expand label patterns to the labels in the catalog
+    if config.catalog is not None:
+        inputs = []
+        for pattern in config.FILE:
+            for row in catalog.query(config.catalog, kind='mtf', label=pattern):
+                if row['label'] not in inputs:
+                    inputs.append(row['label'])
+
+        if len(inputs) == 0:
+            print("ERROR: No matching MTF curves in catalog")
+            return 1
+
+    # Single input, without output directory, behaves as before: write to --output or print
+    if len(inputs) == 1 and config.output_dir is None:
+        if config.reverse:
+            convert(inputs[0], config.output or output_name(inputs[0], None, ext), reverse=True)
+            return 0
+
+        star = star_mtf(inputs[0], config.catalog)
+
+        if config.output is not None:
+            with open(config.output, "w") as f:
+                f.write(star)
+        else:
+            print(star)
+
+        return 0
 
     if config.output is not None:
-        with open(config.output, "w") as f:
-            f.write(star)
-    else:
-        print(star)
+        print("ERROR: Use --output_dir when converting multiple files")
+        return 1
 
-    return 0
+    if config.output_dir is not None:
+        os.makedirs(config.output_dir, exist_ok=True)
+
+    jobs = [(f, output_name(f, config.output_dir, ext)) for f in inputs]
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=config.jobs) as executor:
+        futures = [executor.submit(convert, f, output, config.catalog, config.reverse) for f, output in jobs]
+
+        for (f, output), future in zip(jobs, futures):
+            try:
+                future.result()
+                print("%s -> %s" % (f, output))
+            except (OSError, KeyError, ValueError) as e:
+                print("ERROR: Could not convert %s. Message: '%s'" % (f, e))
+                failed += 1
+
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
     sys.exit(main())
-
@@ -1,25 +1,66 @@
 import argparse
-import matplotlib.pyplot as plt
-import mrcfile
+import contextlib
+import functools
 import numpy as np
 import os
-from numpy.fft import fft2, fftshift
-from scipy.ndimage import gaussian_filter
-from scipy.optimize import curve_fit
-from skimage.transform import downscale_local_mean
+import sys
 
-from mtf_nps_dqe.lib import utils
+from mtf_nps_dqe.lib import utils, cache, catalog, events, parallel, profiling, report, stack
+from mtf_nps_dqe.lib.accumulator import NPSAccumulator, SlidingNPSAccumulator, METHODS
+from mtf_nps_dqe.lib.reader import FrameReader
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('FILE', nargs='?', help="Input image stack of flat fields (MRCs).  If none supplied, a stack will be simulated")
-    parser.add_argument('--super_res', default=1, type=int, help='Rescale the frequency of the measured NPS curve by this factor')
+    parser.add_argument('FILE', nargs='?', help="Input image stack of flat fields (MRC, compressed .mrc.gz/.mrc.bz2, or TIF) or event list (.npy, .npz or .h5).  If none supplied, a stack will be simulated")
+    parser.add_argument('--super_res', default=1, type=int,
+                        help='Rescale the frequency of the measured NPS curve by this factor. Event lists are binned at this super resolution')
     parser.add_argument('--store', type=str, help='Store output measured MTF curve')
+    parser.add_argument('--catalog', type=str, help='Store output measured NPS curve in this catalog (.sqlite)')
+    parser.add_argument('--name', type=str, help='Label to store with measured NPS curve in the catalog (default basename of file)')
     parser.add_argument('--crop', default=0, type=int, help='Crop the image to this (power of 2) size. This helps with NPS(0) estimates.')
+    parser.add_argument('--tile', type=int,
+                        help='Measure the NPS of every tile of this (power of 2) size separately, and map the results')
+    parser.add_argument('--sectors', default=0, type=int,
+                        help='Also calculate the NNPS in this number of angular sectors, and along the row and column axis')
     parser.add_argument('--guess', default=False, action='store_true',
                         help='Use guessed NPS(0) opposed to fitted NPS(0). Sometimes the fitting is bad.')
+    parser.add_argument('--method', default='mean', choices=METHODS.keys(),
+                        help='Remove the fixed pattern by subtracting the mean of all frames, or by taking differences of consecutive frames')
+    parser.add_argument('--validate', default=False, action='store_true',
+                        help='Also measure the NNPS with the other method (in the same pass), and compare')
+    parser.add_argument('--window', type=int,
+                        help='Follow the NNPS and NPS(0) over the stack, in a window of this number of frames sliding over the stack')
+    parser.add_argument('--step', default=1, type=int, help='Number of frames between sliding windows (with --window)')
+    parser.add_argument('--save_2d', type=str, metavar='DIR',
+                        help='Store the 2D NPS, mean frame and NPS(0) measurements in this directory, for re-analysis with reanalyseNPS')
+    parser.add_argument('--no_plot', default=False, action='store_true', help='Do not show the diagnostic figure')
+    parser.add_argument('--figure', type=str,
+                        help='Save the diagnostic figure to this file (drawn in the background), instead of showing it')
+    parser.add_argument('--profile', type=str, help='Write a report with the time and memory use of each stage (.json or .csv)')
+    parser.add_argument('--cache', nargs='?', const=cache.DEFAULT_DIR, type=str,
+                        help='Cache the 2D NPS and NPS(0) measurements of the input in this directory (default %s)' % cache.DEFAULT_DIR)
+    parser.add_argument('--cache_size', default=cache.DEFAULT_SIZE, type=int, help='Maximum size of the cache (MB)')
+    parser.add_argument('--chunk', default=16, type=int, help='Number of frames to read at once')
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Number of processes to accumulate the NPS with (default 1), and to simulate with (with --poisson, default all cores)")
+    parser.add_argument('--prefetch', default=2, type=int,
+                        help='Number of chunks to read ahead on a background thread, while processing (0 to disable)')
+
+    partial_group = parser.add_argument_group('partial measurements')
+    partial_group.add_argument('--start', default=0, type=int, help='Index of the first frame to process')
+    partial_group.add_argument('--stop', default=None, type=int, help='Index of the frame to stop processing at (exclusive)')
+    partial_group.add_argument('--partial', type=str, help='Only store the partial sums of the processed frames to this file (.npz)')
+    partial_group.add_argument('--merge', nargs='+', type=str, help='Merge partial sums (.npz files) instead of processing a FILE')
+    partial_group.add_argument('--checkpoint', type=str,
+                               help='Periodically store the partial sums to this file (.npz), and resume from it when it exists')
+    partial_group.add_argument('--checkpoint_every', default=50, type=int, help='Number of frames between checkpoints')
+
+    event_group = parser.add_argument_group('event lists')
+    event_group.add_argument('--frame_time', type=float, help='Time per frame when binning events into frames (in units of the event time)')
+    event_group.add_argument('--weight', default='counts', choices=['counts', 'tot'],
+                             help='Count every event once, or weigh events by their time over threshold')
 
     sim_group = parser.add_argument_group('simulate')
     sim_group.add_argument('--gauss', type=float, default=0, help="Gaussian sigma used for blurring of image")
@@ -28,6 +69,16 @@ def parse_arguments():
     sim_group.add_argument('--sim_super_res', type=int, default=1, help="Simulate super res factor")
     sim_group.add_argument('--factor', type=int, default=1, help="Initial upscale factor")
     sim_group.add_argument('--real', default=False, action='store_true', help="Perform operations in real space")
+    sim_group.add_argument('--poisson', default=False, action='store_true',
+                           help="Simulate individual electrons (Poisson arrivals, spread by a Gaussian or given PSF)")
+    sim_group.add_argument('--dose', type=float, default=1.0, help="Electrons per pixel per frame (with --poisson)")
+    sim_group.add_argument('--psf_sigma', type=float, default=0.0, help="Sigma of the Gaussian PSF in pixels (with --poisson)")
+    sim_group.add_argument('--psf_kernel', type=str,
+                           help="PSF kernel (.npy) sampled at 16 points per pixel, instead of a Gaussian (with --poisson)")
+    sim_group.add_argument('--counting', default=False, action='store_true',
+                           help="Count every electron once, instead of integrating its charge (with --poisson)")
+    sim_group.add_argument('--n_frames', type=int, default=100, help="Number of frames to simulate")
+    sim_group.add_argument('--seed', type=int, default=None, help="Seed of the random number generator (with --poisson)")
 
     settings = parser.parse_args()
 
@@ -39,96 +90,105 @@ def nps0_fit(x, a, b):
     return a*x/(x+b)
 
 
-def power_spectrum(d):
-    # Take the fourier transform of the image.
-    f1 = fft2(d)
-
-    # Now shift the quadrants around so that low spatial frequencies are in
-    # the center of the 2D fourier transformed image.
-    f2 = fftshift(f1)
-
-    # Take the absolute squared to create a power spectrum
-    psd2D = np.abs(f2) ** 2
-
-    return psd2D
-
-
-def radial_profile(data):
+def radial_profile(data, mask=None):
     y, x = np.indices(data.shape)
     center = tuple(int(s / 2) for s in data.shape)
     r = np.sqrt((x - center[0]) ** 2 + (y - center[1]) ** 2)
     r = r.astype(int)
 
-    tbin = np.bincount(r.ravel(), data.ravel())
-    nr = np.bincount(r.ravel())
+    if mask is None:
+        tbin = np.bincount(r.ravel(), data.ravel())
+        nr = np.bincount(r.ravel())
 
-    return tbin / nr
+        return tbin / nr
 
+    # Only use the pixels in the mask
+    n_r = r.max() + 1
+    tbin = np.bincount(r[mask], data[mask], minlength=n_r)
+    nr = np.bincount(r[mask], minlength=n_r)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return tbin / nr
 
-def calculate_nnps(nps, nps0):
-    return np.divide(nps, nps0)
 
+def dc_cross_mask(shape, width=1):
+    """Mask (True for the pixels to use) excluding the central row and column (the DC cross) of a shifted 2D NPS"""
+    y, x = np.indices(shape)
+    center = tuple(int(s / 2) for s in shape)
 
-def calculate_nps0(frames, mean):
-    r = list()
+    return (np.abs(x - center[0]) >= width) & (np.abs(y - center[1]) >= width)
 
-    # Calculate the bin factors to measure. Do this as power of 2, to
-    factors = 2**np.arange(1, np.log2(mean.shape[0]), dtype=int)
 
-    # Limit the bin factors to measure not too small image sizes
-    factors = factors[0:-2]
+def directional_profiles(data, n_sectors, mask=None):
+    """Radial profiles of n_sectors angular sectors (folded over 180 degrees, starting at the x axis), and the profiles
+    along the row (x) and column (y) axis. Computed in a single bincount, with combined sector and radius bins. Returns
+    the sector profiles (n_sectors x radius), the row and column profiles, and the azimuthal average"""
+    y, x = np.indices(data.shape)
+    center = tuple(int(s / 2) for s in data.shape)
+    dx = x - center[0]
+    dy = y - center[1]
+    r = np.sqrt(dx ** 2 + dy ** 2).astype(int).ravel()
+    n_r = r.max() + 1
 
-    for frame in frames:
-        # Subtract mean from the frame
-        f = frame - mean
+    angle = np.mod(np.arctan2(dy, dx), np.pi).ravel()
+    sector = np.minimum((angle / np.pi * n_sectors).astype(int), n_sectors - 1)
 
-        for factor in factors:
-            # b = 1/factor
+    # The axis profiles are two extra 'sectors', of only the pixels on the axes
+    row = (dy == 0).ravel()
+    col = (dx == 0).ravel()
+    if mask is not None:
+        # Give the masked pixels a bin past the last
+        sector = np.where(mask.ravel(), sector, n_sectors + 2)
+        row &= mask.ravel()
+        col &= mask.ravel()
+    index = np.concatenate([sector * n_r + r, n_sectors * n_r + r[row], (n_sectors + 1) * n_r + r[col]])
+    values = data.ravel()
+    weights = np.concatenate([values, values[row], values[col]])
 
-            # Bin the frame using the mean of the surrounding pixels
-            # binned = downscale_local_mean(f, (factor, factor), cval=np.mean(f))
+    n_bins = (n_sectors + 2) * n_r
+    tbin = np.bincount(index, weights, minlength=n_bins)[:n_bins].reshape(n_sectors + 2, n_r)
+    nr = np.bincount(index, minlength=n_bins)[:n_bins].reshape(n_sectors + 2, n_r)
 
-            # Bin the frame using fourier cropping
-            binned = utils.ift(utils.bin_mic_ft(utils.ft(f), 1, 1/(factor*2), mic_freqs=utils.get_mic_freqs(f, 1)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        profiles = tbin / nr
+        average = tbin[:n_sectors].sum(axis=0) / nr[:n_sectors].sum(axis=0)
 
-            # Calculate the variance
-            sigma_squared = np.var(binned)
+    return profiles[:n_sectors], profiles[n_sectors], profiles[n_sectors + 1], average
 
-            # McMullan et al. 2009 and Paton et al. 2021
-            nps0 = sigma_squared/factor**2
 
-            # print("shape: %s, factor: %d, b: %.2f, var: %s, nps0: %.5f" % (binned.shape, factor, b, sigma_squared, nps0))
+def anisotropy(sector_nnps, w, low=0.1, high=1.0):
+    """Mean NNPS of each sector between low and high (fraction of Nyquist), and the relative spread between sectors"""
+    band = (w >= low) & (w <= high)
+    means = np.nanmean(sector_nnps[:, band], axis=1)
 
-            r.append([factor, nps0])
+    return means, (np.max(means) - np.min(means)) / np.mean(means)
 
-    return np.array(r)
 
+def calculate_nnps(nps, nps0):
+    return np.divide(nps, nps0)
 
-# Read config
-config = parse_arguments()
 
-if config.FILE is None:
-    print("INFO: No image supplied, simulating flat fields")
-    factor = config.factor
-    super_res = config.sim_super_res
-    org_shape = 512
-    shape = 512 * factor
-    gauss = config.gauss
+def simulate_flat_fields(n_frames=100, factor=1, super_res=1, gauss=0, hann=False, bw=False, real=False, org_shape=512):
+    """Simulate a stack of flat field exposures"""
+    shape = org_shape * factor
 
     # Keep illumination constant, when changing factor
     ill = 100 / factor**2
     ill_noise = 10/factor**2
 
     # Simulate flat fields
-    frames = np.random.normal(ill, ill_noise, (100, shape, shape)).astype(np.uint8)
+    frames = np.random.normal(ill, ill_noise, (n_frames, shape, shape)).astype(np.uint8)
 
     # Do operations in real space or fourier space
-    if config.real:
-        if config.gauss > 0:
+    if real:
+        from scipy.ndimage import gaussian_filter
+        from skimage.transform import downscale_local_mean
+
+        if gauss > 0:
             frames = gaussian_filter(frames, (0, gauss * factor, gauss * factor))
 
         # Bin
-        if config.factor > 1:
+        if factor > 1:
             frames = downscale_local_mean(frames, (0, factor // super_res, factor // super_res))
     else:
         # FFT
@@ -141,142 +201,707 @@ if config.FILE is None:
             ft_frames = ft_frames * fg
 
         # Fourier crop (bin)
-        if config.factor > 1:
+        if factor > 1:
             mic_freqs = utils.get_mic_freqs(frames[0], 1 / factor)
-            ft_frames = utils.bin_mic_ft(ft_frames, 1 / factor, super_res / 2, mic_freqs=mic_freqs, lp=config.bw)
+            ft_frames = utils.bin_mic_ft(ft_frames, 1 / factor, super_res / 2, mic_freqs=mic_freqs, lp=bw)
 
-        if config.hann:
+        if hann:
             fh = utils.get_hann_filter(org_shape*super_res)
             ft_frames = ft_frames * fh
 
         # Inverse FFT
         frames = utils.ift(ft_frames)
 
-    # Calculate the mean of all pixels
-    mean = np.mean(frames, axis=0)
-
-    config.FILE = "Simulated (real:{}, gauss:{}, hann:{}, bw:{}, sim_super_res:{}, factor:{})".format(
-        config.real,
-        config.gauss,
-        config.hann,
-        config.bw,
-        config.sim_super_res,
-        config.factor,
-    )
-else:
-    # TODO: Support reading a tif stack
-    with mrcfile.open(config.FILE, mode='r') as f:
-        if config.crop > 0:
-            frames = f.data[1:-1, 0:config.crop, 0:config.crop]
+    return frames
+
+
+@contextlib.contextmanager
+def open_frames(filename, crop=0, frame_time=None, super_res=1, weight='counts'):
+    """Open a stack (skipping the first and last frame of the file) or event list. Yields a function read(start, stop)
+    that returns the frames start:stop. For an uncompressed MRC stack this is a memory mapped slice, which is read
+    when used."""
+    if events.is_event_file(filename):
+        if frame_time is None:
+            raise ValueError('A frame time is required to bin events into frames')
+
+        # The event file is opened, and the frame boundaries found, only once for all chunks
+        with events.open_frames(filename, frame_time, super_res, weight) as (read_events, n_frames):
+            def read(start, stop):
+                frames = read_events(start, stop)
+                return frames[:, 0:crop, 0:crop] if crop > 0 else frames
+
+            yield read
+        return
+
+    with stack.open_stack(filename) as (read_stack, n_frames):
+        def read(start, stop):
+            stop = n_frames - 2 if stop is None else min(stop, n_frames - 2)
+            data = read_stack(start + 1, max(start, stop) + 1)
+            return data[:, 0:crop, 0:crop] if crop > 0 else data
+
+        yield read
+
+
+def load_frames(filename, crop=0, start=0, stop=None, frame_time=None, super_res=1, weight='counts'):
+    """Read the frames start:stop of a stack (skipping the first and last frame of the file), or bin the frames
+    start:stop from an event list"""
+    with open_frames(filename, crop, frame_time, super_res, weight) as read:
+        frames = np.array(read(start, stop))
+        profiling.add_bytes_read(frames.nbytes)
+
+    return frames
+
+
+def save_nps_2d(directory, nps, nps0_meas, mean, first, n_frames, **meta):
+    """Store the 2D NPS and the intermediates needed to re-analyse it, as .npy files that can be memory mapped"""
+    import json
+
+    os.makedirs(directory, exist_ok=True)
+    for name, data in (('nps', nps), ('nps0', nps0_meas), ('mean', mean), ('first', first)):
+        np.save(os.path.join(directory, name + '.npy'), np.asarray(data))
+
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(dict(meta, frames=int(n_frames)), f, indent=2)
+
+
+def load_nps_2d(directory):
+    """Load a stored 2D NPS (memory mapped). Returns a dict with nps, nps0, mean, first and the meta data"""
+    import json
+
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+
+    d = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in ('nps', 'nps0', 'mean', 'first')}
+    d['meta'] = meta
+
+    return d
+
+
+def save_checkpoint(acc, filename):
+    # Write to a temporary file first, so an interruption never leaves a broken checkpoint
+    tmp = filename + '.tmp.npz'
+    acc.save(tmp)
+    os.replace(tmp, filename)
+
+
+def new_accumulator(shape, tile=None, method='mean'):
+    """Accumulator of method (see METHODS) for frames of shape. With tile, the sums are kept for every tile of
+    tile x tile pixels"""
+    if tile:
+        return METHODS[method]((tile, tile), (shape[0] // tile, shape[1] // tile))
+
+    return METHODS[method](shape)
+
+
+def accumulate_nps(frames, acc=None, start=0, checkpoint=None, checkpoint_every=0, tile=None, method='mean'):
+    """Add frames (with index start:) to the partial sums for the NPS and NPS(0) of method (see METHODS). With tile,
+    the sums are kept for every tile of tile x tile pixels. Returns the accumulator"""
+    with profiling.stage('accumulate'):
+        for idx, frame in enumerate(frames):
+            if acc is None:
+                acc = new_accumulator(frame.shape, tile, method)
+
+            acc.add(frame, start + idx)
+
+            if checkpoint is not None and checkpoint_every > 0 and acc.n % checkpoint_every == 0:
+                save_checkpoint(acc, checkpoint)
+
+    return acc
+
+
+def accumulate_parallel(read, start=0, stop=None, workers=2, chunk=16, prefetch=2, tile=None, method='mean',
+                        validate=False):
+    """Accumulate the frames start:stop, read with read(start, stop), on workers processes (see lib/parallel.py).
+    Returns the accumulator, and with validate the accumulator of the other method (otherwise None)"""
+    factories = [functools.partial(new_accumulator, tile=tile, method=method)]
+    if validate:
+        factories.append(functools.partial(new_accumulator, method=other_method(method)))
+
+    with profiling.stage('accumulate'):
+        accs = parallel.accumulate(read, factories, start, stop, workers, chunk, prefetch)
+
+    if accs is None:
+        return None, None
+
+    return accs[0], accs[1] if validate else None
+
+
+def nps_spectra(acc):
+    """Calculate the 2D NPS and the NPS(0) as function of the binning factor from the partial sums"""
+    with profiling.stage('reduce'):
+        return acc.nps(), acc.nps0()
+
+
+def analyse_nps(nps, nps0_meas, guess=False, super_res=1, sectors=0, mask=None, nps0=None):
+    """Estimate NPS(0) and calculate the NNPS from the 2D NPS. Returns a dict with the results and intermediates.
+    Only the pixels in mask are used for the profiles. A given nps0 is used instead of the estimate"""
+    from scipy.optimize import curve_fit
+
+    nps_1d = radial_profile(nps, mask)
+
+    # Make an initial guess for the fitting, by taking the first 10% of the data as NPS(0)
+    # Skip the 0 frequency here, as it may contain a large peak which throws off the guessing.
+    nps0_g = np.nanmean(nps_1d[1:int(len(nps_1d)*0.1)])
+    print("Guessed NPS(0): %0.2f" % nps0_g)
+    fit_guess = [nps0_g, 1]
+    fit_bounds = ([nps0_g - nps0_g*0.5, 0], [nps0_g + nps0_g*0.5, np.inf])
+    print(fit_bounds)
+
+    # Fit
+    with profiling.stage('fit'):
+        fit, pcov = curve_fit(nps0_fit, nps0_meas[:, 0], nps0_meas[:, 1], maxfev=100000, p0=fit_guess, bounds=fit_bounds)
+    nps0_f = fit[0]
+    print("Fitted NPS(0): %0.2f" % nps0_f)
+
+    # Used fitted NPS(0)
+    if nps0 is not None:
+        print("Using given NPS(0): %0.2f" % nps0)
+    elif guess:
+        nps0 = nps0_g
+    else:
+        nps0 = nps0_f
+
+    # Normalize the NPS using the selected NPS(0)
+    nnps = calculate_nnps(nps, nps0)
+
+    # Take the radial profile to create a 1D NPS. Optionally also the profiles of angular sectors, which show
+    # anisotropic noise (such as from the readout direction or chip boundaries)
+    with profiling.stage('radial_profile'):
+        if sectors > 0:
+            sector_nnps, row_nnps, col_nnps, nnps_1d = directional_profiles(nnps, sectors, mask)
         else:
-            frames = f.data[1:-1]
-
-        # Calculate the mean of all pixels
-        mean = np.mean(frames, axis=0)
-
-ps = np.zeros_like(mean)
-for frame in frames:
-    # Calculate the power spectrum of the frame minus the mean of the frames
-    sub = power_spectrum(frame-mean)
-    ps += sub
-
-# Calculate the 2D NPS by taking the average of all individual NPS, and dividing by the number of pixels
-# Paton 2021 et al. (eq 2)
-nps = ps/len(frames)/(mean.shape[0]*mean.shape[1])
-nps_1d = radial_profile(nps)
-
-# Calculate NPS(0) as function of the binning factor
-nps0_meas = calculate_nps0(frames, mean)
-
-# Make an initial guess for the fitting, by taking the first 10% of the data as NPS(0)
-# Skip the 0 frequency here, as it may contain a large peak which throws off the guessing.
-nps0_g = np.mean(nps_1d[1:int(len(nps_1d)*0.1)])
-print("Guessed NPS(0): %0.2f" % nps0_g)
-fit_guess = [nps0_g, 1]
-fit_bounds = ([nps0_g - nps0_g*0.5, 0], [nps0_g + nps0_g*0.5, np.inf])
-print(fit_bounds)
-
-# Fit
-fit, pcov = curve_fit(nps0_fit, nps0_meas[:, 0], nps0_meas[:, 1], maxfev=100000, p0=fit_guess, bounds=fit_bounds)
-nps0_f = fit[0]
-x_fit = np.arange(0, np.max(nps0_meas[:, 0])+1)
-print("Fitted NPS(0): %0.2f" % nps0_f)
-
-# Used fitted NPS(0)
-if config.guess:
-    nps0 = nps0_g
-else:
-    nps0 = nps0_f
-
-# Normalize the NPS using the selected NPS(0)
-nnps = calculate_nnps(nps, nps0)
-
-# Take the radial profile to create a 1D NPS
-nnps_1d = radial_profile(nnps)
-
-# Calculate nyquist frequency from the image shape
-nyquist = mean.shape[0]/2
-max_x = np.sqrt((nnps.shape[0]/2)**2 + (nnps.shape[0]/2)**2)
-w = np.linspace(0, max_x/nyquist, len(nnps_1d))
-
-if config.super_res > 1:
-    print("Applying super res scaling to final curve")
-    w = w * config.super_res
-
-# Figures
-fig, ((ax0, ax1, ax2), (ax3, ax4, ax5)) = plt.subplots(2, 3)
-fig.suptitle(config.FILE)
-
-# Individual frame
-im = ax0.imshow(frames[0])
-fig.colorbar(im, ax=ax0, orientation='vertical')
-ax0.set_title("First frame")
-
-# Subtraction
-im = ax1.imshow(frames[0] - mean)
-fig.colorbar(im, ax=ax1, orientation='vertical')
-ax1.set_title("First frame minus mean of frames")
-
-# Power spectrum
-im = ax2.imshow(nps)
-fig.colorbar(im, ax=ax2, orientation='vertical')
-ax2.set_title("Noise Power Spectrum (NPSdig)")
-
-# Calculating NPS(0)
-ax3.scatter(nps0_meas[:, 0], nps0_meas[:, 1], label='Measured')
-ax3.hlines(y=nps0_g, xmin=0, xmax=np.max(nps0_meas[:, 0]), color='r', label='NPS(0) (10%)')
-ax3.hlines(y=nps0_f, xmin=0, xmax=np.max(nps0_meas[:, 0]), color='orange', label='NPS(0) (fitted)')
-ax3.plot(x_fit, nps0_fit(x_fit, *fit), color='orange', label='%.02f*x/(x+%0.2f)' % (fit[0], fit[1]))
-ax3.set_ylim(0)
-ax3.set_xlabel("Factor")
-ax3.set_ylabel("NPS(0)")
-ax3.legend(loc='lower right')
-ax3.set_title("Estimating NPS(0)")
-
-im = ax4.imshow(nnps, vmax=1)
-fig.colorbar(im, ax=ax4, orientation='vertical')
-ax4.set_title("Normalised 2D noise power spectrum")
-
-# Normalised NPS
-ax5.plot(w, nnps_1d, label=os.path.basename(config.FILE))
-ax5.set_xlim([0, 1])
-ax5.set_ylim([0, 1.1])
-ax5.set_xlabel("Spatial frequency (fraction of Nyquist)")
-ax5.set_ylabel("Normalised noise power spectrum")
-ax5.set_title("Normalised 1D noise power spectrum")
-ax5.set_aspect('equal', adjustable='box')
-ax5.grid()
-
-plt.show()
-
-if config.store is not None:
-    np.savez(config.store, w=w, nps=nnps_1d)
-
-
-# TODO: This is not a very clean way around the fact that this script should be refactored
+            nnps_1d = radial_profile(nnps, mask)
+
+    # Calculate nyquist frequency from the image shape
+    nyquist = nps.shape[0]/2
+    max_x = np.sqrt((nnps.shape[0]/2)**2 + (nnps.shape[0]/2)**2)
+    w = np.linspace(0, max_x/nyquist, len(nnps_1d))
+
+    if super_res > 1:
+        print("Applying super res scaling to final curve")
+        w = w * super_res
+
+    directional = {}
+    if sectors > 0:
+        sector_means, spread = anisotropy(sector_nnps, w)
+        for idx, m in enumerate(sector_means):
+            print("NNPS sector %d-%d degrees (0.1-1 Nyquist): %0.3f" % (idx * 180 / sectors, (idx + 1) * 180 / sectors,
+                                                                      m))
+        print("NNPS anisotropy: %0.3f" % spread)
+
+        directional = {
+            'sector_angles': (np.arange(sectors) + 0.5) * 180 / sectors,
+            'sector_nnps': sector_nnps,
+            'row_nnps': row_nnps,
+            'col_nnps': col_nnps,
+            'anisotropy': spread,
+        }
+
+    return {
+        'nps': nps,
+        'nps0_meas': nps0_meas,
+        'nps0_guess': nps0_g,
+        'nps0_fit': fit,
+        'nps0': nps0,
+        'nnps': nnps,
+        'w': w,
+        'nnps_1d': nnps_1d,
+        **directional,
+    }
+
+
+def measure_nps(frames, guess=False, super_res=1, sectors=0, method='mean'):
+    """Measure the NNPS of a stack of flat fields. Returns a dict with the results and intermediates"""
+    nps, nps0_meas = nps_spectra(accumulate_nps(frames, method=method))
+
+    return analyse_nps(nps, nps0_meas, guess, super_res, sectors)
+
+
+def other_method(method):
+    return 'difference' if method == 'mean' else 'mean'
+
+
+def validate_nps(result, reference, guess=False, super_res=1):
+    """Compare the NNPS with that of the other method, accumulated over the same frames. Adds the reference NNPS
+    curve to the result"""
+    nps, nps0_meas = nps_spectra(reference)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        ref = analyse_nps(nps, nps0_meas, guess, super_res)
+
+    band = (result['w'] > 0) & (result['w'] <= super_res)
+    diff = np.abs(result['nnps_1d'] - ref['nnps_1d'])[band]
+    nps0 = {other_method(reference.method): result['nps0'], reference.method: ref['nps0']}
+    print("Validation: NPS(0) %0.2f (%s) vs %0.2f (%s)" % (result['nps0'], other_method(reference.method), ref['nps0'],
+                                                          reference.method))
+    # Subtracting the mean of n frames also removes 1/n of the noise power
+    print("Validation: NPS(0) ratio mean/difference %0.3f (expected (n-1)/n = %0.3f)" % (
+        nps0['mean'] / nps0['difference'], (reference.n - 1) / reference.n))
+    print("Validation: NNPS difference up to Nyquist: max %0.4f, mean %0.4f" % (np.nanmax(diff), np.nanmean(diff)))
+
+    result['reference_nnps'] = ref['nnps_1d']
+    result['reference_method'] = reference.method
+
+
+def analyse_tiles(nps, nps0_meas, mean, grid, guess=False, super_res=1):
+    """Estimate NPS(0) and calculate the NNPS of every tile. Returns a dict with the NNPS curves of the tiles, and maps
+    of the mean signal, NPS(0), NNPS(0.5 Nyquist) and DQE(0) relative to the median tile"""
+    # The output of every tile is not useful
+    with profiling.stage('analyse_tiles'), open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results = [analyse_nps(nps[t], nps0_meas[t], guess, super_res) for t in range(len(nps))]
+
+    w = results[0]['w']
+    nnps_tiles = np.array([r['nnps_1d'] for r in results])
+    signal_map = np.mean(mean, axis=(-2, -1)).reshape(grid)
+    nps0_map = np.array([r['nps0'] for r in results]).reshape(grid)
+    nnps_half_map = np.array([np.interp(0.5, w, c) for c in nnps_tiles]).reshape(grid)
+
+    # At the same dose, DQE(0) is proportional to mean^2/NPS(0)
+    dqe0 = signal_map ** 2 / nps0_map
+    dqe0_rel_map = dqe0 / np.median(dqe0)
+
+    print("NPS(0) of tiles: %0.2f - %0.2f" % (np.min(nps0_map), np.max(nps0_map)))
+    print("Relative DQE(0) of tiles: %0.3f - %0.3f" % (np.min(dqe0_rel_map), np.max(dqe0_rel_map)))
+
+    return {
+        'w': w,
+        'nnps_tiles': nnps_tiles,
+        'nnps_1d': np.mean(nnps_tiles, axis=0),
+        'signal_map': signal_map,
+        'nps0_map': nps0_map,
+        'nnps_half_map': nnps_half_map,
+        'dqe0_rel_map': dqe0_rel_map,
+    }
+
+
+def sliding_nps(chunks, window, step=1, guess=False, super_res=1):
+    """NNPS and NPS(0) of a window of frames, sliding over the stack every step frames. Chunks yields (start, frames).
+    Returns a dict with the index of the last frame of every window, the frequencies, the NNPS of every window
+    (window x frequency), and the NPS(0) and mean signal of every window"""
+    acc = None
+    seen = 0
+    rows = []
+
+    with profiling.stage('sliding'), open(os.devnull, 'w') as devnull:
+        for start, frames in chunks:
+            for idx, frame in enumerate(frames):
+                if acc is None:
+                    acc = SlidingNPSAccumulator(frame.shape, window)
+                acc.add(frame, start + idx)
+                seen += 1
+
+                if not acc.full() or (seen - window) % step != 0:
+                    continue
+
+                # The output of every window is not useful
+                try:
+                    with contextlib.redirect_stdout(devnull):
+                        r = analyse_nps(acc.nps(), acc.nps0(), guess, super_res)
+                except RuntimeError:
+                    r = {'nnps_1d': np.nan, 'nps0': np.nan}
+                rows.append((start + idx, r.get('w'), r['nnps_1d'], r['nps0'], acc.signal()))
+
+    if not rows:
+        return None
+
+    w = next(r[1] for r in rows if r[1] is not None)
+    nnps = np.full((len(rows), len(w)), np.nan)
+    for idx, row in enumerate(rows):
+        nnps[idx] = row[2]
+
+    return {
+        'frames': np.array([r[0] for r in rows]),
+        'w': w,
+        'nnps': nnps,
+        'nps0': np.array([r[3] for r in rows]),
+        'signal': np.array([r[4] for r in rows]),
+    }
+
+
+def plot_sliding(fig, result, window, title):
+    (ax0, ax1, ax2) = fig.subplots(1, 3)
+    fig.suptitle(title)
+
+    frames, w = result['frames'], result['w']
+    nnps, _ = report.downsample(result['nnps'])
+    im = ax0.imshow(nnps, origin='lower', aspect='auto', vmin=0, vmax=1.1, interpolation='nearest',
+                    extent=(w[0], w[-1], frames[0], frames[-1]))
+    fig.colorbar(im, ax=ax0, orientation='vertical')
+    ax0.set_xlim([0, 1])
+    ax0.set_xlabel("Spatial frequency (fraction of Nyquist)")
+    ax0.set_ylabel("Last frame of window")
+    ax0.set_title("NNPS (window of %d frames)" % window)
+
+    ax1.plot(frames, result['nps0'])
+    ax1.set_xlabel("Last frame of window")
+    ax1.set_ylabel("NPS(0)")
+    ax1.set_title("NPS(0)")
+    ax1.grid()
+
+    ax2.plot(frames, result['signal'])
+    ax2.set_xlabel("Last frame of window")
+    ax2.set_ylabel("Mean signal per pixel")
+    ax2.set_title("Signal")
+    ax2.grid()
+
+
+def plot_tiles(fig, result, title):
+    ((ax0, ax1), (ax2, ax3)) = fig.subplots(2, 2)
+    fig.suptitle(title)
+
+    for ax, key, label in ((ax0, 'signal_map', "Mean signal"), (ax1, 'nps0_map', "NPS(0)"),
+                           (ax2, 'dqe0_rel_map', "DQE(0) relative to median tile")):
+        im = ax.imshow(result[key])
+        fig.colorbar(im, ax=ax, orientation='vertical')
+        ax.set_title(label)
+
+    for curve in result['nnps_tiles']:
+        ax3.plot(result['w'], curve, color='grey', linewidth=0.5)
+    ax3.plot(result['w'], result['nnps_1d'], color='black', label='Mean of tiles')
+    ax3.set_xlim([0, 1])
+    ax3.set_ylim([0, 1.1])
+    ax3.set_xlabel("Spatial frequency (fraction of Nyquist)")
+    ax3.set_ylabel("Normalised noise power spectrum")
+    ax3.set_title("NNPS of tiles")
+    ax3.legend(loc='lower left')
+    ax3.grid()
+
+
+def plot_nps(fig, first, mean, result, title, label):
+    nps0_meas = result['nps0_meas']
+    fit = result['nps0_fit']
+    x_fit = np.arange(0, np.max(nps0_meas[:, 0])+1)
+
+    # Figures. Images are reduced to display resolution
+    ((ax0, ax1, ax2), (ax3, ax4, ax5)) = fig.subplots(2, 3)
+    fig.suptitle(title)
+
+    # Individual frame
+    im = report.image(ax0, first)
+    fig.colorbar(im, ax=ax0, orientation='vertical')
+    ax0.set_title("First frame")
+
+    # Subtraction
+    im = report.image(ax1, first - mean)
+    fig.colorbar(im, ax=ax1, orientation='vertical')
+    ax1.set_title("First frame minus mean of frames")
+
+    # Power spectrum
+    im = report.image(ax2, result['nps'])
+    fig.colorbar(im, ax=ax2, orientation='vertical')
+    ax2.set_title("Noise Power Spectrum (NPSdig)")
+
+    # Calculating NPS(0)
+    ax3.scatter(nps0_meas[:, 0], nps0_meas[:, 1], label='Measured')
+    ax3.hlines(y=result['nps0_guess'], xmin=0, xmax=np.max(nps0_meas[:, 0]), color='r', label='NPS(0) (10%)')
+    ax3.hlines(y=fit[0], xmin=0, xmax=np.max(nps0_meas[:, 0]), color='orange', label='NPS(0) (fitted)')
+    ax3.plot(x_fit, nps0_fit(x_fit, *fit), color='orange', label='%.02f*x/(x+%0.2f)' % (fit[0], fit[1]))
+    ax3.set_ylim(0)
+    ax3.set_xlabel("Factor")
+    ax3.set_ylabel("NPS(0)")
+    ax3.legend(loc='lower right')
+    ax3.set_title("Estimating NPS(0)")
+
+    im = report.image(ax4, result['nnps'], vmax=1)
+    fig.colorbar(im, ax=ax4, orientation='vertical')
+    ax4.set_title("Normalised 2D noise power spectrum")
+
+    # Normalised NPS
+    ax5.plot(result['w'], result['nnps_1d'], label=label)
+    if 'reference_nnps' in result:
+        ax5.plot(result['w'], result['reference_nnps'], '-.', label='Method: %s' % result['reference_method'])
+        ax5.legend(loc='lower left')
+    if 'row_nnps' in result:
+        ax5.plot(result['w'][:len(result['row_nnps'])], result['row_nnps'], '--', label='Row axis')
+        ax5.plot(result['w'][:len(result['col_nnps'])], result['col_nnps'], ':', label='Column axis')
+        ax5.legend(loc='lower left')
+    ax5.set_xlim([0, 1])
+    ax5.set_ylim([0, 1.1])
+    ax5.set_xlabel("Spatial frequency (fraction of Nyquist)")
+    ax5.set_ylabel("Normalised noise power spectrum")
+    ax5.set_title("Normalised 1D noise power spectrum")
+    ax5.set_aspect('equal', adjustable='box')
+    ax5.grid()
+
+
 def main():
-    pass
+    config = parse_arguments()
+    profiling.enable(config.profile)
+
+    cache_key = None
+    cached = None
+    acc = None
+    reference = None
+
+    if config.validate and (config.merge is not None or config.partial is not None or config.tile):
+        print("WARNING: --validate is not supported with --merge, --partial or --tile")
+        config.validate = False
+
+    if config.workers is not None and config.workers > 1 and config.checkpoint is not None:
+        print("ERROR: --checkpoint is not supported with more than 1 worker")
+        return 1
+
+    if config.window is not None and (config.merge is not None or config.partial is not None or config.tile or
+                                      config.checkpoint is not None or config.method != 'mean' or config.validate):
+        print("ERROR: --window is not supported with --merge, --partial, --tile, --checkpoint, --method or --validate")
+        return 1
+
+    if config.merge is not None:
+        acc = NPSAccumulator.load(config.merge[0])
+        try:
+            for partial in config.merge[1:]:
+                acc.merge(NPSAccumulator.load(partial))
+        except ValueError as e:
+            print("ERROR: Could not merge partial measurements. Message: '%s'" % e)
+            return 1
+
+        print("INFO: Merged %d frames (ranges: %s)" % (acc.n, ", ".join("%d:%d" % r for r in acc.ranges)))
+        config.FILE = config.FILE or "Merged (%s)" % ", ".join(os.path.basename(p) for p in config.merge)
+    elif config.FILE is None:
+        print("INFO: No image supplied, simulating flat fields")
+
+        if config.poisson:
+            from mtf_nps_dqe.lib import simulate
+
+            with profiling.stage('simulate'):
+                try:
+                    kernel = np.load(config.psf_kernel) if config.psf_kernel is not None else None
+                    frames = simulate.simulate_frames(config.n_frames, 512, config.dose, config.psf_sigma,
+                                                      config.counting, seed=config.seed, workers=config.workers,
+                                                      kernel=kernel)
+                except (OSError, ValueError) as e:
+                    print("ERROR: %s" % e)
+                    return 1
+
+            # Every electron deposits a total charge of 1, so for Poisson arrivals NPS(0) equals the dose
+            print("INFO: Expected NPS(0): %0.2f" % config.dose)
+
+            config.FILE = "Simulated (poisson, dose:{}, psf:{}, counting:{})".format(
+                config.dose,
+                config.psf_kernel or config.psf_sigma,
+                config.counting,
+            )
+        else:
+            with profiling.stage('simulate'):
+                frames = simulate_flat_fields(config.n_frames, config.factor, config.sim_super_res, config.gauss,
+                                              config.hann, config.bw, config.real)
+
+            config.FILE = "Simulated (real:{}, gauss:{}, hann:{}, bw:{}, sim_super_res:{}, factor:{})".format(
+                config.real,
+                config.gauss,
+                config.hann,
+                config.bw,
+                config.sim_super_res,
+                config.factor,
+            )
+
+        if config.window is not None:
+            return sliding_output(config, [(0, frames)])
+
+        if config.workers is not None and config.workers > 1:
+            acc, reference = accumulate_parallel(lambda start, stop: frames[start:stop], 0, None, config.workers,
+                                                 config.chunk, config.prefetch, config.tile, config.method,
+                                                 config.validate)
+        else:
+            acc = accumulate_nps(frames, tile=config.tile, method=config.method)
+            if config.validate:
+                reference = accumulate_nps(frames, method=other_method(config.method))
+    elif config.window is not None:
+        try:
+            with open_frames(config.FILE, config.crop, config.frame_time, config.super_res, config.weight) as read:
+                frames = FrameReader(read, config.start, config.stop, config.chunk, config.prefetch)
+                status = sliding_output(config, frames)
+        except ValueError as e:
+            print("ERROR: %s" % e)
+            return 1
+        print("INFO: %s" % frames.summary())
+
+        return status
+    else:
+        if config.cache is not None and config.partial is None:
+            cache_key = cache.key('nps', config.FILE, crop=config.crop, start=config.start, stop=config.stop,
+                                  frame_time=config.frame_time, super_res=config.super_res, weight=config.weight,
+                                  tile=config.tile, method=config.method)
+            cached = cache.load(config.cache, cache_key)
+            if cached is not None and config.validate:
+                print("WARNING: Using cached NPS measurement, skipping validation")
+                config.validate = False
+
+        if cached is None:
+            start = config.start
+            if config.checkpoint is not None and os.path.exists(config.checkpoint):
+                acc = NPSAccumulator.load(config.checkpoint)
+                if acc.method != config.method:
+                    print("ERROR: Checkpoint %s uses the '%s' method" % (config.checkpoint, acc.method))
+                    return 1
+                if acc.ranges:
+                    start = max(start, acc.ranges[-1][1])
+                print("INFO: Resuming from checkpoint with %d frames, at frame %d" % (acc.n, start))
+
+            # Read and process the frames in chunks, so memory use does not grow with the number of frames. The next
+            # chunks are read on a background thread, while the current chunk is transformed
+            try:
+                with open_frames(config.FILE, config.crop, config.frame_time, config.super_res, config.weight) as read:
+                    if config.workers is not None and config.workers > 1:
+                        # The chunks are read into shared memory, and accumulated on a pool of processes
+                        acc, reference = accumulate_parallel(read, start, config.stop, config.workers, config.chunk,
+                                                             config.prefetch, config.tile, config.method,
+                                                             config.validate)
+                    else:
+                        frames = FrameReader(read, start, config.stop, config.chunk, config.prefetch)
+                        for index, chunk in frames:
+                            acc = accumulate_nps(chunk, acc, index, config.checkpoint, config.checkpoint_every,
+                                                 config.tile, config.method)
+                            if config.validate:
+                                reference = accumulate_nps(chunk, reference, index,
+                                                           method=other_method(config.method))
+                        print("INFO: %s" % frames.summary())
+            except (ValueError, RuntimeError) as e:
+                print("ERROR: %s" % e)
+                return 1
+
+            if config.checkpoint is not None and acc is not None:
+                save_checkpoint(acc, config.checkpoint)
+
+            if acc is None:
+                print("ERROR: No frames in range %d:%s" % (config.start, config.stop))
+                return 1
+        else:
+            print("INFO: Using cached NPS measurement")
+
+    if config.partial is not None:
+        acc.save(config.partial)
+        print("INFO: Stored partial measurement of %d frames to %s" % (acc.n, config.partial))
+        profiling.write()
+        return 0
+
+    if cached is None:
+        nps, nps0_meas = nps_spectra(acc)
+        mean = acc.mean()
+        first = acc.first
+        n_frames = acc.n
+
+        if cache_key is not None:
+            cache.store(config.cache, cache_key, config.cache_size,
+                        nps=nps, nps0_meas=nps0_meas, mean=mean, first=first, n_frames=n_frames,
+                        grid=acc.grid if acc.grid is not None else ())
+    else:
+        nps, nps0_meas, mean, first, n_frames = (cached[k] for k in ('nps', 'nps0_meas', 'mean', 'first', 'n_frames'))
+
+    if nps.ndim == 3:
+        return tiled_output(config, nps, nps0_meas, mean, acc.grid if acc is not None else cached['grid'], n_frames)
+
+    if config.save_2d is not None:
+        save_nps_2d(config.save_2d, nps, nps0_meas, mean, first, n_frames, source=config.FILE, crop=config.crop,
+                    super_res=config.super_res)
+        print("INFO: Stored 2D NPS to %s" % config.save_2d)
+
+    result = analyse_nps(nps, nps0_meas, config.guess, config.super_res, config.sectors)
+
+    if reference is not None:
+        if reference.n != n_frames:
+            print("WARNING: Validation only covers the %d frames read in this run" % reference.n)
+        validate_nps(result, reference, config.guess, config.super_res)
+
+    if not config.no_plot:
+        with profiling.stage('plot'):
+            report.render(plot_nps, first, mean, result, config.FILE, os.path.basename(config.FILE),
+                          output=config.figure, figsize=(15, 9))
+
+    # The directional NNPS curves (when measured) share the frequencies of the azimuthal average
+    directional = {k: result[k] for k in ('sector_angles', 'sector_nnps', 'row_nnps', 'col_nnps', 'anisotropy')
+                   if k in result}
+
+    if 'reference_nnps' in result:
+        directional['reference_nnps'] = result['reference_nnps']
+
+    if config.store is not None:
+        np.savez(config.store, w=result['w'], nps=result['nnps_1d'], **directional)
+
+    if config.catalog is not None:
+        # Only scalars go into the metadata, the curves are stored as arrays with the curve
+        scalars = {k: directional.pop(k) for k in ('anisotropy',) if k in directional}
+        catalog.store_curve(config.catalog, 'nps', result['w'], result['nnps_1d'],
+                            label=config.name or os.path.basename(config.store or config.FILE),
+                            source=config.FILE,
+                            arrays=directional,
+                            crop=config.crop,
+                            frames=int(n_frames),
+                            method=acc.method if acc is not None else config.method,
+                            nps0=result['nps0'], nps0_guess=result['nps0_guess'], nps0_fit=result['nps0_fit'],
+                            guess=config.guess,
+                            super_res=config.super_res,
+                            sectors=config.sectors,
+                            **scalars)
+
+    with profiling.stage('figure'):
+        report.wait()
+
+    profiling.write()
+
+    return 0
+
+
+def tiled_output(config, nps, nps0_meas, mean, grid, n_frames):
+    if config.save_2d is not None or config.sectors > 0:
+        print("WARNING: --save_2d and --sectors are not supported with --tile")
+
+    result = analyse_tiles(nps, nps0_meas, mean, tuple(grid), config.guess, config.super_res)
+
+    if not config.no_plot:
+        with profiling.stage('plot'):
+            report.render(plot_tiles, result, config.FILE, output=config.figure, figsize=(10, 9))
+
+    maps = {k: result[k] for k in ('signal_map', 'nps0_map', 'nnps_half_map', 'dqe0_rel_map')}
+
+    if config.store is not None:
+        np.savez(config.store, w=result['w'], nps=result['nnps_1d'], nnps_tiles=result['nnps_tiles'], grid=grid,
+                 tile=nps.shape[-1], **maps)
+
+    if config.catalog is not None:
+        catalog.store_curve(config.catalog, 'nps', result['w'], result['nnps_1d'],
+                            label=config.name or os.path.basename(config.store or config.FILE),
+                            source=config.FILE,
+                            arrays=dict(maps, nnps_tiles=result['nnps_tiles']),
+                            tile=nps.shape[-1],
+                            grid=[int(g) for g in grid],
+                            frames=int(n_frames),
+                            guess=config.guess,
+                            super_res=config.super_res)
+
+    with profiling.stage('figure'):
+        report.wait()
+
+    profiling.write()
+
+    return 0
+
+
+def sliding_output(config, chunks):
+    result = sliding_nps(chunks, config.window, config.step, config.guess, config.super_res)
+    if result is None:
+        print("ERROR: Fewer frames than the window of %d frames" % config.window)
+        return 1
+
+    nps0 = result['nps0']
+    print("INFO: %d windows of %d frames (step %d)" % (len(nps0), config.window, config.step))
+    print("NPS(0) of windows: %0.2f - %0.2f (first %0.2f, last %0.2f)" % (np.nanmin(nps0), np.nanmax(nps0), nps0[0],
+                                                                          nps0[-1]))
+    print("Signal of windows: %0.2f - %0.2f" % (np.min(result['signal']), np.max(result['signal'])))
+
+    if not config.no_plot:
+        with profiling.stage('plot'):
+            report.render(plot_sliding, result, config.window, config.FILE, output=config.figure, figsize=(15, 5))
+
+    if config.store is not None:
+        np.savez(config.store, window=config.window, step=config.step, **result)
+
+    with profiling.stage('figure'):
+        report.wait()
+
+    profiling.write()
+
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -1,21 +1,18 @@
 import argparse
 import os.path
+import sys
 
-import matplotlib.pyplot as plt
 import numpy as np
 
-plt.rcParams.update({
-    "font.size": 12,
-    "font.family": 'Arial',
-    "svg.fonttype": 'none',
-    "lines.linewidth" : 3
-})
+from mtf_nps_dqe.lib import catalog, utils
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('--input', nargs='+', type=str, required=True, help='Input measured NPS curves (can be multiple)')
+    parser.add_argument('--input', nargs='+', type=str, required=False, help='Input measured NPS curves (can be multiple)')
+    parser.add_argument('--catalog', type=str, required=False, help='Also plot measured NPS curves from this catalog (.sqlite)')
+    parser.add_argument('--select', type=str, required=False, help='Only plot catalog curves with a matching label (%% is a wildcard)')
     parser.add_argument('--output', type=str, required=False, help='Output image file (SVG) to store to')
 
     return parser.parse_args()
@@ -26,34 +23,46 @@ def load_nps(f):
     return d['w'], d['nps']
 
 
-config = parse_arguments()
-plt.figure(figsize=(7, 7))
+def main():
+    config = parse_arguments()
 
-for input_f in config.input:
-    w, nps = load_nps(input_f)
+    plt = utils.pyplot(show=config.output is None)
+    plt.rcParams.update({
+        "font.size": 12,
+        "font.family": 'Arial',
+        "svg.fonttype": 'none',
+        "lines.linewidth" : 3
+    })
 
-    plt.plot(w, nps, label=os.path.basename(input_f))
+    plt.figure(figsize=(7, 7))
 
+    if config.input is not None:
+        for input_f in config.input:
+            w, nps = load_nps(input_f)
 
-plt.legend(loc='lower left')
-plt.xlim([0, 1.0])
-plt.ylim([0, 1.1])
-plt.xlabel("Spatial frequency (fraction of Nyquist)")
-plt.title("NPS")
-plt.grid()
-plt.gca().set_aspect('equal', adjustable='box')
+            plt.plot(w, nps, label=os.path.basename(input_f))
 
-if config.output is not None:
-    plt.tight_layout()
-    plt.savefig(config.output, dpi=300, bbox_inches='tight', pad_inches=0.1)
-else:
-    plt.show()
+    if config.catalog is not None:
+        for label, w, nps, _ in catalog.select(config.catalog, 'nps', config.select):
+            plt.plot(w, nps, label=label)
 
 
-# TODO: This is not a very clean way around the fact that this script should be refactored
-def main():
-    pass
+    plt.legend(loc='lower left')
+    plt.xlim([0, 1.0])
+    plt.ylim([0, 1.1])
+    plt.xlabel("Spatial frequency (fraction of Nyquist)")
+    plt.title("NPS")
+    plt.grid()
+    plt.gca().set_aspect('equal', adjustable='box')
+
+    if config.output is not None:
+        plt.tight_layout()
+        plt.savefig(config.output, dpi=300, bbox_inches='tight', pad_inches=0.1)
+    else:
+        plt.show()
+
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
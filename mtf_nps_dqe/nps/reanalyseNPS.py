@@ -0,0 +1,92 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from mtf_nps_dqe.lib import catalog, profiling, report
+from mtf_nps_dqe.nps import measureNPS
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('DIR', help="Directory with the 2D NPS, as stored by measureNPS --save_2d")
+    parser.add_argument('--super_res', default=None, type=int,
+                        help='Rescale the frequency of the NPS curve by this factor (default as measured)')
+    parser.add_argument('--guess', default=False, action='store_true',
+                        help='Use guessed NPS(0) opposed to fitted NPS(0). Sometimes the fitting is bad.')
+    parser.add_argument('--nps0', default=None, type=float, help='Use this NPS(0), instead of estimating it')
+    parser.add_argument('--sectors', default=0, type=int,
+                        help='Also calculate the NNPS in this number of angular sectors, and along the row and column axis')
+    parser.add_argument('--mask_dc', default=0, type=int,
+                        help='Exclude the central row and column (DC cross) of this half width from the profiles')
+    parser.add_argument('--store', type=str, help='Store output NPS curve')
+    parser.add_argument('--catalog', type=str, help='Store output NPS curve in this catalog (.sqlite)')
+    parser.add_argument('--name', type=str, help='Label to store with NPS curve in the catalog (default basename of input)')
+    parser.add_argument('--no_plot', default=False, action='store_true', help='Do not show the diagnostic figure')
+    parser.add_argument('--figure', type=str,
+                        help='Save the diagnostic figure to this file (drawn in the background), instead of showing it')
+    parser.add_argument('--profile', type=str, help='Write a report with the time and memory use of each stage (.json or .csv)')
+
+    settings = parser.parse_args()
+
+    return settings
+
+
+def main():
+    config = parse_arguments()
+    profiling.enable(config.profile)
+
+    try:
+        with profiling.stage('read'):
+            d = measureNPS.load_nps_2d(config.DIR)
+    except (OSError, ValueError) as e:
+        print("ERROR: Could not read 2D NPS. Message: '%s'" % e)
+        return 1
+
+    meta = d['meta']
+    super_res = config.super_res if config.super_res is not None else meta.get('super_res', 1)
+    print("INFO: 2D NPS of %s (%d frames)" % (meta.get('source'), meta['frames']))
+
+    mask = measureNPS.dc_cross_mask(d['nps'].shape, config.mask_dc) if config.mask_dc > 0 else None
+
+    result = measureNPS.analyse_nps(d['nps'], d['nps0'], config.guess, super_res, config.sectors, mask, config.nps0)
+
+    if not config.no_plot:
+        with profiling.stage('plot'):
+            report.render(measureNPS.plot_nps, d['first'], d['mean'], result, meta.get('source'),
+                          os.path.basename(config.DIR), output=config.figure, figsize=(15, 9))
+
+    directional = {k: result[k] for k in ('sector_angles', 'sector_nnps', 'row_nnps', 'col_nnps', 'anisotropy')
+                   if k in result}
+
+    if config.store is not None:
+        np.savez(config.store, w=result['w'], nps=result['nnps_1d'], **directional)
+
+    if config.catalog is not None:
+        # Only scalars go into the metadata, the curves are stored as arrays with the curve
+        scalars = {k: directional.pop(k) for k in ('anisotropy',) if k in directional}
+        catalog.store_curve(config.catalog, 'nps', result['w'], result['nnps_1d'],
+                            label=config.name or os.path.basename(config.store or os.path.normpath(config.DIR)),
+                            source=meta.get('source'),
+                            arrays=directional,
+                            crop=meta.get('crop'),
+                            frames=meta['frames'],
+                            nps0=result['nps0'], nps0_guess=result['nps0_guess'], nps0_fit=result['nps0_fit'],
+                            guess=config.guess,
+                            super_res=super_res,
+                            mask_dc=config.mask_dc,
+                            sectors=config.sectors,
+                            **scalars)
+
+    with profiling.stage('figure'):
+        report.wait()
+
+    profiling.write()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
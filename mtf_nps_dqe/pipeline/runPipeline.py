@@ -0,0 +1,276 @@
+import argparse
+import contextlib
+import csv
+import hashlib
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+from mtf_nps_dqe.dqe import calculateDQE
+from mtf_nps_dqe.lib import catalog, report
+from mtf_nps_dqe.lib.reader import FrameReader
+from mtf_nps_dqe.mtf import measureMTF
+from mtf_nps_dqe.nps import measureNPS
+
+# Runs the MTF -> NPS -> DQE measurements of many detectors, as described in a CSV manifest with one DQE curve per
+# row. MTF and NPS jobs are independent and run concurrently on a process pool. Jobs that read the same input file
+# are grouped, so the input is read only once. A DQE job runs as soon as both its MTF and NPS jobs are done.
+
+COLUMNS = ['name', 'edge', 'x', 'y', 'width', 'height', 'rotate', 'flat', 'crop', 'guess', 'super_res', 'dqe0']
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('MANIFEST', help="CSV file with the columns: %s" % ", ".join(COLUMNS))
+    parser.add_argument('--output_dir', default='.', type=str, help='Directory to store the measured curves and logs')
+    parser.add_argument('--catalog', type=str, help='Also store all measured curves in this catalog (.sqlite)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('--figures', default=False, action='store_true',
+                        help='Save the diagnostic figure of every MTF and NPS job to the output directory (.png)')
+
+    settings = parser.parse_args()
+
+    return settings
+
+
+def read_manifest(filename):
+    rows = []
+    with open(filename, newline='') as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            row = {k.strip(): (v or '').strip() for k, v in row.items() if k is not None}
+            if not row.get('name') or not row.get('edge') or not row.get('flat'):
+                raise ValueError("Manifest line %d: name, edge and flat are required" % line)
+
+            rows.append({
+                'name': row['name'],
+                'edge': row['edge'],
+                'roi': tuple(int(row[k]) for k in ('x', 'y', 'width', 'height')),
+                'rotate': int(row.get('rotate') or 0),
+                'flat': row['flat'],
+                'crop': int(row.get('crop') or 0),
+                'guess': (row.get('guess') or '').lower() in ('1', 'true', 'yes'),
+                'super_res': int(row.get('super_res') or 1),
+                'dqe0': float(row.get('dqe0') or 0.95),
+            })
+
+    return rows
+
+
+def job_id(kind, *key):
+    return "%s-%s" % (kind, hashlib.sha1(repr(key).encode()).hexdigest()[:10])
+
+
+def log_file(output_dir, kind, filename, *key):
+    """Log of a group of jobs. The hash of the key keeps inputs with the same name in different directories apart"""
+    return os.path.join(output_dir, "%s-%s.log" % (job_id(kind, filename, *key), os.path.basename(filename)))
+
+
+def build_jobs(rows):
+    """Build the dependency graph. Returns the MTF jobs and NPS jobs (grouped by input file), and the DQE jobs"""
+    mtf_groups = {}
+    nps_groups = {}
+    dqe_jobs = []
+
+    names = set()
+    for row in rows:
+        # The name is the output file of the DQE curve
+        if row['name'] in names:
+            raise ValueError("Duplicate name '%s' in manifest" % row['name'])
+        names.add(row['name'])
+
+        mtf_key = (row['edge'], row['rotate'], row['roi'], row['super_res'])
+        mtf_id = job_id('mtf', *mtf_key)
+        mtf_groups.setdefault((row['edge'], row['rotate']), {})[mtf_id] = {'roi': row['roi'], 'super_res': row['super_res']}
+
+        nps_key = (row['flat'], row['crop'], row['guess'], row['super_res'])
+        nps_id = job_id('nps', *nps_key)
+        nps_groups.setdefault((row['flat'], row['crop']), {})[nps_id] = {'guess': row['guess'], 'super_res': row['super_res']}
+
+        dqe_jobs.append({'name': row['name'], 'mtf': mtf_id, 'nps': nps_id, 'dqe0': row['dqe0']})
+
+    return mtf_groups, nps_groups, dqe_jobs
+
+
+def run_mtf_group(edge, rotate, jobs, output_dir, figures=False):
+    """Measure all MTF jobs on the same edge image. Returns a dict of job id -> (output file, error)"""
+    results = {}
+    with open(log_file(output_dir, 'mtf', edge, rotate), 'a') as log, \
+            contextlib.redirect_stdout(log):
+        try:
+            im = measureMTF.load_image(edge, rotate)
+        except Exception:
+            return {j: (None, traceback.format_exc(limit=1)) for j in jobs}
+
+        for j, job in jobs.items():
+            print("INFO: %s %s" % (j, job))
+            try:
+                r = measureMTF.measure_mtf(im, *job['roi'], job['super_res'])
+                output = os.path.join(output_dir, j + '.npz')
+                np.savez(output, w=r['w'], mtf=r['mtf'], fit=r['fit'], perr=r['perr'])
+                results[j] = (output, None)
+                if figures:
+                    report.render(measureMTF.plot_mtf, im, r, edge, output=os.path.join(output_dir, j + '.png'),
+                                  figsize=(12, 10))
+            except Exception:
+                results[j] = (None, traceback.format_exc(limit=1))
+                print(results[j][1])
+
+        # The figures are drawn in the background, while the next jobs are measured
+        report.wait()
+
+    return results
+
+
+def run_nps_group(flat, crop, jobs, output_dir, figures=False):
+    """Measure all NPS jobs on the same flat field stack. The spectra are accumulated once, only the analysis is done
+    per job. Returns a dict of job id -> (output file, error)"""
+    results = {}
+    with open(log_file(output_dir, 'nps', flat, crop), 'a') as log, contextlib.redirect_stdout(log):
+        try:
+            acc = None
+            with measureNPS.open_frames(flat, crop) as read:
+                for index, chunk in FrameReader(read):
+                    acc = measureNPS.accumulate_nps(chunk, acc, index)
+            if acc is None:
+                raise ValueError("No frames in %s" % flat)
+            nps, nps0_meas = measureNPS.nps_spectra(acc)
+            # Shared by the figures of all jobs
+            mean = acc.mean() if figures else None
+        except Exception:
+            return {j: (None, traceback.format_exc(limit=1)) for j in jobs}
+
+        for j, job in jobs.items():
+            print("INFO: %s %s" % (j, job))
+            try:
+                r = measureNPS.analyse_nps(nps, nps0_meas, job['guess'], job['super_res'])
+                output = os.path.join(output_dir, j + '.npz')
+                np.savez(output, w=r['w'], nps=r['nnps_1d'], nps0=r['nps0'])
+                results[j] = (output, None)
+                if figures:
+                    report.render(measureNPS.plot_nps, acc.first, mean, r, flat, j,
+                                  output=os.path.join(output_dir, j + '.png'), figsize=(15, 9))
+            except Exception:
+                results[j] = (None, traceback.format_exc(limit=1))
+                print(results[j][1])
+
+        report.wait()
+
+    return results
+
+
+def run_dqe(job, mtf_file, nps_file, output_dir):
+    mtf = np.load(mtf_file)
+    nps = np.load(nps_file)
+
+    dqe, _ = calculateDQE.calculate_dqe(mtf['w'], mtf['mtf'], nps['w'], nps['nps'], job['dqe0'])
+
+    output = os.path.join(output_dir, job['name'] + '.npz')
+    np.savez(output, w=nps['w'], dqe=dqe, label=job['name'])
+
+    return output
+
+
+def run(rows, output_dir, workers, catalog_path=None, figures=False, jobs=None):
+    """Run all jobs (by default built from the rows). Returns a dict of job (id or DQE name) -> (output file, error)"""
+    mtf_groups, nps_groups, dqe_jobs = jobs or build_jobs(rows)
+    done = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # The job ids of every group, to fail only the jobs of a group that raised (or of which the worker died)
+        groups = {}
+        for (edge, rotate), group in mtf_groups.items():
+            groups[executor.submit(run_mtf_group, edge, rotate, group, output_dir, figures)] = list(group)
+        for (flat, crop), group in nps_groups.items():
+            groups[executor.submit(run_nps_group, flat, crop, group, output_dir, figures)] = list(group)
+        pending = set(groups)
+
+        waiting = list(dqe_jobs)
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                try:
+                    done.update(future.result())
+                except Exception:
+                    error = traceback.format_exc(limit=1)
+                    done.update({j: (None, error) for j in groups[future]})
+
+            # Run the DQE jobs of which both inputs are available. These are cheap, so run them here.
+            for job in list(waiting):
+                if job['mtf'] not in done or job['nps'] not in done:
+                    continue
+                waiting.remove(job)
+
+                (mtf_file, mtf_error), (nps_file, nps_error) = done[job['mtf']], done[job['nps']]
+                if mtf_error or nps_error:
+                    done[job['name']] = (None, "Skipped, because %s failed" % (job['mtf'] if mtf_error else job['nps']))
+                    continue
+
+                try:
+                    done[job['name']] = (run_dqe(job, mtf_file, nps_file, output_dir), None)
+                except Exception:
+                    done[job['name']] = (None, traceback.format_exc(limit=1))
+
+    if catalog_path is not None:
+        store_catalog(catalog_path, rows, dqe_jobs, done)
+
+    return done
+
+
+def store_catalog(catalog_path, rows, dqe_jobs, done):
+    """Store the curves of the successful DQE jobs. MTF and NPS curves shared by several rows are stored once, with the
+    name of the first row"""
+    stored = set()
+    for row, job in zip(rows, dqe_jobs):
+        output, error = done[job['name']]
+        if error:
+            continue
+
+        if job['mtf'] not in stored:
+            stored.add(job['mtf'])
+            mtf = np.load(done[job['mtf']][0])
+            catalog.store_curve(catalog_path, 'mtf', mtf['w'], mtf['mtf'], label=row['name'], source=row['edge'],
+                                roi=list(row['roi']), rotate=row['rotate'], lam=mtf['fit'][0], lam_err=mtf['perr'][0],
+                                x0=mtf['fit'][1], x0_err=mtf['perr'][1], super_res=row['super_res'])
+
+        if job['nps'] not in stored:
+            stored.add(job['nps'])
+            nps = np.load(done[job['nps']][0])
+            catalog.store_curve(catalog_path, 'nps', nps['w'], nps['nps'], label=row['name'], source=row['flat'],
+                                crop=row['crop'], nps0=nps['nps0'], guess=row['guess'], super_res=row['super_res'])
+
+        dqe = np.load(output)
+        catalog.store_curve(catalog_path, 'dqe', dqe['w'], dqe['dqe'], label=row['name'], dqe0=row['dqe0'],
+                            mtf=done[job['mtf']][0], nps=done[job['nps']][0])
+
+
+def main():
+    config = parse_arguments()
+
+    try:
+        rows = read_manifest(config.MANIFEST)
+        jobs = build_jobs(rows)
+    except (OSError, ValueError, KeyError) as e:
+        print("ERROR: Could not read manifest. Message: '%s'" % e)
+        return 1
+
+    os.makedirs(config.output_dir, exist_ok=True)
+
+    done = run(rows, config.output_dir, config.workers, config.catalog, config.figures, jobs)
+
+    failed = 0
+    for job, (output, error) in sorted(done.items()):
+        if error:
+            failed += 1
+            print("FAILED  %s: %s" % (job, error.strip().splitlines()[-1]))
+        else:
+            print("OK      %s -> %s" % (job, output))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,295 @@
+import argparse
+import asyncio
+import fnmatch
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from mtf_nps_dqe.dqe import calculateDQE
+from mtf_nps_dqe.lib import catalog
+from mtf_nps_dqe.mtf import measureMTF
+from mtf_nps_dqe.nps import measureNPS
+
+# Watches a directory for flat field and edge acquisitions (MRC stacks) while they are being written. New frames are
+# read through a memory map as soon as they are complete on disk. Flat field frames are added to an NPS accumulator,
+# edge frames are summed and the MTF is refitted. After every batch of frames the DQE curve is republished.
+#
+# A poller enqueues batches of frames on a bounded queue. A single worker processes them (off the event loop, in a
+# thread). When the worker falls behind, the queue fills up and the poller waits, so memory use stays bounded.
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('DIRECTORY', help="Directory to watch for new MRC files")
+    parser.add_argument('--flat', default='*flat*.mrc', type=str, help='File name pattern of the flat field stacks')
+    parser.add_argument('--edge', default='*edge*.mrc', type=str, help='File name pattern of the edge images (stacks)')
+    parser.add_argument('--roi', nargs=4, type=int, metavar=('X', 'Y', 'WIDTH', 'HEIGHT'), help='ROI of the edge')
+    parser.add_argument('--rotate', default=0, type=int, help='Number of times to rotate the edge image clockwise')
+    parser.add_argument('--crop', default=0, type=int, help='Crop the flat fields to this (power of 2) size')
+    parser.add_argument('--guess', default=False, action='store_true', help='Use guessed NPS(0) opposed to fitted NPS(0)')
+    parser.add_argument('--super_res', default=1, type=int, help='Rescale the frequency of the curves by this factor')
+    parser.add_argument('--dqe0', default=0.95, type=float, help='DQE(0) estimate')
+    parser.add_argument('--output', type=str, help='Publish the DQE curve to this file (default DIRECTORY/dqe.npz)')
+    parser.add_argument('--catalog', type=str, help='Also store the curves in this catalog (.sqlite) once acquisitions are complete')
+    parser.add_argument('--name', type=str, help='Label of the curves in the catalog (default name of the flat field file)')
+    parser.add_argument('--interval', default=1.0, type=float, help='Seconds between polling the directory')
+    parser.add_argument('--settle', default=10.0, type=float,
+                        help='Seconds a file should not grow, before it is considered complete')
+    parser.add_argument('--batch', default=20, type=int, help='Maximum number of frames per batch')
+    parser.add_argument('--queue_size', default=4, type=int, help='Maximum number of batches waiting to be processed')
+    parser.add_argument('--once', default=False, action='store_true',
+                        help='Process the files present, and exit once they are complete')
+
+    settings = parser.parse_args()
+
+    return settings
+
+
+def mrc_frames(filename):
+    """Memory map the frames of a (possibly still growing) MRC stack. Only the frames that are complete on disk are
+    mapped, as the header may only be finalised after the last frame is written. Returns None when the header is not
+    written yet."""
+    import mrcfile
+    from mrcfile.utils import data_dtype_from_header
+
+    try:
+        with mrcfile.open(filename, mode='r', header_only=True, permissive=True) as f:
+            header = f.header
+            dtype = data_dtype_from_header(header)
+    except (OSError, ValueError):
+        return None
+
+    shape = (int(header.ny), int(header.nx))
+    offset = header.nbytes + int(header.nsymbt)
+    frame_bytes = shape[0] * shape[1] * dtype.itemsize
+
+    n = (os.path.getsize(filename) - offset) // frame_bytes
+    if n <= 0:
+        return np.empty((0,) + shape, dtype=dtype)
+
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(n,) + shape)
+
+
+class Acquisition:
+    """State of a single file being acquired"""
+
+    def __init__(self, path, kind):
+        self.path = path
+        self.kind = kind
+        self.queued = 0
+        self.size = -1
+        self.changed = time.monotonic()
+        self.complete = False
+
+
+class Watcher:
+    def __init__(self, config):
+        self.config = config
+        self.output = config.output or os.path.join(config.DIRECTORY, 'dqe.npz')
+        self.files = {}
+        self.queue = asyncio.Queue(maxsize=config.queue_size)
+        # Processing state, only touched by the worker
+        self.nps = {}
+        self.edges = {}
+        self.mtf = None
+        self.nps_result = None
+        self.flat_file = None
+        self.edge_file = None
+        self.stored = None
+
+    def classify(self, name):
+        if fnmatch.fnmatch(name, self.config.flat):
+            return 'flat'
+        if fnmatch.fnmatch(name, self.config.edge):
+            return 'edge'
+        return None
+
+    async def poll(self):
+        """Scan the directory, and enqueue batches of newly written frames"""
+        while True:
+            for entry in sorted(os.scandir(self.config.DIRECTORY), key=lambda e: e.name):
+                kind = self.classify(entry.name)
+                if kind is None or not entry.is_file():
+                    continue
+
+                acq = self.files.get(entry.path)
+                if acq is None:
+                    acq = self.files[entry.path] = Acquisition(entry.path, kind)
+                    print("INFO: New %s acquisition %s" % (kind, entry.name))
+
+                if acq.complete:
+                    continue
+
+                size = entry.stat().st_size
+                if size != acq.size:
+                    acq.size = size
+                    acq.changed = time.monotonic()
+
+                await self.enqueue(acq)
+
+            # Exit when nothing is pending (also when there are no acquisitions at all)
+            if self.config.once and all(a.complete for a in self.files.values()):
+                if not self.files:
+                    print("INFO: No acquisitions in %s" % self.config.DIRECTORY)
+                await self.queue.put(None)
+                return
+
+            await asyncio.sleep(self.config.interval)
+
+    async def complete(self, acq, kind):
+        """Mark the acquisition complete. Whether all acquisitions are complete is passed with the item, as the
+        acquisitions are only updated here, on the event loop"""
+        acq.complete = True
+        await self.queue.put((kind, acq.path, None, None, all(a.complete for a in self.files.values())))
+
+    async def enqueue(self, acq):
+        settled = time.monotonic() - acq.changed >= self.config.settle
+
+        frames = mrc_frames(acq.path)
+        if frames is None:
+            # An empty file, or a header that is never written
+            if settled:
+                print("WARNING: Skipping %s, it is not a readable MRC file" % os.path.basename(acq.path))
+                await self.complete(acq, 'skipped')
+            return
+
+        # As with measureNPS, skip the first and last frame of a flat field stack. While the file is growing, the
+        # last frame is not known yet, so always keep the latest frame back.
+        if acq.kind == 'flat':
+            start, stop = max(acq.queued, 1), len(frames) - 1
+        else:
+            start, stop = acq.queued, len(frames) if settled else len(frames) - 1
+        while start < stop:
+            end = min(start + self.config.batch, stop)
+            # Waits when the queue is full (backpressure)
+            await self.queue.put((acq.kind, acq.path, start, end, False))
+            acq.queued = start = end
+
+        if settled:
+            await self.complete(acq, acq.kind)
+
+    async def work(self, executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+
+            try:
+                await loop.run_in_executor(executor, self.process, *item)
+            except Exception as e:
+                print("ERROR: Processing %s failed. Message: '%s'" % (item[1], e))
+
+    def process(self, kind, path, start, stop, all_complete):
+        if start is None:
+            if kind != 'skipped':
+                print("INFO: Acquisition %s complete" % os.path.basename(path))
+            self.publish(final=all_complete)
+            return
+
+        t = time.perf_counter()
+        frames = mrc_frames(path)
+        if kind == 'flat':
+            self.add_flat(path, frames, start, stop)
+        else:
+            self.add_edge(path, frames, start, stop)
+        print("INFO: %s frames %d:%d processed in %.2f s" % (os.path.basename(path), start, stop,
+                                                                time.perf_counter() - t))
+
+        self.publish()
+
+    def add_flat(self, path, frames, start, stop):
+        data = frames[start:stop]
+        if self.config.crop > 0:
+            data = data[:, 0:self.config.crop, 0:self.config.crop]
+
+        # Index the frames as measureNPS does (after skipping the first frame)
+        acc = self.nps.get(path)
+        self.nps[path] = measureNPS.accumulate_nps(np.array(data), acc, start - 1)
+        self.flat_file = path
+
+        if self.nps[path].n > 2:
+            nps, nps0_meas = measureNPS.nps_spectra(self.nps[path])
+            self.nps_result = measureNPS.analyse_nps(nps, nps0_meas, self.config.guess, self.config.super_res)
+
+    def add_edge(self, path, frames, start, stop):
+        total = self.edges.get(path)
+        part = np.sum(frames[start:stop], axis=0, dtype=np.float64)
+        self.edges[path] = part if total is None else total + part
+        self.edge_file = path
+
+        if self.config.roi is None:
+            return
+
+        im = np.rot90(self.edges[path], self.config.rotate) if self.config.rotate > 0 else self.edges[path]
+        self.mtf = measureMTF.measure_mtf(im, *self.config.roi, self.config.super_res)
+        print("INFO: MTF lambda: %.4f (+- %.4f)" % (self.mtf['fit'][0], self.mtf['perr'][0]))
+
+    def publish(self, final=False):
+        """Write the DQE curve. With final (all acquisitions are complete), also store the curves in the catalog"""
+        if self.mtf is None or self.nps_result is None:
+            return
+
+        dqe, mtf_inter = calculateDQE.calculate_dqe(self.mtf['w'], self.mtf['mtf'], self.nps_result['w'],
+                                                    self.nps_result['nnps_1d'], self.config.dqe0)
+
+        # Write to a temporary file first, so readers never see a partial file
+        tmp = self.output + '.tmp.npz'
+        np.savez(tmp, w=self.nps_result['w'], dqe=dqe, mtf=mtf_inter, nps=self.nps_result['nnps_1d'],
+                 frames=self.nps[self.flat_file].n, updated=time.time())
+        os.replace(tmp, self.output)
+        print("INFO: Published DQE (%d flat field frames) to %s" % (self.nps[self.flat_file].n, self.output))
+
+        # Store in the catalog once, when all acquisitions seen so far are complete
+        stored = (self.flat_file, self.edge_file, self.nps[self.flat_file].n)
+        if final and self.config.catalog is not None and stored != self.stored:
+            self.stored = stored
+            label = self.config.name or os.path.basename(self.flat_file)
+            catalog.store_curve(self.config.catalog, 'mtf', self.mtf['w'], self.mtf['mtf'], label=label,
+                                source=self.edge_file, roi=list(self.config.roi), rotate=self.config.rotate,
+                                lam=self.mtf['fit'][0], lam_err=self.mtf['perr'][0], super_res=self.config.super_res)
+            catalog.store_curve(self.config.catalog, 'nps', self.nps_result['w'], self.nps_result['nnps_1d'],
+                                label=label, source=self.flat_file, crop=self.config.crop,
+                                frames=self.nps[self.flat_file].n, nps0=self.nps_result['nps0'],
+                                guess=self.config.guess, super_res=self.config.super_res)
+            catalog.store_curve(self.config.catalog, 'dqe', self.nps_result['w'], dqe, label=label,
+                                dqe0=self.config.dqe0)
+
+    async def run(self):
+        # A single worker thread, so the accumulators are only updated from one place
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            poller = asyncio.ensure_future(self.poll())
+            worker = asyncio.ensure_future(self.work(executor))
+            await asyncio.wait([poller, worker], return_when=asyncio.FIRST_EXCEPTION)
+
+            for task in (poller, worker):
+                if task.done() and task.exception() is not None:
+                    raise task.exception()
+            poller.cancel()
+
+
+def main():
+    config = parse_arguments()
+
+    if not os.path.isdir(config.DIRECTORY):
+        print("ERROR: %s is not a directory" % config.DIRECTORY)
+        return 1
+
+    if config.roi is None:
+        print("WARNING: No --roi of the edge given, only the NPS will be measured")
+
+    print("INFO: Watching %s" % config.DIRECTORY)
+    try:
+        asyncio.run(Watcher(config).run())
+    except KeyboardInterrupt:
+        print("INFO: Stopped")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
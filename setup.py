@@ -22,8 +22,13 @@ setup(
         "tqdm>=4.0.0,<5.0",
         "mrcfile>1.0.0,<2.0.0",
         "scikit-image>0.17,<1.0.0",
-        "pandas>1.0.0,<2.0.0"
+        "pandas>1.0.0,<2.0.0",
+        "tifffile>2021.0.0"
     ],
+    extras_require={
+        "hdf5": ["h5py>3.0.0"],
+        "compression": ["imagecodecs>2021.0.0"],
+    },
     package_data={
         'mtf_nps_dqe': ['mtf/published/*', 'dqe/published/*'],
     },
@@ -54,11 +59,15 @@ setup(
     entry_points={
         'console_scripts': [
             'measureMTF = mtf_nps_dqe.mtf.measureMTF:main',
+            'mapMTF = mtf_nps_dqe.mtf.mapMTF:main',
             'measureNPS = mtf_nps_dqe.nps.measureNPS:main',
+            'reanalyseNPS = mtf_nps_dqe.nps.reanalyseNPS:main',
             'calculateDQE = mtf_nps_dqe.dqe.calculateDQE:main',
             'starMTF = mtf_nps_dqe.mtf.starMTF:main',
             'plotMTF = mtf_nps_dqe.mtf.plotMTF:main',
             'plotNPS = mtf_nps_dqe.nps.plotNPS:main',
             'plotDQE = mtf_nps_dqe.dqe.plotDQE:main',
+            'runPipeline = mtf_nps_dqe.pipeline.runPipeline:main',
+            'watchFolder = mtf_nps_dqe.pipeline.watchFolder:main',
         ], }
 )
\ No newline at end of file
@@ -0,0 +1,70 @@
+import numpy as np
+from numpy.fft import fft2, fftshift
+
+from mtf_nps_dqe.lib import utils
+from mtf_nps_dqe.lib.reader import FrameReader
+from mtf_nps_dqe.nps import measureNPS
+
+
+# Reference implementations of the per frame NPS and NPS(0), as used by measureNPS before the partial sums of the
+# NPSAccumulator. The power spectrum of the mean subtracted frames, and the binned variances, are calculated frame by
+# frame after the mean of the stack is known.
+
+def power_spectrum(d):
+    return np.abs(fftshift(fft2(d))) ** 2
+
+
+def calculate_nps0(frames, mean):
+    r = list()
+
+    # Bin factors as powers of 2, not too small image sizes
+    factors = 2**np.arange(1, np.log2(mean.shape[0]), dtype=int)
+    factors = factors[0:-2]
+
+    for frame in frames:
+        f = frame - mean
+
+        for factor in factors:
+            # Bin the frame using fourier cropping
+            binned = utils.ift(utils.bin_mic_ft(utils.ft(f), 1, 1/(factor*2), mic_freqs=utils.get_mic_freqs(f, 1)))
+
+            # McMullan et al. 2009 and Paton et al. 2021
+            r.append([factor, np.var(binned)/factor**2])
+
+    return np.array(r)
+
+
+def flat_fields(size, n_frames):
+    np.random.seed(0)
+    return measureNPS.simulate_flat_fields(n_frames, org_shape=size).astype(np.float64)
+
+
+def test_accumulator_reference():
+    frames = flat_fields(256, 8)
+    mean = np.mean(frames, axis=0)
+
+    ps = np.zeros_like(mean)
+    for frame in frames:
+        ps += power_spectrum(frame - mean)
+    nps0 = calculate_nps0(frames, mean)
+
+    acc = measureNPS.accumulate_nps(frames)
+    factors = acc.nps0()[:, 0]
+
+    assert np.allclose(acc.nps(), ps / len(frames) / mean.size)
+    assert np.allclose(acc.nps0()[:, 1], [np.mean(nps0[nps0[:, 0] == factor, 1]) for factor in factors])
+
+
+def test_chunked_difference():
+    # The chunk buffers of the reader are reused, the previous frame of the difference method must not change with them
+    frames = flat_fields(256, 12)
+    reference = measureNPS.accumulate_nps(frames, method='difference')
+
+    for chunk, prefetch in ((4, 0), (4, 2), (5, 1)):
+        acc = None
+        for start, chunk_frames in FrameReader(lambda a, b: frames[a:b], 0, None, chunk, prefetch):
+            acc = measureNPS.accumulate_nps(chunk_frames, acc, start, method='difference')
+
+        assert acc.pairs == reference.pairs
+        assert np.allclose(acc.nps(), reference.nps())
+        assert np.allclose(acc.nps0(), reference.nps0())
@@ -0,0 +1,56 @@
+import sys
+
+import numpy as np
+
+from mtf_nps_dqe.lib import catalog
+from mtf_nps_dqe.nps import measureNPS, reanalyseNPS
+
+
+def run(monkeypatch, module, *args):
+    monkeypatch.setattr(sys, 'argv', [module.__name__] + [str(a) for a in args])
+    return module.main()
+
+
+def test_reanalysed_curves_in_arrays(tmp_path, monkeypatch):
+    np.random.seed(0)
+    frames = measureNPS.simulate_flat_fields(6, org_shape=128).astype(np.float64)
+    acc = measureNPS.accumulate_nps(frames)
+    nps, nps0_meas = measureNPS.nps_spectra(acc)
+    measureNPS.save_nps_2d(str(tmp_path / 'nps2d'), nps, nps0_meas, acc.mean(), acc.first, acc.n, super_res=1)
+
+    db = tmp_path / 'curves.sqlite'
+    assert run(monkeypatch, reanalyseNPS, tmp_path / 'nps2d', '--sectors', 4, '--catalog', db, '--no_plot') == 0
+
+    row, = catalog.query(str(db), kind='nps')
+    # Only the (two) fit parameters of NPS(0) are a list
+    assert not any(isinstance(v, list) for k, v in row['metadata'].items() if k != 'nps0_fit')
+    assert len(row['metadata']['nps0_fit']) == 2
+    assert row['metadata']['sectors'] == 4
+    assert 'anisotropy' in row['metadata']
+
+    arrays = catalog.load_arrays(str(db), row['id'])
+    assert sorted(arrays) == ['col_nnps', 'row_nnps', 'sector_angles', 'sector_nnps']
+    _, w, value, _ = catalog.select(str(db), 'nps')[0]
+    assert arrays['sector_nnps'].shape == (4, len(w))
+    assert arrays['row_nnps'].shape == value.shape
+
+
+def test_source_hashed_once(tmp_path, monkeypatch):
+    source = tmp_path / 'flat.mrc'
+    source.write_bytes(b'frames')
+    db = str(tmp_path / 'curves.sqlite')
+
+    opened = []
+    real_open = open
+    monkeypatch.setattr('builtins.open', lambda f, *a, **kw: opened.append(f) or real_open(f, *a, **kw))
+
+    w = np.linspace(0, 1, 5)
+    for kind in ('mtf', 'nps'):
+        catalog.store_curve(db, kind, w, w, label='a', source=str(source))
+    assert opened.count(str(source)) == 1
+
+    # A changed file is hashed again
+    source.write_bytes(b'other frames')
+    catalog.store_curve(db, 'dqe', w, w, label='a', source=str(source))
+    hashes = {r['kind']: r['source_hash'] for r in catalog.query(db)}
+    assert hashes['mtf'] == hashes['nps'] != hashes['dqe']
@@ -0,0 +1,27 @@
+import numpy as np
+
+from mtf_nps_dqe.lib import events
+
+
+def test_frames_non_representable_frame_time(tmp_path):
+    # Event times on (and next to) the frame boundaries of a frame time of 0.1, which is not exactly representable:
+    # 0.5 // 0.1 == 4, while 5 * 0.1 == 0.5
+    t = np.arange(1, 300) / 10
+    t = np.sort(np.concatenate([[0], t, np.nextafter(t, 0), np.nextafter(t, 1)]))
+    ev = np.zeros(len(t), dtype=[('x', np.uint16), ('y', np.uint16), ('t', np.float64)])
+    ev['x'] = np.arange(len(t)) % 4
+    ev['y'] = np.arange(len(t)) % 3
+    ev['t'] = t
+    filename = str(tmp_path / 'events.npy')
+    np.save(filename, ev)
+
+    frame_time = 0.1
+    index = (t // frame_time).astype(np.int64)
+
+    with events.open_frames(filename, frame_time) as (read, n_frames):
+        frames = np.concatenate([read(start, start + 1) for start in range(n_frames)])
+        assert np.array_equal(read(0, None), frames)
+
+    # Every event is in the frame of its floor divided time, as counted by frame_count
+    assert n_frames == events.frame_count(t, frame_time)
+    assert np.array_equal(frames.sum(axis=(1, 2)), np.bincount(index, minlength=n_frames + 1)[:n_frames])
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from mtf_nps_dqe.lib import simulate
+
+
+def gaussian(dx, dy, sigma=0.7):
+    return np.exp(-(dx ** 2 + dy ** 2) / (2 * sigma ** 2))
+
+
+def test_kernel_matches_gaussian():
+    exact = simulate.make_psf(0.7)
+    sampled = simulate.make_psf(kernel=gaussian, radius=3)
+
+    assert sampled['pixels'].shape == exact['pixels'].shape
+    assert np.allclose(sampled['pixels'], exact['pixels'], atol=1e-3)
+
+
+def test_deposit_blocks():
+    # The charge does not depend on the number of electrons deposited at once, and electrons near the edge of the
+    # frame spread into it
+    rng = np.random.default_rng(0)
+    psf = simulate.make_psf(kernel=np.ones((33, 49)))
+    x, y = simulate.arrivals(rng, 64, 2.0, margin=psf['k'] + 1)
+
+    frame = simulate.deposit(x, y, 64, psf)
+    assert np.allclose(simulate.deposit(x, y, 64, psf, block=100), frame)
+    assert abs(frame.mean() - 2.0) < 0.1
+
+
+def test_invalid_kernel():
+    with pytest.raises(ValueError):
+        simulate.make_psf(kernel=np.ones((4, 5)))
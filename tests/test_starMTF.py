@@ -0,0 +1,24 @@
+import sys
+
+import numpy as np
+
+from mtf_nps_dqe.mtf import starMTF
+
+
+def run(monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ['starMTF'] + [str(a) for a in args])
+    return starMTF.main()
+
+
+def test_round_trip(tmp_path, monkeypatch):
+    w = np.linspace(0, 1, 101)
+    mtf = np.sinc(w / 2) * np.exp(-w)
+    np.savez(tmp_path / 'mtf.npz', w=w, mtf=mtf)
+
+    assert run(monkeypatch, tmp_path / 'mtf.npz', '--output', tmp_path / 'mtf.star') == 0
+    assert run(monkeypatch, tmp_path / 'mtf.star', '--reverse', '--output', tmp_path / 'back.npz') == 0
+
+    with np.load(tmp_path / 'back.npz') as back:
+        assert len(np.unique(back['w'])) == len(back['w'])
+        assert np.allclose(back['w'], w, atol=1e-5)
+        assert np.allclose(back['mtf'], mtf, atol=1e-5)